@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from . import log
+
+defaults = {
+    "max_batch_size": 8,
+    "max_wait_ms": 10,
+}
+
+# Micro-batching scheduler, used to let concurrent requests for the same voice share one forward pass.
+# Items are queued per key (items with the same key can be run in the same batch). A queue is flushed when it
+# holds max_batch_size items, or when its oldest item has waited for max_wait_ms milliseconds.
+# Batches are run one at a time in a scheduler thread, by run_batch(key, items), which returns one result per item.
+# initializer (optional) is called in the scheduler thread when it starts.
+class MicroBatcher:
+
+    def __init__(self, name, run_batch, max_batch_size=defaults["max_batch_size"], max_wait_ms=defaults["max_wait_ms"], initializer=None):
+        if max_batch_size < 1:
+            raise ValueError(f"Invalid max_batch_size for voice {name}: {max_batch_size} (expected >= 1)")
+        if max_wait_ms < 0:
+            raise ValueError(f"Invalid max_wait_ms for voice {name}: {max_wait_ms} (expected >= 0)")
+        self.name = name
+        self.run_batch = run_batch
+        self.initializer = initializer
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.cond = threading.Condition()
+        self.queues = OrderedDict() # key => list of (item, future, enqueued at)
+        self.thread = None
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+        log.debug(f"Created batcher for voice {name} with max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms}")
+
+    # Queues an item, and returns a concurrent.futures.Future for its result
+    def submit(self, key, item):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError(f"Batcher for voice {self.name} is shut down")
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name=f"batcher-{self.name}", daemon=True)
+                self.thread.start()
+            self.queues.setdefault(key, []).append((item, future, time.monotonic()))
+            self.cond.notify()
+        return future
+
+    # Queues a list of items with the same key, and blocks until all of them are done
+    def run(self, key, items):
+        futures = [self.submit(key, item) for item in items]
+        return [f.result() for f in futures]
+
+    # Returns the next batch to run, waiting until one is due. Returns None when shut down.
+    def next_batch(self):
+        max_wait = self.max_wait_ms / 1000.0
+        with self.cond:
+            while True:
+                if self.closed and len(self.queues) == 0:
+                    return None
+                now = time.monotonic()
+                timeout = None
+                for key, queue in self.queues.items():
+                    waited = now - queue[0][2]
+                    if len(queue) >= self.max_batch_size or waited >= max_wait or self.closed:
+                        batch = queue[:self.max_batch_size]
+                        rest = queue[self.max_batch_size:]
+                        if len(rest) > 0:
+                            self.queues[key] = rest
+                            self.queues.move_to_end(key)
+                        else:
+                            del self.queues[key]
+                        return key, batch
+                    if timeout is None or max_wait - waited < timeout:
+                        timeout = max_wait - waited
+                self.cond.wait(timeout)
+
+    def loop(self):
+        if self.initializer is not None:
+            self.initializer()
+        while True:
+            next = self.next_batch()
+            if next is None:
+                return
+            key, batch = next
+            # skip items whose requests were cancelled while waiting
+            batch = [(item, future) for item, future, _ in batch if future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            log.debug(f"Running batch of size {len(batch)} for voice {self.name}")
+            try:
+                results = list(self.run_batch(key, [item for item, _ in batch]))
+                if len(results) != len(batch):
+                    # results can't be matched to items, so no request gets a result that may not be its own
+                    raise ValueError(f"Batch of size {len(batch)} for voice {self.name} returned {len(results)} result(s)")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def as_json(self):
+        with self.cond:
+            queued = sum(len(q) for q in self.queues.values())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "queued": queued,
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches > 0 else None,
+        }
+
+    # Stops the scheduler thread once the queued items are done
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+
+def create_batcher(name, run_batch, opts, initializer=None):
+    return MicroBatcher(name, run_batch, initializer=initializer, **(defaults | opts))
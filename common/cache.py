@@ -0,0 +1,161 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from . import log
+
+# Thread-safe LRU cache, limited by number of entries and (optionally) by total size in bytes.
+# sizeof is a function returning the size of a cached value, used for the byte limit.
+class LRUCache:
+
+    def __init__(self, max_entries=1000, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups > 0 else None,
+            }
+
+
+# Content-addressed key for a synthesis request
+def synthesis_key(voice_name, input, input_type, params):
+    if isinstance(input, str):
+        input = " ".join(input.split())
+    obj = [voice_name, input, input_type, params]
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+# Cache for synthesis results (result json + wav bytes), with an in-memory LRU tier and an optional on-disk tier.
+# The disk tier is not size limited, it is a folder of <key>.json/<key>.wav files that survives restarts.
+class SynthesisCache:
+
+    def __init__(self, max_entries=1000, max_bytes=None, disk_path=None):
+        self.memory = LRUCache(max_entries, max_bytes, sizeof=lambda value: len(value[1]))
+        self.disk_path = disk_path
+        self.disk_hits = 0
+        self.disk_misses = 0
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+        log.debug(f"Created synthesis cache with max_entries={max_entries}, max_bytes={max_bytes}, disk_path={disk_path}")
+
+    # Returns a copy of the cached result and the wav bytes, or None
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk_path is not None:
+            value = self.read_disk(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.put(key, value)
+            else:
+                self.disk_misses += 1
+        if value is None:
+            return None
+        result, wav = value
+        return copy.deepcopy(result), wav
+
+    def put(self, key, result, wav):
+        value = (copy.deepcopy(result), wav)
+        self.memory.put(key, value)
+        if self.disk_path is not None:
+            self.write_disk(key, value)
+
+    def read_disk(self, key):
+        json_file = os.path.join(self.disk_path, f"{key}.json")
+        wav_file = os.path.join(self.disk_path, f"{key}.wav")
+        if not (os.path.isfile(json_file) and os.path.isfile(wav_file)):
+            return None
+        try:
+            with open(json_file, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            with open(wav_file, "rb") as f:
+                wav = f.read()
+            return result, wav
+        except (OSError, ValueError) as e:
+            log.warning(f"Couldn't read cached synthesis {key}: {e}")
+            return None
+
+    def write_disk(self, key, value):
+        result, wav = value
+        # write to temp files and rename, so that concurrent readers never see partial files
+        try:
+            for ext, write in [(".wav", lambda f: f.write(wav)),
+                               (".json", lambda f: f.write(json.dumps(result, ensure_ascii=False).encode("utf-8")))]:
+                fn = os.path.join(self.disk_path, f"{key}{ext}")
+                tmp = f"{fn}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    write(f)
+                os.replace(tmp, fn)
+        except OSError as e:
+            log.warning(f"Couldn't write cached synthesis {key}: {e}")
+
+    def stats(self):
+        res = self.memory.stats()
+        if self.disk_path is not None:
+            res["disk_path"] = self.disk_path
+            res["disk_hits"] = self.disk_hits
+            res["disk_misses"] = self.disk_misses
+        return res
+
+
+def create_synthesis_cache(opts, output_path):
+    disk_path = None
+    if opts.get("disk", False):
+        disk_path = os.path.join(output_path, "cache")
+    return SynthesisCache(max_entries=opts.get("max_entries", 1000),
+                          max_bytes=opts.get("max_bytes", None),
+                          disk_path=disk_path)
@@ -91,17 +91,27 @@ import threading
 import time
 import psutil
 
+# Logs the RSS of the server process every interval seconds.
+# Listeners (e.g., ResidencyManager.check_rss) are called with each sample, in bytes.
 class MemoryLogger:
 
     def __init__(self, interval=60):
         self.interval = interval
+        self.listeners = []
+        self.rss = None
         debug(f"Initializing memory logger with interal {interval}")
     
     def log_memory(self):
         process = psutil.Process(os.getpid())
         while True:
-            mem = process.memory_info().rss / (1024 ** 3)  # GB
+            self.rss = process.memory_info().rss
+            mem = self.rss / (1024 ** 3)  # GB
             debug(f"[MEM] {mem:.2f} GB")
+            for listener in self.listeners:
+                try:
+                    listener(self.rss)
+                except Exception as e:
+                    error(f"Memory listener failed: {e}")
             #mem = process.memory_info().rss / (1024 ** 2)
             #debug(f"[MEM] {mem:.2f} MB")
             time.sleep(self.interval)
@@ -0,0 +1,65 @@
+import threading
+
+from . import log
+
+# A shared object with a reference count. The lock is shared by all users of the object, and is also held while it is created.
+# data is a dict for state that belongs to the key rather than to the object (e.g., a cache of the object's output),
+# and is kept when the object is dropped, so that it is still there when the object is created again.
+class Shared:
+    def __init__(self, key, data):
+        self.key = key
+        self.value = None
+        self.refs = 0
+        self.lock = threading.Lock()
+        self.data = data
+
+
+# Process wide registry of shared objects (e.g., phonemizer models used by several voices).
+# Objects are created on first acquire, and dropped when the last user releases them.
+class SharedRegistry:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = {} # key => Shared
+        self.data = {} # key => Shared.data, kept between releases
+        self.loads = 0
+        self.shared_loads = 0
+
+    # Returns the Shared entry for key, calling create() to create its value if it doesn't exist yet
+    def acquire(self, key, create):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = Shared(key, self.data.setdefault(key, {}))
+                self.entries[key] = entry
+            entry.refs += 1
+        try:
+            # objects with different keys can be created at the same time
+            with entry.lock:
+                if entry.value is None:
+                    entry.value = create()
+                    self.loads += 1
+                    log.debug(f"Created shared {self.name} {key}")
+                else:
+                    self.shared_loads += 1
+                    log.debug(f"Reusing shared {self.name} {key} ({entry.refs} users)")
+        except Exception:
+            self.release(entry)
+            raise
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs <= 0 and self.entries.get(entry.key) is entry:
+                del self.entries[entry.key]
+                log.debug(f"Released shared {self.name} {entry.key}")
+
+    def as_json(self):
+        with self.lock:
+            return {
+                "entries": [{"key": list(e.key), "users": e.refs} for e in self.entries.values()],
+                "loads": self.loads,
+                "shared_loads": self.shared_loads,
+            }
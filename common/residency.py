@@ -0,0 +1,145 @@
+import gc
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import log
+
+defaults = {
+    "max_voices": None,
+    "max_bytes": None,
+    "max_rss": None,
+}
+
+def rss():
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+# Keeps track of loaded voices, and unloads the least recently used ones to stay within limits:
+#   max_voices: max number of loaded voices
+#   max_bytes: max memory used by loaded voices, estimated per voice as the increase in RSS while loading it
+#   max_rss: max RSS of the server process, checked on each sample of the memory logger (see check_rss)
+# Unset limits are not enforced. Voices that are in use (see use) are never unloaded, so limits can be
+# exceeded temporarily when many voices are used at the same time.
+class ResidencyManager:
+
+    def __init__(self, model_paths, max_voices=defaults["max_voices"], max_bytes=defaults["max_bytes"], max_rss=defaults["max_rss"]):
+        if max_voices is not None and max_voices < 1:
+            raise ValueError(f"Invalid max_voices for residency: {max_voices} (expected >= 1)")
+        self.model_paths = model_paths
+        self.max_voices = max_voices
+        self.max_bytes = max_bytes
+        self.max_rss = max_rss
+        self.lock = threading.Lock()
+        self.resident = OrderedDict() # voice name => voice, least recently used first
+        self.sizes = {} # voice name => estimated bytes
+        self.in_use = {} # voice name => number of running jobs
+        self.load_locks = {} # voice name => lock held while the voice is loading
+        self.evicted = set()
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    # Loads a voice (if needed), and unloads other voices if the limits are exceeded.
+    # Concurrent calls for the same voice load it once: the first call loads the voice, and the others wait for it.
+    def load(self, voice):
+        if voice.loaded:
+            self.touch(voice)
+            return
+        with self.load_lock(voice.name):
+            if voice.loaded:
+                self.touch(voice)
+                return
+            before = rss()
+            voice.load(self.model_paths)
+            size = max(0, rss() - before)
+        with self.lock:
+            self.resident[voice.name] = voice
+            self.resident.move_to_end(voice.name)
+            self.sizes[voice.name] = size
+            self.loads += 1
+            if voice.name in self.evicted:
+                self.reloads += 1
+                self.evicted.discard(voice.name)
+        log.info(f"Loaded voice {voice.name} (estimated size {size / 1024 / 1024:.1f} MB)")
+        self.enforce(keep=voice.name)
+
+    def load_lock(self, name):
+        with self.lock:
+            return self.load_locks.setdefault(name, threading.Lock())
+
+    # Marks a voice as in use for the duration of a synthesis job, loading it if needed
+    @contextmanager
+    def use(self, voice):
+        with self.lock:
+            self.in_use[voice.name] = self.in_use.get(voice.name, 0) + 1
+        try:
+            self.load(voice)
+            yield voice
+        finally:
+            with self.lock:
+                self.in_use[voice.name] -= 1
+            # limits may have been exceeded while the voice was in use
+            self.enforce()
+
+    def touch(self, voice):
+        with self.lock:
+            if voice.name in self.resident:
+                self.resident.move_to_end(voice.name)
+
+    def over_limits(self, process_rss=None):
+        if self.max_voices is not None and len(self.resident) > self.max_voices:
+            return True
+        if self.max_bytes is not None and sum(self.sizes.get(name, 0) for name in self.resident) > self.max_bytes:
+            return True
+        if self.max_rss is not None and process_rss is not None and process_rss > self.max_rss:
+            return True
+        return False
+
+    # Unloads least recently used voices that aren't in use, until the limits are met
+    def enforce(self, keep=None, process_rss=None):
+        with self.lock:
+            while self.over_limits(process_rss):
+                candidates = [name for name in self.resident if name != keep and self.in_use.get(name, 0) == 0]
+                if len(candidates) == 0:
+                    log.warning(f"Residency limits exceeded, but all {len(self.resident)} loaded voices are in use")
+                    return
+                self.evict(candidates[0])
+                # RSS is only sampled by the memory logger, so evict one voice per sample
+                process_rss = None
+
+    def evict(self, name):
+        voice = self.resident.pop(name)
+        self.sizes.pop(name, None)
+        voice.unload()
+        self.evicted.add(name)
+        self.evictions += 1
+        gc.collect()
+        log.info(f"Unloaded voice {name} (least recently used)")
+
+    # Listener for log.MemoryLogger samples
+    def check_rss(self, process_rss):
+        if self.max_rss is not None and process_rss > self.max_rss:
+            self.enforce(process_rss=process_rss)
+
+    def as_json(self):
+        with self.lock:
+            return {
+                "max_voices": self.max_voices,
+                "max_bytes": self.max_bytes,
+                "max_rss": self.max_rss,
+                "resident": list(self.resident),
+                "resident_bytes": sum(self.sizes.values()),
+                "sizes": dict(self.sizes),
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
+
+
+def create_manager(model_paths, opts):
+    opts = dict(defaults) | (opts or {})
+    opts.pop("_comment", None)
+    return ResidencyManager(model_paths, **opts)
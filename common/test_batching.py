@@ -0,0 +1,75 @@
+import pytest
+import threading
+import time
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import batching
+
+class TestMicroBatcher:
+
+    def test_flush_on_max_batch_size(self):
+        batches = []
+        def run_batch(key, items):
+            batches.append((key, list(items)))
+            return [i * 10 for i in items]
+        batcher = batching.MicroBatcher("test", run_batch, max_batch_size=3, max_wait_ms=10000)
+        futures = [batcher.submit("k", i) for i in range(3)]
+        assert [f.result(timeout=5) for f in futures] == [0, 10, 20]
+        assert batches == [("k", [0, 1, 2])]
+        batcher.shutdown()
+
+    def test_flush_on_max_wait(self):
+        batcher = batching.MicroBatcher("test", lambda key, items: items, max_batch_size=10, max_wait_ms=20)
+        start = time.monotonic()
+        assert batcher.run("k", [1, 2]) == [1, 2]
+        assert time.monotonic() - start >= 0.02
+        assert batcher.as_json()["batches"] == 1
+        batcher.shutdown()
+
+    def test_concurrent_callers_share_batch(self):
+        sizes = []
+        def run_batch(key, items):
+            sizes.append(len(items))
+            return items
+        batcher = batching.MicroBatcher("test", run_batch, max_batch_size=4, max_wait_ms=1000)
+        results = {}
+        def call(i):
+            results[i] = batcher.run("k", [i])
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+        assert results == {i: [i] for i in range(4)}
+        assert sizes == [4]
+        batcher.shutdown()
+
+    def test_keys_are_not_mixed(self):
+        batches = []
+        def run_batch(key, items):
+            batches.append((key, sorted(items)))
+            return items
+        batcher = batching.MicroBatcher("test", run_batch, max_batch_size=2, max_wait_ms=10000)
+        futures = [batcher.submit("a", 1), batcher.submit("b", 2), batcher.submit("a", 3), batcher.submit("b", 4)]
+        for f in futures:
+            f.result(timeout=5)
+        assert sorted(batches) == [("a", [1, 3]), ("b", [2, 4])]
+        batcher.shutdown()
+
+    def test_error_is_passed_to_all_items(self):
+        def run_batch(key, items):
+            raise RuntimeError("failed")
+        batcher = batching.MicroBatcher("test", run_batch, max_batch_size=2, max_wait_ms=0)
+        with pytest.raises(RuntimeError):
+            batcher.run("k", [1, 2])
+        batcher.shutdown()
+
+    def test_missing_results_are_errors(self):
+        batcher = batching.MicroBatcher("test", lambda key, items: items[:-1], max_batch_size=2, max_wait_ms=1000)
+        futures = [batcher.submit("k", i) for i in range(2)]
+        for f in futures:
+            with pytest.raises(ValueError):
+                f.result(timeout=5)
+        batcher.shutdown()
@@ -0,0 +1,48 @@
+import pytest
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import cache
+
+class TestCache:
+
+    def test_lru_eviction(self):
+        c = cache.LRUCache(max_entries=2)
+        c.put("a", 1)
+        c.put("b", 2)
+        assert c.get("a") == 1 # a is now most recently used
+        c.put("c", 3)
+        assert "b" not in c
+        assert c.get("a") == 1
+        assert c.get("c") == 3
+        stats = c.stats()
+        assert stats["evictions"] == 1
+        assert stats["hits"] == 3
+
+    def test_byte_limit(self):
+        c = cache.LRUCache(max_entries=10, max_bytes=5, sizeof=len)
+        c.put("a", "xxx")
+        c.put("b", "yyy")
+        assert "a" not in c
+        assert c.stats()["bytes"] == 3
+        c.put("c", "too large")
+        assert "c" not in c
+
+    def test_synthesis_key(self):
+        params = {"length_scale": 1.0}
+        assert cache.synthesis_key("v", " hello   world ", "text", params) == cache.synthesis_key("v", "hello world", "text", params)
+        assert cache.synthesis_key("v", "hello world", "text", params) != cache.synthesis_key("v", "hello world", "mixed", params)
+        assert cache.synthesis_key("v", "hello world", "text", params) != cache.synthesis_key("v", "hello world", "text", {"length_scale": 1.1})
+
+    def test_disk_tier(self, tmp_path):
+        c1 = cache.SynthesisCache(max_entries=10, disk_path=str(tmp_path))
+        c1.put("key", {"tokens": [{"orth": "hej"}]}, b"RIFF")
+        result, wav = c1.get("key")
+        result["audio"] = "modified.wav"
+        assert "audio" not in c1.get("key")[0]
+
+        c2 = cache.SynthesisCache(max_entries=10, disk_path=str(tmp_path))
+        assert c2.get("key") == ({"tokens": [{"orth": "hej"}]}, b"RIFF")
+        assert c2.stats()["disk_hits"] == 1
+        assert c2.get("other") is None
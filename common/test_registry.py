@@ -0,0 +1,75 @@
+import pytest
+import threading
+import time
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import registry
+
+class TestSharedRegistry:
+
+    def test_shared_instance(self):
+        reg = registry.SharedRegistry("test")
+        e1 = reg.acquire(("dp", "model.pt", "sv"), object)
+        e2 = reg.acquire(("dp", "model.pt", "sv"), object)
+        e3 = reg.acquire(("dp", "model.pt", "en"), object)
+        assert e1 is e2
+        assert e1.value is e2.value
+        assert e3.value is not e1.value
+        assert e1.refs == 2
+        stats = reg.as_json()
+        assert stats["loads"] == 2
+        assert stats["shared_loads"] == 1
+
+    def test_release(self):
+        reg = registry.SharedRegistry("test")
+        key = ("espeak", None, "sv")
+        e1 = reg.acquire(key, object)
+        e2 = reg.acquire(key, object)
+        reg.release(e1)
+        assert key in reg.entries
+        reg.release(e2)
+        assert key not in reg.entries
+        # created again on next acquire
+        e3 = reg.acquire(key, object)
+        assert e3.value is not e1.value
+
+    def test_data_is_kept(self):
+        reg = registry.SharedRegistry("test")
+        key = ("espeak", None, "sv")
+        e1 = reg.acquire(key, object)
+        e1.data["cache"] = {"hej": "hˈɛj"}
+        assert reg.acquire(key, object).data is e1.data
+        assert reg.acquire(("espeak", None, "en"), object).data == {}
+        reg.release(e1)
+        reg.release(e1)
+        assert key not in reg.entries
+        # the object is created again, but its data is still there
+        assert reg.acquire(key, object).data["cache"] == {"hej": "hˈɛj"}
+
+    def test_failed_create(self):
+        reg = registry.SharedRegistry("test")
+        def fail():
+            raise RuntimeError("failed")
+        with pytest.raises(RuntimeError):
+            reg.acquire("key", fail)
+        assert "key" not in reg.entries
+        assert reg.acquire("key", object).value is not None
+
+    def test_concurrent_acquire_creates_once(self):
+        reg = registry.SharedRegistry("test")
+        created = []
+        def create():
+            time.sleep(0.05)
+            created.append(1)
+            return object()
+        entries = []
+        threads = [threading.Thread(target=lambda: entries.append(reg.acquire("key", create))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(created) == 1
+        assert len(set(id(e.value) for e in entries)) == 1
+        assert entries[0].refs == 4
@@ -0,0 +1,104 @@
+import pytest
+import threading
+import time
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import residency, log
+
+log.configure("test", log.default_handler, log.default_level)
+
+class FakeVoice:
+    def __init__(self, name):
+        self.name = name
+        self.loaded = False
+        self.loads = 0
+
+    def load(self, model_paths):
+        self.loaded = True
+        self.loads += 1
+
+    def unload(self):
+        self.loaded = False
+
+class TestResidencyManager:
+
+    def test_evict_least_recently_used(self):
+        manager = residency.ResidencyManager([], max_voices=2)
+        a, b, c = FakeVoice("a"), FakeVoice("b"), FakeVoice("c")
+        manager.load(a)
+        manager.load(b)
+        manager.load(a) # a is now more recently used than b
+        manager.load(c)
+        assert a.loaded and c.loaded
+        assert not b.loaded
+        stats = manager.as_json()
+        assert stats["resident"] == ["a", "c"]
+        assert stats["loads"] == 3
+        assert stats["evictions"] == 1
+        assert stats["reloads"] == 0
+
+    def test_reload(self):
+        manager = residency.ResidencyManager([], max_voices=1)
+        a, b = FakeVoice("a"), FakeVoice("b")
+        manager.load(a)
+        manager.load(b)
+        with manager.use(a):
+            assert a.loaded
+        assert a.loads == 2
+        assert not b.loaded
+        stats = manager.as_json()
+        assert stats["reloads"] == 1
+        assert stats["evictions"] == 2
+
+    def test_voices_in_use_are_not_evicted(self):
+        manager = residency.ResidencyManager([], max_voices=1)
+        a, b = FakeVoice("a"), FakeVoice("b")
+        with manager.use(a):
+            manager.load(b)
+            assert a.loaded and b.loaded
+            assert manager.as_json()["evictions"] == 0
+        # limits are enforced when the voice is no longer in use
+        assert not a.loaded and b.loaded
+
+    def test_byte_budget(self):
+        manager = residency.ResidencyManager([], max_bytes=100)
+        a, b = FakeVoice("a"), FakeVoice("b")
+        manager.load(a)
+        manager.load(b)
+        # sizes are measured as RSS increase while loading, so set them explicitly
+        manager.sizes = {"a": 80, "b": 80}
+        manager.enforce(keep="b")
+        assert not a.loaded and b.loaded
+
+    def test_max_rss(self):
+        manager = residency.ResidencyManager([], max_rss=1000)
+        a, b = FakeVoice("a"), FakeVoice("b")
+        manager.load(a)
+        manager.load(b)
+        manager.check_rss(500)
+        assert a.loaded and b.loaded
+        # one voice is unloaded per sample
+        manager.check_rss(2000)
+        assert not a.loaded and b.loaded
+
+    def test_concurrent_loads_load_once(self):
+        manager = residency.ResidencyManager([])
+        a = FakeVoice("a")
+        def slow_load(model_paths):
+            time.sleep(0.05)
+            a.loads += 1
+            a.loaded = True
+        a.load = slow_load
+        threads = [threading.Thread(target=manager.load, args=(a,)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert a.loads == 1
+        assert manager.as_json()["loads"] == 1
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            residency.create_manager([], {"max_voices": 0})
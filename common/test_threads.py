@@ -0,0 +1,67 @@
+import pytest
+import asyncio
+from types import SimpleNamespace
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import threads, workers
+
+affinity_supported = hasattr(os, "sched_setaffinity")
+
+class TestThreadSettings:
+
+    def test_parse_cpus(self):
+        assert threads.parse_cpus("0-3,8,10-11") == {0, 1, 2, 3, 8, 10, 11}
+        assert threads.parse_cpus([2, "1"]) == {1, 2}
+        assert threads.parse_cpus("") == set()
+
+    def test_voice_overrides_global(self):
+        s = threads.create_settings("test", {"intra_op_threads": 4, "inter_op_threads": 2, "_comment": "..."}, {"intra_op_threads": 1})
+        assert s.as_json() == {"intra_op_threads": 1, "inter_op_threads": 2, "cpu_affinity": None}
+
+    def test_defaults(self):
+        s = threads.create_settings("test", None, None)
+        assert s.as_json() == {"intra_op_threads": None, "inter_op_threads": None, "cpu_affinity": None}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            threads.ThreadSettings("test", intra_op_threads=0)
+
+    def test_session_options(self):
+        options = SimpleNamespace(intra_op_num_threads=0)
+        threads.ThreadSettings("test", intra_op_threads=2).session_options(options)
+        assert options.intra_op_num_threads == 2
+
+    @pytest.mark.skipif(not affinity_supported, reason="CPU affinity not supported")
+    def test_invalid_affinity(self):
+        with pytest.raises(ValueError):
+            threads.ThreadSettings("test", cpu_affinity=[os.cpu_count() + 1000])
+
+    @pytest.mark.skipif(not affinity_supported, reason="CPU affinity not supported")
+    def test_pinned_restores_affinity(self):
+        before = os.sched_getaffinity(0)
+        cpu = min(before)
+        s = threads.ThreadSettings("test", cpu_affinity=[cpu])
+        with s.pinned():
+            assert os.sched_getaffinity(0) == {cpu}
+        assert os.sched_getaffinity(0) == before
+
+    @pytest.mark.skipif(not affinity_supported, reason="CPU affinity not supported")
+    def test_pool_threads_use_affinity(self):
+        before = os.sched_getaffinity(0)
+        cpu = max(before)
+        s = threads.ThreadSettings("test", cpu_affinity=str(cpu))
+        pool = workers.VoicePool("test", max_workers=1, initializer=s.apply)
+        assert asyncio.run(pool.run(os.sched_getaffinity, 0)) == {cpu}
+        # the calling thread is not affected
+        assert os.sched_getaffinity(0) == before
+        pool.shutdown()
+
+    def test_process_wide_counts_only_global(self):
+        s = threads.create_settings("test", {"intra_op_threads": 2}, {"cpu_affinity": None}, process_wide_counts=True)
+        assert s.intra_op_threads == 2
+        with pytest.raises(ValueError):
+            threads.create_settings("test", {"intra_op_threads": 2}, {"intra_op_threads": 4}, process_wide_counts=True)
+        # onnxruntime thread counts can be set per voice
+        assert threads.create_settings("test", {"intra_op_threads": 2}, {"intra_op_threads": 4}).intra_op_threads == 4
@@ -0,0 +1,78 @@
+import pytest
+import threading
+import time
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import warmup, residency, log
+
+log.configure("test", log.default_handler, log.default_level)
+
+class FakeVoice:
+    def __init__(self, name, enabled=True, load_time=0.0, fail=False):
+        self.name = name
+        self.enabled = enabled
+        self.loaded = False
+        self.load_time = load_time
+        self.fail = fail
+
+    def load(self, model_paths):
+        time.sleep(self.load_time)
+        if self.fail:
+            raise Exception("model not found")
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+def wait_for(condition, timeout=2.0):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            raise TimeoutError()
+        time.sleep(0.01)
+
+class TestWarmup:
+
+    def test_parallel_load_and_states(self):
+        voices = {
+            "fast": FakeVoice("fast"),
+            "slow": FakeVoice("slow", load_time=0.3),
+            "broken": FakeVoice("broken", fail=True),
+            "lazy": FakeVoice("lazy"),
+            "off": FakeVoice("off", enabled=False),
+        }
+        warmed_up = []
+        w = warmup.Warmup(voices, residency.ResidencyManager([]), lambda v: warmed_up.append(v.name), max_workers=3)
+        w.start(["fast", "slow", "broken"])
+        # the server is ready as soon as the first voice is warm
+        wait_for(w.ready)
+        health = w.health()["voices"]
+        assert health["fast"]["state"] == "ready"
+        assert health["slow"]["state"] in ["loading", "warming_up"]
+        wait_for(lambda: w.voice_state(voices["slow"]) == "ready")
+        health = w.health()["voices"]
+        assert health["broken"]["state"] == "failed"
+        assert health["broken"]["error"] == "model not found"
+        assert health["lazy"]["state"] == "not_loaded"
+        assert health["off"]["state"] == "disabled"
+        assert sorted(warmed_up) == ["fast", "slow"]
+        w.shutdown()
+
+    def test_ready_without_startup_voices(self):
+        w = warmup.Warmup({"a": FakeVoice("a")}, residency.ResidencyManager([]), lambda v: None)
+        w.start([])
+        assert w.ready()
+
+    def test_failed_warm_up(self):
+        voices = {"a": FakeVoice("a")}
+        def fail(v):
+            raise Exception("synthesis failed")
+        w = warmup.create_warmup(voices, residency.ResidencyManager([]), fail, {"max_workers": 1})
+        w.start(["a"])
+        wait_for(lambda: "error" in w.health()["voices"]["a"])
+        # the voice is loaded, but warm-up failed, so the server doesn't report ready
+        assert not w.ready()
+        assert w.health()["voices"]["a"]["error"] == "synthesis failed"
+        w.shutdown()
@@ -0,0 +1,109 @@
+import pytest
+import asyncio
+import threading
+import time
+
+import gc
+import json
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import workers
+
+class TestVoicePool:
+
+    def test_run(self):
+        pool = workers.VoicePool("test", max_workers=2, max_queue=0)
+        res = asyncio.run(pool.run(lambda a, b: a + b, 1, 2))
+        assert res == 3
+        assert pool.as_json()["completed"] == 1
+        assert pool.as_json()["in_flight"] == 0
+
+    def test_reject_when_full(self):
+        pool = workers.VoicePool("test", max_workers=1, max_queue=1, retry_after=3)
+        release = threading.Event()
+        running = [pool.submit(release.wait), pool.submit(release.wait)]
+        with pytest.raises(workers.PoolFullError) as e:
+            pool.submit(release.wait)
+        assert e.value.retry_after == 3
+        stats = pool.as_json()
+        assert stats["in_flight"] == 1
+        assert stats["queued"] == 1
+        assert stats["rejected"] == 1
+        release.set()
+        for f in running:
+            f.result(timeout=5)
+        # slots are freed once the jobs are done
+        for _ in range(100):
+            if pool.as_json()["completed"] == 2:
+                break
+            time.sleep(0.01)
+        pool.submit(lambda: None).result(timeout=5)
+        assert pool.as_json()["rejected"] == 1
+
+    def test_voice_overrides_global(self):
+        pool = workers.create_pool("test", {"max_workers": 4, "max_queue": 2}, {"max_queue": 0})
+        assert pool.max_workers == 4
+        assert pool.max_queue == 0
+
+    @pytest.mark.parametrize("server", ["piper_server", "matcha_server"])
+    def test_pool_from_sample_config(self, server):
+        config_file = os.path.join(parentdir, server, "config_sample.json")
+        with open(config_file) as f:
+            data = json.load(f)
+        assert "_comment" in data["workers"]
+        pool = workers.create_pool("test", data["workers"], {})
+        assert pool.max_workers == data["workers"]["max_workers"]
+        assert pool.max_queue == data["workers"]["max_queue"]
+
+    def test_stream(self):
+        pool = workers.VoicePool("test", max_workers=1, max_queue=0)
+
+        async def consume():
+            return [x async for x in pool.stream(x for x in [b"a", b"b", b"c"])]
+
+        assert asyncio.run(consume()) == [b"a", b"b", b"c"]
+        assert pool.as_json()["completed"] == 1
+        assert pool.as_json()["in_flight"] == 0
+
+    def test_stream_start(self):
+        pool = workers.VoicePool("test", max_workers=1, max_queue=0)
+
+        def failing():
+            raise RuntimeError("voice couldn't be loaded")
+            yield b"a"
+
+        async def start(gen):
+            stream = pool.stream(gen)
+            started = await stream.start()
+            return started, [x async for x in stream]
+
+        # the first item is produced by start, and kept for iteration
+        assert asyncio.run(start(x for x in [b"a", b"b"])) == (True, [b"a", b"b"])
+        # an empty stream (e.g., a voice that isn't loaded) is detected before a response is started
+        assert asyncio.run(start(x for x in [])) == (False, [])
+        with pytest.raises(RuntimeError):
+            asyncio.run(start(failing()))
+        assert pool.pending == 0
+
+    def test_stream_dropped(self):
+        pool = workers.VoicePool("test", max_workers=1, max_queue=0)
+        closed = []
+
+        def gen():
+            try:
+                yield b"a"
+            finally:
+                closed.append(True)
+
+        # a stream that is never iterated (e.g., the response is dropped) gives its slot back
+        stream = pool.stream(gen())
+        assert pool.pending == 1
+        with pytest.raises(workers.PoolFullError):
+            pool.stream(gen())
+        del stream
+        gc.collect()
+        assert pool.pending == 0
+
+        asyncio.run(pool.stream(gen()).aclose())
+        assert pool.pending == 0
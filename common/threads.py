@@ -0,0 +1,118 @@
+import os
+import sys
+from contextlib import contextmanager
+
+from . import log
+
+# CPU thread settings for a voice, from the global "threads" section of the config file, overridden per voice:
+#   intra_op_threads: threads used within one operator
+#   inter_op_threads: threads used to run independent operators in parallel
+# Thread counts are per voice for onnxruntime (session options). torch thread pools are process wide, so for torch they
+# can only be set in the global section (see matcha_server/backends.py).
+#   cpu_affinity: CPUs that the voice's threads may run on, as a list of CPU ids or a string like "0-3,8-11" (Linux only)
+# Unset values are left to the library defaults.
+class ThreadSettings:
+
+    def __init__(self, name, intra_op_threads=None, inter_op_threads=None, cpu_affinity=None):
+        for k, v in [("intra_op_threads", intra_op_threads), ("inter_op_threads", inter_op_threads)]:
+            if v is not None and v < 1:
+                raise ValueError(f"Invalid {k} for voice {name}: {v} (expected >= 1)")
+        self.name = name
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.cpu_affinity = parse_cpus(cpu_affinity) if cpu_affinity is not None else None
+        if self.cpu_affinity is not None and not hasattr(os, "sched_setaffinity"):
+            log.warning(f"CPU affinity is not supported on this platform, ignoring cpu_affinity for voice {name}")
+            self.cpu_affinity = None
+        if self.cpu_affinity is not None:
+            available = os.sched_getaffinity(0)
+            if len(self.cpu_affinity) == 0 or not self.cpu_affinity <= available:
+                raise ValueError(f"Invalid cpu_affinity for voice {name}: {cpu_affinity} (available CPUs: {sorted(available)})")
+
+    # Sets the thread options of an onnxruntime.SessionOptions
+    def session_options(self, options):
+        if self.intra_op_threads is not None:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads is not None:
+            import onnxruntime
+            options.inter_op_num_threads = self.inter_op_threads
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        return options
+
+    # Applies the CPU affinity to the calling thread. Used as initializer for the voice's worker threads.
+    def apply(self):
+        if self.cpu_affinity is not None:
+            os.sched_setaffinity(0, self.cpu_affinity)
+
+    # Pins the calling thread to cpu_affinity while loading models, so that threads created by the libraries
+    # (e.g., the onnxruntime thread pools) inherit the affinity. The previous affinity is restored afterwards.
+    @contextmanager
+    def pinned(self):
+        if self.cpu_affinity is None:
+            yield
+            return
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cpu_affinity)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous)
+
+    def as_json(self):
+        return {
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "cpu_affinity": sorted(self.cpu_affinity) if self.cpu_affinity is not None else None,
+        }
+
+
+# Parses a list of CPU ids, or a string like "0-3,8-11"
+def parse_cpus(cpus):
+    if isinstance(cpus, str):
+        res = set()
+        for part in cpus.split(","):
+            part = part.strip()
+            if "-" in part:
+                start, end = part.split("-")
+                res.update(range(int(start), int(end) + 1))
+            elif part != "":
+                res.add(int(part))
+        return res
+    return set(int(c) for c in cpus)
+
+
+# process_wide_counts: thread counts can't be set per voice (torch backend), only in the global section
+def create_settings(name, global_opts, voice_opts, process_wide_counts=False):
+    voice_opts = voice_opts or {}
+    if process_wide_counts:
+        for k in ["intra_op_threads", "inter_op_threads"]:
+            if voice_opts.get(k) is not None:
+                raise ValueError(f"Invalid threads for voice {name}: {k} can't be set per voice with the torch backend (torch thread pools are process wide), set it in the global threads section")
+    opts = {}
+    opts.update(global_opts or {})
+    opts.update(voice_opts)
+    opts.pop("_comment", None)
+    return ThreadSettings(name, **opts)
+
+
+# Process wide thread settings, as reported by the OS and the libraries
+def process_info():
+    res = {
+        "cpu_count": os.cpu_count(),
+        "pid": os.getpid(),
+    }
+    if hasattr(os, "sched_getaffinity"):
+        res["cpu_affinity"] = sorted(os.sched_getaffinity(0))
+    if "torch" in sys.modules:
+        import torch
+        res["torch"] = {
+            "version": torch.__version__,
+            "intra_op_threads": torch.get_num_threads(),
+            "inter_op_threads": torch.get_num_interop_threads(),
+        }
+    if "onnxruntime" in sys.modules:
+        import onnxruntime
+        res["onnxruntime"] = {
+            "version": onnxruntime.__version__,
+        }
+    return res
@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log
+
+defaults = {
+    "max_workers": 4,
+    "synthesize": True,
+}
+
+# Loads voices in a background thread pool on startup, so that the server can take requests while voices are loading.
+# After loading, each voice runs a dummy synthesis with warm_up(voice), to initialize the ONNX/torch graphs before the first request.
+# Voice states:
+#   disabled: the voice is not enabled in the config file
+#   pending: waiting for a warm-up thread
+#   loading, warming_up: in progress
+#   failed: loading or warm-up failed (see error)
+#   ready: loaded (and warmed up, if it was loaded on startup)
+#   not_loaded: not loaded on startup (loaded on first request), or unloaded by the residency manager
+class Warmup:
+
+    def __init__(self, voices, residency, warm_up, max_workers=defaults["max_workers"], synthesize=defaults["synthesize"]):
+        if max_workers < 1:
+            raise ValueError(f"Invalid max_workers for warmup: {max_workers} (expected >= 1)")
+        self.voices = voices
+        self.residency = residency
+        self.warm_up = warm_up
+        self.max_workers = max_workers
+        self.synthesize = synthesize
+        self.lock = threading.Lock()
+        self.states = {} # voice name => state of voices loaded on startup
+        self.errors = {}
+        self.times = {}
+        self.executor = None
+
+    def start(self, names):
+        if len(names) == 0:
+            return
+        with self.lock:
+            for name in names:
+                self.states[name] = "pending"
+        self.executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(names)), thread_name_prefix="warmup")
+        for name in names:
+            self.executor.submit(self.run, self.voices[name])
+        log.info(f"Loading {len(names)} voice(s) in the background: {names}")
+
+    def set_state(self, name, state):
+        with self.lock:
+            self.states[name] = state
+
+    def run(self, voice):
+        start_time = time.time()
+        try:
+            self.set_state(voice.name, "loading")
+            with self.residency.use(voice):
+                if self.synthesize:
+                    self.set_state(voice.name, "warming_up")
+                    warm_up_start_time = time.time()
+                    self.warm_up(voice)
+                    log.info(f"Warmed up voice {voice.name} in {time.time() - warm_up_start_time:.2f} seconds")
+            self.times[voice.name] = time.time() - start_time
+            self.set_state(voice.name, "ready")
+        except Exception as e:
+            log.error(f"Couldn't load voice {voice.name} on startup: {e}")
+            self.errors[voice.name] = f"{e}"
+            self.set_state(voice.name, "failed")
+
+    def voice_state(self, voice):
+        if not voice.enabled:
+            return "disabled"
+        with self.lock:
+            state = self.states.get(voice.name)
+        if state in ["pending", "loading", "warming_up"]:
+            return state
+        if voice.loaded:
+            return "ready"
+        if state == "failed":
+            return state
+        return "not_loaded"
+
+    # Ready as soon as one of the voices loaded on startup is warmed up (or when no voices are loaded on startup).
+    # Voices unloaded later by the residency manager are loaded again on request, so the server stays ready.
+    def ready(self):
+        with self.lock:
+            return len(self.states) == 0 or "ready" in self.states.values()
+
+    def health(self):
+        voices = {}
+        for name, v in self.voices.items():
+            obj = {"state": self.voice_state(v)}
+            if name in self.times:
+                obj["startup_seconds"] = self.times[name]
+            if name in self.errors:
+                obj["error"] = self.errors[name]
+            voices[name] = obj
+        return {
+            "ready": self.ready(),
+            "voices": voices,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_warmup(voices, residency, warm_up, opts):
+    opts = dict(defaults) | (opts or {})
+    opts.pop("_comment", None)
+    return Warmup(voices, residency, warm_up, **opts)
@@ -0,0 +1,160 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log
+
+defaults = {
+    "max_workers": 1,
+    "max_queue": 8,
+    "retry_after": 1,
+}
+
+class PoolFullError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Too many requests for voice {name}, try again in {retry_after} second(s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Per-voice worker pool, used to run blocking synthesis outside of the asyncio event loop.
+# At most max_workers jobs run at the same time, and at most max_queue jobs are waiting for a worker.
+# Jobs beyond that are rejected with a PoolFullError, so that the server can respond with 503 instead of piling up work.
+# initializer (optional) is called in each worker thread when it starts, e.g., to apply the voice's thread settings.
+class VoicePool:
+
+    def __init__(self, name, max_workers=defaults["max_workers"], max_queue=defaults["max_queue"], retry_after=defaults["retry_after"], initializer=None):
+        if max_workers < 1:
+            raise ValueError(f"Invalid max_workers for voice {name}: {max_workers} (expected >= 1)")
+        if max_queue < 0:
+            raise ValueError(f"Invalid max_queue for voice {name}: {max_queue} (expected >= 0)")
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"voice-{name}", initializer=initializer)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        log.debug(f"Created worker pool for voice {name} with max_workers={max_workers}, max_queue={max_queue}")
+
+    def admit(self):
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolFullError(self.name, self.retry_after)
+            self.pending += 1
+
+    def release(self, *_):
+        with self.lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        self.admit()
+        try:
+            future = self.executor.submit(functools.partial(fn, *args, **kwargs))
+        except Exception:
+            self.release()
+            raise
+        # the slot is released when the job is actually done, even if the awaiting request was cancelled
+        future.add_done_callback(self.release)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    # Iterate a blocking generator in the pool, one item at a time.
+    # The stream holds one slot from admission (i.e., before the first item is produced) until it is exhausted or closed,
+    # or until it is garbage collected, e.g., if the response is dropped before it is iterated.
+    def stream(self, gen):
+        self.admit()
+        return PoolStream(self, gen)
+
+    def as_json(self):
+        with self.lock:
+            pending = self.pending
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": min(pending, self.max_workers),
+            "queued": max(0, pending - self.max_workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Async iterator returned by VoicePool.stream. The generator's slot in the pool is released exactly once.
+class PoolStream:
+
+    def __init__(self, pool, gen):
+        self.pool = pool
+        self.gen = gen
+        self.released = False
+        self.first = []
+        self.iterator = self._iterate()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.pool.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.first) > 0:
+            return self.first.pop()
+        return await self.iterator.__anext__()
+
+    # Produces the first item, which is kept for iteration. Used to raise errors (e.g., a voice that can't be loaded)
+    # before a response is started, instead of sending an empty response. Returns False if the stream is empty.
+    async def start(self):
+        try:
+            self.first = [await self.iterator.__anext__()]
+        except StopAsyncIteration:
+            return False
+        return True
+
+    async def aclose(self):
+        await self.iterator.aclose()
+        # the iterator doesn't run its finally block if it was never started
+        if not self.released:
+            self.release()
+            self.gen.close()
+
+    def __del__(self):
+        if not self.released:
+            self.release()
+            self.gen.close()
+
+    async def _iterate(self):
+        done = object()
+        future = None
+        try:
+            while True:
+                future = self.pool.executor.submit(next, self.gen, done)
+                item = await asyncio.wrap_future(future)
+                if item is done:
+                    break
+                yield item
+        finally:
+            self.release()
+            if future is None or future.done():
+                self.gen.close()
+            else:
+                # the client went away while an item was being produced
+                future.add_done_callback(lambda _: self.gen.close())
+
+
+def create_pool(name, global_opts, voice_opts, initializer=None):
+    opts = dict(defaults)
+    opts.update(global_opts or {})
+    opts.update(voice_opts or {})
+    opts.pop("_comment", None)
+    return VoicePool(name, initializer=initializer, **opts)
@@ -1,4 +1,4 @@
-import torch
+import numpy as np
 
 import os
 import sys
@@ -6,9 +6,10 @@ parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
 from common import log
 
-# Constants
-HOP_LENGTH = 256            # Typically 256 in most models
-SAMPLE_RATE = 22050         # Depends on your setup
+# Defaults, used if the hop length and sample rate can't be read from the voice's vocoder config
+DEFAULT_HOP_LENGTH = 256
+DEFAULT_SAMPLE_RATE = 22050
+DEFAULT_FRAME_SECONDS = DEFAULT_HOP_LENGTH / DEFAULT_SAMPLE_RATE
 
 word_boundary = ' '
 pause = ','
@@ -27,61 +28,111 @@ def combine(tokens, aligned):
         return tokens
 
 
-def align(input_processed, output, id2symbol):
-    #"attn": torch.Tensor, shape: (batch_size, max_text_length, max_mel_length),
-    #Alignment map between text and mel spectrogram
+def to_numpy(t):
+    if hasattr(t, "detach"):
+        return t.detach().cpu().numpy()
+    return np.asarray(t)
 
-    #alignment_phonemes = input_processed['x'][0]
 
-    attn = output["attn"][0][0]  # shape: (max_text_length, max_mel_length)
-    #mel_len = output["mel_lengths"][0].item()
-    x = input_processed['x']
-    phoneme_ids = x[0]     # shape: (max_text_length,)
+# First and last mel frame aligned to each phoneme, computed for all phonemes at once.
+# attn has shape (..., text_length, mel_length). Phonemes without frames get n_frames = 0.
+def phoneme_frames(attn):
+    aligned = attn > 0
+    n_frames = aligned.sum(axis=-1)
+    start_frames = aligned.argmax(axis=-1)
+    end_frames = aligned.shape[-1] - 1 - aligned[..., ::-1].argmax(axis=-1)
+    return start_frames, end_frames, n_frames
 
+
+# First and last mel frame of each phoneme, computed from the predicted durations (in frames, shape (..., text_length)).
+# This gives the same frames as the attention map, which the model derives from the same durations:
+# phoneme i covers the frames f with cumsum(durations)[i-1] <= f < cumsum(durations)[i], up to the mel length.
+def duration_frames(durations, mel_lengths):
+    cum = np.cumsum(durations, axis=-1)
+    ends = np.ceil(cum).astype(np.int64)
+    starts = np.concatenate([np.zeros_like(ends[..., :1]), ends[..., :-1]], axis=-1)
+    ends = np.minimum(ends, np.asarray(mel_lengths).reshape(-1, 1))
+    n_frames = np.maximum(ends - starts, 0)
+    return starts, ends - 1, n_frames
+
+
+# Groups aligned phonemes into words, split on word boundaries and pauses
+def group_words(phoneme_ids, start_times, end_times, id2symbol):
     acc_word = {
         'phonemes': "",
         'start_time': None,
         'end_time': None,
     }
     res = []
-    for phoneme_idx in range(attn.shape[0]):
-        mel_indices = torch.where(attn[phoneme_idx] > 0)[0]  # frames aligned to this phoneme
-
-        if len(mel_indices) > 0:
-            start_frame = mel_indices[0].item()
-            end_frame = mel_indices[-1].item()
-
-            start_time = start_frame * HOP_LENGTH / SAMPLE_RATE
-            end_time = (end_frame + 1) * HOP_LENGTH / SAMPLE_RATE  # +1 for inclusive range
-
-            pid = phoneme_ids[phoneme_idx].item()
-            phoneme = id2symbol.get(pid, '?')
-
-            #log.debug(f"alignment debug {pid} {phoneme} {start_time} {end_time}")
-
-            if acc_word['start_time'] is None:
-                acc_word['start_time'] = start_time
-
-            if phoneme == pause and len(acc_word['phonemes']) > 0:
-                res.append(acc_word)
-                acc_word = {
-                    'phonemes': phoneme,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                }
-            elif phoneme == word_boundary:
-                acc_word['end_time'] = end_time
-                res.append(acc_word)
-                acc_word = {
-                    'phonemes': "",
-                    'start_time': None,
-                    'end_time': None,
-                }
-            else:
-                if phoneme != '_':
-                    acc_word['phonemes'] += phoneme
-                acc_word['end_time'] = end_time
+    for pid, start_time, end_time in zip(phoneme_ids, start_times, end_times):
+        phoneme = id2symbol.get(pid, '?')
+
+        if acc_word['start_time'] is None:
+            acc_word['start_time'] = start_time
+
+        if phoneme == pause and len(acc_word['phonemes']) > 0:
+            res.append(acc_word)
+            acc_word = {
+                'phonemes': phoneme,
+                'start_time': start_time,
+                'end_time': end_time,
+            }
+        elif phoneme == word_boundary:
+            acc_word['end_time'] = end_time
+            res.append(acc_word)
+            acc_word = {
+                'phonemes': "",
+                'start_time': None,
+                'end_time': None,
+            }
+        else:
+            if phoneme != '_':
+                acc_word['phonemes'] += phoneme
+            acc_word['end_time'] = end_time
 
     if len(acc_word) > 0:
         res.append(acc_word)
     return res
+
+
+# Word alignment for a batch of utterances, from per-phoneme frames (see phoneme_frames and duration_frames).
+#   x: phoneme ids, shape (batch_size, max_text_length)
+#   x_lengths: shape (batch_size,)
+# Returns a list of aligned words for each utterance.
+#   frame_seconds: duration of a mel frame in seconds (hop length / sample rate)
+def align_frames(x, x_lengths, start_frames, end_frames, n_frames, id2symbol, frame_seconds=DEFAULT_FRAME_SECONDS):
+    x = to_numpy(x)
+    start_times = start_frames * frame_seconds
+    end_times = (end_frames + 1) * frame_seconds  # +1 for inclusive range
+    res = []
+    for i in range(x.shape[0]):
+        # phonemes with aligned frames
+        keep = np.flatnonzero(n_frames[i, :int(x_lengths[i])] > 0)
+        res.append(group_words(x[i, keep].tolist(), start_times[i, keep].tolist(), end_times[i, keep].tolist(), id2symbol))
+    return res
+
+
+# Word alignment from the attention map.
+#   attn: alignment map between text and mel spectrogram, shape (batch_size, 1, max_text_length, max_mel_length)
+def align_batch(x, x_lengths, attn, id2symbol, frame_seconds=DEFAULT_FRAME_SECONDS):
+    attn = to_numpy(attn)[:, 0]
+    return align_frames(x, to_numpy(x_lengths), *phoneme_frames(attn), id2symbol, frame_seconds)
+
+
+# Word alignment from the predicted durations.
+#   durations: phoneme durations in frames, shape (batch_size, max_text_length)
+#   mel_lengths: shape (batch_size,)
+def align_batch_durations(x, x_lengths, durations, mel_lengths, id2symbol, frame_seconds=DEFAULT_FRAME_SECONDS):
+    return align_frames(x, to_numpy(x_lengths), *duration_frames(to_numpy(durations), to_numpy(mel_lengths)), id2symbol, frame_seconds)
+
+
+# Word alignment for a single utterance. Uses the predicted durations if the output has them, else the attention map.
+def align(input_processed, output, id2symbol, frame_seconds=DEFAULT_FRAME_SECONDS):
+    x = input_processed['x'][:1]
+    if "durations" in output:
+        durations = output["durations"][:1]
+        x_lengths = [min(x.shape[-1], durations.shape[-1])]
+        return align_batch_durations(x, x_lengths, durations, output["mel_lengths"][:1], id2symbol, frame_seconds)[0]
+    attn = output["attn"][:1]
+    x_lengths = [min(x.shape[-1], attn.shape[-2])]
+    return align_batch(x, x_lengths, attn, id2symbol, frame_seconds)[0]
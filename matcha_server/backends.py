@@ -0,0 +1,191 @@
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import log
+
+# Inference backends for Matcha voices.
+# Both backends take and return NumPy arrays, so that the rest of the server doesn't depend on torch:
+#   synthesise(x, x_lengths, spks, ...) => {"mel", "mel_lengths", "durations"} (and "attn" if requested, or if the model has no durations)
+#   to_waveform(mel, denoiser_strength) => waveforms, shape (batch_size, samples)
+#   audio_config() => (sample rate, hop length), None for values that aren't known by the backend
+
+backend_types = ["torch", "onnx"]
+
+
+# PyTorch checkpoints, loaded with matcha.cli (requires torch and matcha-tts)
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model_path, vocoder_path, device, threads=None, quantize=False):
+        from matcha.cli import load_matcha, load_vocoder
+        # torch thread counts are process wide, and only set in the global threads section (same for all torch voices)
+        if threads is not None and threads.intra_op_threads is not None:
+            import torch
+            torch.set_num_threads(threads.intra_op_threads)
+        if threads is not None and threads.inter_op_threads is not None:
+            set_torch_interop_threads(threads.inter_op_threads)
+        self.device = device
+        self.model = load_matcha(model_path, Path(model_path), device)
+        self.vocoder, self.denoiser = load_vocoder(os.path.basename(vocoder_path), vocoder_path, device)
+        patches = matcha_patches(self.model)
+        self.returns_durations = patches["durations"]
+        self.batched_trim_silence = patches["batched_trim_silence"]
+        if quantize:
+            import torch
+            # dynamic quantization only covers linear layers (text encoder and decoder transformer blocks).
+            # HiFi-GAN is convolutional and stays in fp32; use the onnx backend to quantize the vocoder.
+            torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            log.info(f"Quantized linear layers of {model_path} to int8")
+
+    def audio_config(self):
+        # HiFi-GAN keeps its config in vocoder.h
+        h = getattr(self.vocoder, "h", None)
+        return getattr(h, "sampling_rate", None), getattr(h, "hop_size", None)
+
+    def synthesise(self, x, x_lengths, spks, n_timesteps, temperature, length_scale, trim_silence, keep_attn=False):
+        import torch
+        #with torch.no_grad():
+        with torch.inference_mode():
+            output = self.model.synthesise(
+                torch.from_numpy(x).to(self.device),
+                torch.from_numpy(x_lengths).to(self.device),
+                n_timesteps=n_timesteps,
+                temperature=temperature,
+                spks=torch.from_numpy(spks).to(self.device) if spks is not None else None,
+                length_scale=length_scale,
+                trim_silence=trim_silence
+            )
+        res = {
+            "mel": output["mel"].cpu().numpy(),
+            "mel_lengths": output["mel_lengths"].cpu().numpy(),
+        }
+        if "durations" in output:
+            res["durations"] = output["durations"].cpu().numpy()
+        if keep_attn or "durations" not in output:
+            res["attn"] = output["attn"].cpu().numpy()
+        return res
+
+    def to_waveform(self, mel, denoiser_strength):
+        import torch
+        from matcha.cli import to_waveform
+        #with torch.no_grad():
+        with torch.inference_mode():
+            waveform = to_waveform(torch.from_numpy(mel).to(self.device), self.vocoder, self.denoiser, denoiser_strength)
+        return waveform.numpy().reshape(mel.shape[0], -1)
+
+
+# ONNX graphs exported with onnx_export.py, run with onnxruntime (torch is not needed).
+# The number of ODE steps and silence trimming are fixed at export time, and the vocoder runs without denoiser.
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_path, vocoder_path, threads=None, quantize=False):
+        import onnxruntime
+        if quantize:
+            model_path = quantized_onnx(model_path)
+            vocoder_path = quantized_onnx(vocoder_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            threads.session_options(options)
+        providers = ["CPUExecutionProvider"]
+        self.model = onnxruntime.InferenceSession(model_path, sess_options=options, providers=providers)
+        self.vocoder = onnxruntime.InferenceSession(vocoder_path, sess_options=options, providers=providers)
+        self.model_inputs = [i.name for i in self.model.get_inputs()]
+        self.model_outputs = [o.name for o in self.model.get_outputs()]
+        self.metadata = self.model.get_modelmeta().custom_metadata_map | self.vocoder.get_modelmeta().custom_metadata_map
+        if "durations" not in self.model_outputs:
+            raise Exception(f"ONNX model {model_path} has no durations output. Export it with onnx_export.py from a patched Matcha-TTS (see patch.sh)")
+        self.returns_durations = True
+        # silence trimming is part of the exported graph, which is exported from a patched Matcha-TTS
+        self.batched_trim_silence = True
+
+    def audio_config(self):
+        sample_rate = self.metadata.get("sample_rate")
+        hop_length = self.metadata.get("hop_length")
+        return (int(sample_rate) if sample_rate is not None else None,
+                int(hop_length) if hop_length is not None else None)
+
+    def synthesise(self, x, x_lengths, spks, n_timesteps, temperature, length_scale, trim_silence, keep_attn=False):
+        if "n_timesteps" in self.metadata and int(self.metadata["n_timesteps"]) != n_timesteps:
+            log.warning(f"ONNX model was exported with {self.metadata['n_timesteps']} steps, ignoring steps={n_timesteps}")
+        if "trim_silence" in self.metadata and (self.metadata["trim_silence"] == "True") != bool(trim_silence):
+            log.warning(f"ONNX model was exported with trim_silence={self.metadata['trim_silence']}, ignoring trim_silence={trim_silence}")
+        inputs = {
+            "x": x.astype(np.int64),
+            "x_lengths": x_lengths.astype(np.int64),
+            "scales": np.array([temperature, length_scale], dtype=np.float32),
+        }
+        if "spks" in self.model_inputs:
+            inputs["spks"] = (spks if spks is not None else np.zeros(x.shape[0])).astype(np.int64)
+        outputs = self.model.run(None, inputs)
+        return dict(zip(self.model_outputs, outputs))
+
+    def to_waveform(self, mel, denoiser_strength):
+        waveform = self.vocoder.run(None, {"mel": mel.astype(np.float32)})[0]
+        return waveform.reshape(mel.shape[0], -1)
+
+
+# Features added to Matcha-TTS by patch.sh, found in the source of the model's module:
+#   durations: synthesise returns the phoneme durations
+#   batched_trim_silence: trim_silence trims the last real symbol of each utterance in a padded batch (x_lengths - 1),
+#     instead of the last position, which is padding for all but the longest utterance
+# The Matcha-TTS fork installed with install_from_stts_fork.sh isn't patched by patch.sh.
+def matcha_patches(model):
+    import inspect
+    try:
+        src = inspect.getsource(inspect.getmodule(type(model)))
+    except (OSError, TypeError):
+        src = ""
+    return {
+        "durations": '"durations"' in src,
+        "batched_trim_silence": "x_lengths.long() - 1" in src,
+    }
+
+
+# torch has one inter-op thread pool per process, which can only be sized before it is first used.
+# If it's already in use, a warning is logged.
+def set_torch_interop_threads(n):
+    import torch
+    if torch.get_num_interop_threads() == n:
+        return
+    try:
+        torch.set_num_interop_threads(n)
+        log.info(f"Set torch inter-op threads to {n}")
+    except RuntimeError:
+        log.warning(f"Couldn't set torch inter-op threads to {n}, already set to {torch.get_num_interop_threads()} for this process")
+
+
+# Returns the path of an int8 version of an ONNX graph: a pre-quantized <name>.int8.onnx next to the original
+# (see onnx_export.py --quantize), or one created with dynamic quantization in the temp folder.
+def quantized_onnx(path):
+    if path.endswith(".int8.onnx"):
+        return path
+    name = f"{Path(path).stem}.int8.onnx"
+    prequantized = os.path.join(os.path.dirname(path), name)
+    if os.path.isfile(prequantized):
+        return prequantized
+    import tempfile
+    output = os.path.join(tempfile.gettempdir(), "matcha_quantized", name)
+    if not os.path.isfile(output) or os.path.getmtime(output) < os.path.getmtime(path):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        quantize_onnx(path, output)
+    return output
+
+def quantize_onnx(path, output):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    import onnx
+    log.info(f"Quantizing {path} to int8...")
+    quantize_dynamic(path, output, weight_type=QuantType.QInt8)
+    # keep the metadata written by onnx_export.py (steps, sample rate, etc)
+    metadata = onnx.load(path, load_external_data=False).metadata_props
+    quantized = onnx.load(output)
+    existing = {p.key for p in quantized.metadata_props}
+    quantized.metadata_props.extend([p for p in metadata if p.key not in existing])
+    onnx.save(quantized, output)
+    log.info(f"    ... saved {output}")
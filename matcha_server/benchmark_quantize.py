@@ -0,0 +1,127 @@
+import sys
+import os
+import argparse
+import copy
+import gc
+import json
+import time
+
+import numpy as np
+
+# imports from this repo
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import log
+import config
+import tools
+
+# Logging
+log.configure("matcha", log.default_handler, "info")
+
+# Compares a Matcha voice with and without int8 quantization (the voice's quantize setting):
+# load memory (RSS increase), synthesis speed (acoustic model + vocoder, as real time factor) and quality, as
+# log spectral distance (dB) and mel spectrogram distance between fp32 and int8 audio for the same input.
+# Temperature is set to 0 to make synthesis deterministic, so that differences are caused by quantization only.
+
+### EXAMPLE COMMANDS
+
+# python benchmark_quantize.py --config_file config_sample.json --voice en_us_ljspeech
+
+# python benchmark_quantize.py --config_file config_sample.json --voice en_us_ljspeech --input-file sentences.txt --runs 10
+
+
+default_inputs = [
+    "This is a short sentence.",
+    "The quick brown fox jumps over the lazy dog, and then it runs back into the forest.",
+    "Speech synthesis on CPU only nodes should be fast, small and still sound natural, even for long paragraphs of text.",
+]
+
+parser = argparse.ArgumentParser(
+    prog='benchmark_quantize',
+    description='Benchmark int8 quantization of a Matcha voice against fp32',
+    epilog=''
+)
+parser.add_argument('--config_file', required=True)
+parser.add_argument('--voice', required=True)
+parser.add_argument('--input-file', help="Input sentences, one per line (default: a few built-in English sentences)")
+parser.add_argument('-i', '--input-type', default="text")
+parser.add_argument('--runs', default=5, type=int, help="Number of timed runs per input (default: 5)")
+
+
+def rss():
+    import psutil
+    return psutil.Process().memory_info().rss
+
+# Log spectral distance in dB between two waveforms (truncated to the shortest one)
+def log_spectral_distance(wav1, wav2, n_fft=1024, hop=256):
+    n = min(len(wav1), len(wav2))
+    window = np.hanning(n_fft)
+    def power(wav):
+        frames = [wav[i:i+n_fft] * window for i in range(0, n - n_fft + 1, hop)]
+        return np.abs(np.fft.rfft(np.array(frames), axis=-1)) ** 2 + 1e-10
+    p1, p2 = power(wav1[:n]), power(wav2[:n])
+    return float(np.mean(np.sqrt(np.mean((10 * np.log10(p1 / p2)) ** 2, axis=-1))))
+
+# Mean absolute difference between two log mel spectrograms (truncated to the shortest one)
+def mel_distance(mel1, mel2):
+    n = min(mel1.shape[-1], mel2.shape[-1])
+    return float(np.mean(np.abs(mel1[..., :n] - mel2[..., :n])))
+
+def run(voice, model_paths, inputs, input_type, runs):
+    rss_before = rss()
+    start_time = time.time()
+    voice.load(model_paths)
+    load_time = time.time() - start_time
+    load_rss = rss() - rss_before
+    voice.temperature = 0.0
+    spk_id = voice.speaker
+    processed = [voice.process_tokens(None, words) for words in voice.process_token_lists([tools.input2tokens(input, input_type) for input in inputs])]
+    outputs = [voice.infer([p], spk_id, voice.speaking_rate)[0] for p in processed] # also warm-up
+    times = []
+    for _ in range(runs):
+        for p in processed:
+            start_time = time.time()
+            voice.infer([p], spk_id, voice.speaking_rate)
+            times.append(time.time() - start_time)
+    audio_seconds = sum(o["waveform"].shape[-1] for o in outputs) / voice.sample_rate
+    return {
+        "load_seconds": load_time,
+        "load_rss_mb": load_rss / 1024 / 1024,
+        "synthesis_seconds": sum(times) / runs,
+        "audio_seconds": audio_seconds,
+        "rtf": sum(times) / runs / audio_seconds,
+    }, outputs
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    inputs = default_inputs
+    if args.input_file:
+        with open(args.input_file, "r", encoding="utf-8") as f:
+            inputs = [l.strip() for l in f if l.strip() != ""]
+    global_cfg = config.load_config(args.config_file)
+    if args.voice not in global_cfg.voices:
+        raise KeyError(f"Couldn't find a voice named '{args.voice}' in config file {args.config_file}")
+    base = global_cfg.voices[args.voice]
+
+    # synthesis runs in this thread, with the same thread settings as the voice's worker threads in the server
+    base.threads.apply()
+    results = {}
+    outputs = {}
+    for name, quantize in [("fp32", False), ("int8", True)]:
+        v = copy.copy(base)
+        v.quantize = quantize
+        log.info(f"Running {name} benchmark for voice {args.voice} ({v.backend_type} backend)")
+        results[name], outputs[name] = run(v, global_cfg.model_paths, inputs, args.input_type, args.runs)
+        # release the models before the next run, so that memory use is measured from the same baseline
+        v.backend = None
+        gc.collect()
+
+    results["speedup"] = results["fp32"]["synthesis_seconds"] / results["int8"]["synthesis_seconds"]
+    results["memory_saved_mb"] = results["fp32"]["load_rss_mb"] - results["int8"]["load_rss_mb"]
+    results["quality"] = {
+        "log_spectral_distance_db": float(np.mean([log_spectral_distance(o1["waveform"], o2["waveform"]) for o1, o2 in zip(outputs["fp32"], outputs["int8"])])),
+        "mel_distance": float(np.mean([mel_distance(o1["mel"], o2["mel"]) for o1, o2 in zip(outputs["fp32"], outputs["int8"])])),
+        "length_difference_frames": int(sum(abs(o1["mel"].shape[-1] - o2["mel"].shape[-1]) for o1, o2 in zip(outputs["fp32"], outputs["int8"]))),
+    }
+    print(json.dumps(results, indent=4))
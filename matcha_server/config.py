@@ -7,7 +7,7 @@ import tools
 import voice
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
-from common import log
+from common import log, cache, workers, batching, threads, residency
 
 defaults = {
     "steps": 10,
@@ -20,7 +20,12 @@ class MatchaConfig:
     voices: dict
     model_paths: list
     output_path: str
+    save_output: bool
     force_cpu: bool
+    cache: object
+    residency: object
+    startup_voices: list
+    warmup: dict
 
 
 def load_from_args(args):
@@ -65,6 +70,7 @@ def load_config(config_file):
         else:
             log.configure("matcha", log.default_handler, log.default_level)
 
+        memLogger = None
         if data.get("log_memory_usage",False):
             memLogger = log.MemoryLogger()
             memLogger.start()
@@ -72,8 +78,23 @@ def load_config(config_file):
         result = MatchaConfig()
         result.model_paths = list(map(tools.create_path, data['model_paths']))
         result.output_path = tools.create_path(data['output_path'], create=True)
+        result.save_output = data.get('save_output', True)
         result.force_cpu = data.get('force_cpu', False)
         result.voices = {}
+        # voices with load_on_startup are loaded in the background when the server starts (see common/warmup.py)
+        result.startup_voices = []
+        result.warmup = data.get('warmup')
+        result.cache = None
+        if "cache" in data:
+            result.cache = cache.create_synthesis_cache(data["cache"], result.output_path)
+
+        result.residency = residency.create_manager(result.model_paths, data.get('residency'))
+        if result.residency.max_rss is not None:
+            # max_rss is checked on each sample of the memory logger
+            if memLogger is None:
+                memLogger = log.MemoryLogger()
+                memLogger.start()
+            memLogger.listeners.append(result.residency.check_rss)
 
         if data.get('clear_audio_on_startup', False):
             tools.clear_audio(result.output_path)
@@ -101,7 +122,18 @@ def load_config(config_file):
                             symbols=symbols,
                             trim_silence=voice_config.get('trim_silence',False),
                             phonemizers=[],
-                            selected_phonemizer_index=0)
+                            selected_phonemizer_index=0,
+                            batch_size=voice_config.get('batch_size',1),
+                            pipeline_sentences=voice_config.get('pipeline_sentences',False),
+                            alignment_mode=voice_config.get('alignment','durations'),
+                            backend_type=voice_config.get('backend','torch'),
+                            quantize=voice_config.get('quantize',False))
+            if voice_config.get('cache', True):
+                v.cache = result.cache
+            v.threads = threads.create_settings(name, data.get('threads'), voice_config.get('threads'), process_wide_counts=v.backend_type == "torch")
+            v.pool = workers.create_pool(name, data.get('workers'), voice_config.get('workers'), initializer=v.threads.apply)
+            if 'batching' in voice_config:
+                v.batcher = batching.create_batcher(name, lambda key, items, v=v: v.infer(items, *key, batch_size=len(items)), voice_config['batching'], initializer=v.threads.apply)
             result.voices[name] = v
             if not voice_config.get('enabled', True):
                 log.debug(f"Skipping voice {name} (not enabled)")
@@ -110,6 +142,6 @@ def load_config(config_file):
             if not voice_config.get('load_on_startup', True):
                 log.debug(f"Not loading voice {name} on startup")
                 continue
-            v.load(result.model_paths)
+            result.startup_voices.append(name)
 
     return result
@@ -157,5 +157,5 @@ log.debug(f"Selected phonemizer: {voice.selected_phonemizer()}")
 
 voice.validate()
 
-result = voice.synthesize(args.input, args.input_type, args.output_file, args)
+result, _ = voice.synthesize(args.input, args.input_type, args.output_file, args)
 print(f"[+] Final output {result}")
@@ -1,22 +1,24 @@
 # For usage info, se README.md
 
 import os, sys
+import asyncio
 
 from argparse import Namespace
 import json
 
 # Imports from this repo
 import config
+from voice import phonemizer_backends
 
 scriptdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(scriptdir)
 sys.path.insert(0, parentdir)
-from common import release, log
+from common import release, log, workers, threads, warmup
 
 # Other imports
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel # data models for post requests
 from dotenv import load_dotenv
@@ -24,10 +26,59 @@ from dotenv import load_dotenv
 load_dotenv()
 
 input_types = ['text','phonemes','mixed']
-return_types = ['json','wav']
+return_types = ['json','wav','stream']
 
 global_cfg = None
 
+def synthesize_job(voice, inputs, input_type, params, return_type):
+    # the voice is loaded if needed, and can't be unloaded by the residency manager while in use
+    with global_cfg.residency.use(voice):
+        # json responses refer to the audio file, so it has to be saved even if save_output is disabled
+        return voice.synthesize_all(inputs, input_type, global_cfg.output_path, params,
+                                    save_output=global_cfg.save_output,
+                                    save_audio=global_cfg.save_output or return_type == 'json')
+
+def stream_job(voice, inputs, input_type, params):
+    with global_cfg.residency.use(voice):
+        for event in voice.synthesize_stream(inputs, input_type, params):
+            yield (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+async def stream_response(voice, inputs, input_type, params):
+    try:
+        lines = voice.pool.stream(stream_job(voice, inputs, input_type, params))
+    except workers.PoolFullError as e:
+        raise busy_error(e)
+    # the voice is loaded and the first chunk is produced before the response is started, so that errors get a status code
+    try:
+        started = await lines.start()
+    except Exception as e:
+        log.error(f"Couldn't synthesize stream for voice {voice.name}: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error, see server log for details")
+    if not started:
+        msg = f"Voice {voice.name} is not loaded"
+        log.error(msg)
+        raise HTTPException(status_code=503, detail=msg)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+# Dummy synthesis after loading a voice on startup, to initialize the ONNX/torch graphs before the first request.
+# The output is neither saved nor cached. The input text can be set with warmup_text in the voice config.
+def warm_up_job(voice):
+    text = voice.config.get('warmup_text', "test") if voice.config else "test"
+    params = Namespace(speaking_rate=None, speaker=None)
+    voice.synthesize(text, "text", os.path.join(global_cfg.output_path, f"warmup_{voice.name}"), params, save_output=False, save_audio=False)
+
+# Loads a voice (if needed) in a separate thread, so that the event loop isn't blocked.
+# Concurrent requests for a voice that isn't loaded wait for the same load.
+async def load_voice(v):
+    await asyncio.to_thread(global_cfg.residency.load, v)
+
+def busy_error(e: workers.PoolFullError):
+    log.warning(f"{e}")
+    return HTTPException(status_code=503, detail=f"{e}", headers={"Retry-After": f"{e.retry_after}"})
+
+def wav_response(result, wav):
+    return Response(content=wav, media_type="audio/wav", headers={"Content-Disposition": f'attachment; filename="{result["audio"]}"'})
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global global_cfg, vInfo
@@ -56,7 +107,19 @@ async def lifespan(app: FastAPI):
     app.mount("/static", StaticFiles(directory=global_cfg.output_path), name="static")
     # ->  http://127.0.0.1:8000/static/FILENAME.wav    
 
+    # voices with load_on_startup are loaded in the background, see /ready and /health
+    global_cfg.warmup = warmup.create_warmup(global_cfg.voices, global_cfg.residency, warm_up_job, global_cfg.warmup)
+    global_cfg.warmup.start(global_cfg.startup_voices)
+
     yield
+    global_cfg.warmup.shutdown()
+    for v in global_cfg.voices.values():
+        if v.batcher is not None:
+            v.batcher.shutdown()
+        if v.pool is not None:
+            v.pool.shutdown()
+        if v.vocoder_pool is not None:
+            v.vocoder_pool.shutdown(wait=False, cancel_futures=True)
 
 app = FastAPI(lifespan=lifespan,swagger_ui_parameters={"tryItOutEnabled": True})
 
@@ -107,7 +170,7 @@ async def load(voice: str):
             if v.loaded:
                 return f"Voice {v.name} is already loaded"
             else:
-                v.load(global_cfg.model_paths)
+                await load_voice(v)
                 return f"Loaded voice {v.name}"
     return f"No such voice: {v.name}"
 
@@ -121,7 +184,7 @@ async def load_all():
         if v.loaded:
             res["already_loaded"].append(v.name)
         else:
-            v.load(global_cfg.model_paths)
+            await load_voice(v)
             res["loaded"].append(v.name)
     return res
 
@@ -189,12 +252,16 @@ async def synthesize_as_post(request: SynthRequest):
     )
     if not voice.loaded:
         try:
-            voice.load(global_cfg.model_paths)
+            await load_voice(voice)
         except Exception as e:
             log.error(f"Matcha error: {e}")
             raise HTTPException(status_code=500, detail=f"Couldn't load voice {request.voice}, see server log for details")
+    if request.return_type == 'stream':
+        return await stream_response(voice, request.input, request.input_type, params)
     try:
-        res = voice.synthesize_all(request.input, request.input_type, global_cfg.output_path, params)
+        res, wavs = await voice.pool.run(synthesize_job, voice, request.input, request.input_type, params, request.return_type)
+    except workers.PoolFullError as e:
+        raise busy_error(e)
     except RuntimeError as e:
         log.error(f"Matcha error: {e}")
         raise HTTPException(status_code=500, detail="Couldn't synthesize for voice {request.voice}, see server log for details")
@@ -208,9 +275,7 @@ async def synthesize_as_post(request: SynthRequest):
             return res
     elif request.return_type == 'wav':
         if len(res) == 1:
-            f = res[0]['audio']
-            full_path = os.path.join(global_cfg.output_path, f)
-            return FileResponse(full_path, filename=os.path.basename(f), media_type="audio/wav")
+            return wav_response(res[0], wavs[0])
         else:
             msg = f"Cannot use return type {request.return_type} for multiple output objects. Try json instead."
             log.error(msg)
@@ -259,12 +324,16 @@ async def synthesize_as_get(voice: str = 'sv_se_nst_female1',
     v = global_cfg.voices[voice]
     if not v.loaded:
         try:
-            v.load(global_cfg.model_paths)
+            await load_voice(v)
         except Exception as e:
             log.error(f"Matcha error: {e}")
             raise HTTPException(status_code=500, detail=f"Couldn't load voice {voice}, see server log for details")
+    if return_type == 'stream':
+        return await stream_response(v, inputs, input_type, params)
     try:
-        res = v.synthesize_all(inputs, input_type, global_cfg.output_path, params)
+        res, wavs = await v.pool.run(synthesize_job, v, inputs, input_type, params, return_type)
+    except workers.PoolFullError as e:
+        raise busy_error(e)
     except RuntimeError as e:
         log.error(f"Matcha error: {e}")
         raise HTTPException(status_code=500, detail=f"Couldn't synthesize for voice {voice}, see server log for details")
@@ -275,9 +344,7 @@ async def synthesize_as_get(voice: str = 'sv_se_nst_female1',
         return res
     elif return_type == 'wav':
         if len(res) == 1:
-            f = res[0]['audio']
-            full_path = os.path.join(global_cfg.output_path, f)
-            return FileResponse(full_path, filename=os.path.basename(f), media_type="audio/wav")
+            return wav_response(res[0], wavs[0])
         else:
             msg = f"Cannot use return type {return_type} for multiple output objects. Try json instead."
             log.error(msg)
@@ -287,6 +354,37 @@ async def synthesize_as_get(voice: str = 'sv_se_nst_female1',
         log.error(msg)
         raise HTTPException(status_code=400, detail=msg)
 
+@app.get("/cache")
+async def cache_stats():
+    if global_cfg.cache is None:
+        return {"enabled": False}
+    return {"enabled": True} | global_cfg.cache.stats()
+
+# Loaded voices (least recently used first), load/unload counters, and phonemizer backends shared by the loaded voices
+@app.get("/residency")
+async def residency_stats():
+    return global_cfg.residency.as_json() | {"phonemizers": phonemizer_backends.as_json()}
+
+# Thread settings of the voices (unset values use the library defaults), and of the server process
+@app.get("/threads")
+async def thread_settings():
+    return {
+        "process": threads.process_info(),
+        "voices": {name: v.threads.as_json() for name, v in global_cfg.voices.items()},
+    }
+
+# 200 when at least one voice is loaded and warmed up (or no voices are loaded on startup), 503 while voices are loading
+@app.get("/ready")
+async def ready():
+    if not global_cfg.warmup.ready():
+        raise HTTPException(status_code=503, detail="No voice is ready yet", headers={"Retry-After": "1"})
+    return {"ready": True}
+
+# State of each voice: ready, pending, loading, warming_up, failed, not_loaded or disabled
+@app.get("/health")
+async def health():
+    return global_cfg.warmup.health()
+
 @app.get("/ping")
 async def ping():
     return HTMLResponse(content="matcha", media_type="text")
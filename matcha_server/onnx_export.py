@@ -0,0 +1,160 @@
+import sys
+import os
+import argparse
+from pathlib import Path
+import torch
+
+# imports from this repo
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import log
+import config
+import tools
+
+# Logging
+log.configure("matcha", log.default_handler, log.default_level)
+
+# Exports the acoustic model and the vocoder of a Matcha voice to ONNX, for use with "backend": "onnx" in the config file.
+# Requires torch, onnx and a Matcha-TTS installation patched with patch.sh (the acoustic model graph outputs phoneme durations for alignment).
+
+### EXAMPLE COMMANDS
+
+# python onnx_export.py --config_file config_sample.json --voice en_us_ljspeech -o ~/.local/share/matcha_tts
+
+# python onnx_export.py -m ~/.local/share/matcha_tts/matcha_ljspeech.ckpt -v ~/.local/share/matcha_tts/hifigan_T2_v1 -o ~/.local/share/matcha_tts --steps 10
+
+
+parser = argparse.ArgumentParser(
+    prog='onnx_export',
+    description='Export Matcha acoustic model and vocoder to ONNX',
+    epilog=''
+)
+parser.add_argument('--config_file')
+parser.add_argument('--voice')
+parser.add_argument('-m', '--model', help="Path to voice model (.ckpt)")
+parser.add_argument('-v', '--vocoder', help="Path to vocoder (usually no extension)")
+parser.add_argument('--steps', default=None, type=int, help=f"number of ODE steps, fixed in the exported graph (default: from voice config, or {config.defaults['steps']})")
+parser.add_argument('--trim-silence', action='store_true', default=None, help="Trim leading and trailing silences (fixed in the exported graph)")
+parser.add_argument('--opset', default=15, type=int, help="ONNX opset version (default: 15)")
+parser.add_argument('--quantize', action='store_true', help="Also save int8 versions of the graphs (<name>.int8.onnx), used by voices with quantize set to true")
+parser.add_argument('-o', '--output-folder', required=True)
+
+
+# Acoustic model graph: synthesise with fixed n_timesteps and trim_silence.
+# Inputs: x, x_lengths, scales (temperature, length scale) and spks (multi speaker models only)
+class AcousticModel(torch.nn.Module):
+    def __init__(self, model, n_timesteps, trim_silence):
+        super().__init__()
+        self.model = model
+        self.n_timesteps = n_timesteps
+        self.trim_silence = trim_silence
+
+    def forward(self, x, x_lengths, scales, spks=None):
+        output = self.model.synthesise(x, x_lengths, n_timesteps=self.n_timesteps, temperature=scales[0], spks=spks, length_scale=scales[1], trim_silence=self.trim_silence)
+        if "durations" not in output:
+            raise Exception("Matcha model doesn't return durations, run patch.sh before exporting")
+        return output["mel"], output["mel_lengths"], output["durations"]
+
+
+# Vocoder graph: mel => waveform (without denoiser)
+class Vocoder(torch.nn.Module):
+    def __init__(self, vocoder):
+        super().__init__()
+        self.vocoder = vocoder
+
+    def forward(self, mel):
+        return self.vocoder(mel).clamp(-1, 1).squeeze(1)
+
+
+def add_metadata(onnx_file, metadata):
+    import onnx
+    model = onnx.load(onnx_file)
+    for k, v in metadata.items():
+        prop = model.metadata_props.add()
+        prop.key = k
+        prop.value = str(v)
+    onnx.save(model, onnx_file)
+
+
+def export(model_path, vocoder_path, output_folder, n_timesteps, trim_silence, opset):
+    from matcha.cli import load_matcha, load_vocoder
+    model = load_matcha(model_path, Path(model_path), "cpu")
+    vocoder, _ = load_vocoder(os.path.basename(vocoder_path), vocoder_path, "cpu")
+    h = getattr(vocoder, "h", None)
+    audio_metadata = {}
+    if h is not None:
+        audio_metadata = {"sample_rate": h.sampling_rate, "hop_length": h.hop_size}
+
+    # acoustic model
+    model_file = os.path.join(output_folder, f"{Path(model_path).stem}.onnx")
+    x = torch.randint(low=1, high=model.n_vocab, size=(2, 50), dtype=torch.long)
+    x_lengths = torch.tensor([50, 40], dtype=torch.long)
+    scales = torch.tensor([0.667, 1.0], dtype=torch.float32)
+    inputs = [x, x_lengths, scales]
+    input_names = ["x", "x_lengths", "scales"]
+    dynamic_axes = {
+        "x": {0: "batch_size", 1: "time"},
+        "x_lengths": {0: "batch_size"},
+        "mel": {0: "batch_size", 2: "time"},
+        "mel_lengths": {0: "batch_size"},
+        "durations": {0: "batch_size", 1: "time"},
+    }
+    if model.n_spks > 1:
+        inputs.append(torch.tensor([0, 0], dtype=torch.long))
+        input_names.append("spks")
+        dynamic_axes["spks"] = {0: "batch_size"}
+    log.info(f"Exporting acoustic model {model_path} with {n_timesteps} steps, trim_silence={trim_silence}...")
+    torch.onnx.export(AcousticModel(model, n_timesteps, trim_silence), tuple(inputs), model_file,
+                      input_names=input_names,
+                      output_names=["mel", "mel_lengths", "durations"],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset,
+                      do_constant_folding=True)
+    add_metadata(model_file, {"n_timesteps": n_timesteps, "trim_silence": bool(trim_silence)} | audio_metadata)
+    log.info(f"    ... saved {model_file}")
+
+    # vocoder
+    vocoder_file = os.path.join(output_folder, f"{Path(vocoder_path).name}.onnx")
+    mel = torch.randn(2, model.n_feats, 100)
+    log.info(f"Exporting vocoder {vocoder_path}...")
+    torch.onnx.export(Vocoder(vocoder), (mel,), vocoder_file,
+                      input_names=["mel"],
+                      output_names=["wav"],
+                      dynamic_axes={"mel": {0: "batch_size", 2: "time"}, "wav": {0: "batch_size", 1: "time"}},
+                      opset_version=opset,
+                      do_constant_folding=True)
+    add_metadata(vocoder_file, audio_metadata)
+    log.info(f"    ... saved {vocoder_file}")
+    return model_file, vocoder_file
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    steps = args.steps
+    trim_silence = args.trim_silence
+    if args.config_file:
+        if args.voice is None:
+            parser.error("--config_file requires --voice")
+        global_cfg = config.load_config(args.config_file)
+        if args.voice not in global_cfg.voices:
+            raise KeyError(f"Couldn't find a voice named '{args.voice}' in config file {args.config_file}")
+        voice_config = global_cfg.voices[args.voice].config
+        model_path = tools.find_file(voice_config['model'], global_cfg.model_paths)
+        vocoder_path = tools.find_file(voice_config['vocoder'], global_cfg.model_paths)
+        if model_path is None or vocoder_path is None:
+            raise Exception(f"Couldn't find model and vocoder for voice {args.voice}. Looked in {global_cfg.model_paths}")
+        steps = tools.get_or_else(steps, voice_config.get('steps'), config.defaults['steps'])
+        trim_silence = tools.get_or_else(trim_silence, voice_config.get('trim_silence'), False)
+    else:
+        if args.model is None or args.vocoder is None:
+            parser.error("--model and --vocoder are required for use without config file")
+        model_path = args.model
+        vocoder_path = args.vocoder
+        steps = tools.get_or_else(steps, config.defaults['steps'])
+        trim_silence = tools.get_or_else(trim_silence, False)
+    os.makedirs(args.output_folder, exist_ok=True)
+    files = export(model_path, vocoder_path, args.output_folder, steps, trim_silence, args.opset)
+    if args.quantize:
+        import backends
+        for f in files:
+            backends.quantize_onnx(f, os.path.join(args.output_folder, f"{Path(f).stem}.int8.onnx"))
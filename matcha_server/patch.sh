@@ -5,6 +5,7 @@ sed -i 's/checkpoint = torch.load(checkpoint_path, map_location=device)/checkpoi
 if [ -e .venv/lib/python3.10/site-packages/matcha ] ; then
     sed -i 's/MatchaTTS.load_from_checkpoint(checkpoint_path, map_location=device)/MatchaTTS.load_from_checkpoint(checkpoint_path, map_location=device, weights_only=False)/' .venv/lib/python3.*/site-packages/matcha/cli.py
     sed -i 's|\(plot_spectrogram_to_numpy.*\) f"{filename}.png")|\1 folder / f"{filename}.png")|' .venv/lib/python3.*/site-packages/matcha/cli.py
-    sed -i 's/w_ceil = torch.ceil(w) \* length_scale/w_ceil = torch.ceil(w) * length_scale\n        log.debug("trim_silence set to %s" % trim_silence)\n        if trim_silence:\n            w_ceil[:, :, 0] = 0   # remove leading silence, patched by STTS\n            w_ceil[:, :, -1] = torch.clamp(w_ceil[:, :, -1], max=3)  # trim trailing silence, patched by STTS/' .venv/lib/python3.*/site-packages/matcha/models/matcha_tts.py
+    sed -i 's/w_ceil = torch.ceil(w) \* length_scale/w_ceil = torch.ceil(w) * length_scale\n        log.debug("trim_silence set to %s" % trim_silence)\n        if trim_silence:\n            w_ceil[:, :, 0] = 0   # remove leading silence, patched by STTS\n            last = torch.arange(w_ceil.shape[0]), x_lengths.long() - 1\n            w_ceil[last[0], :, last[1]] = torch.clamp(w_ceil[last[0], :, last[1]], max=3)  # trim trailing silence (last non-padded symbol), patched by STTS/' .venv/lib/python3.*/site-packages/matcha/models/matcha_tts.py
+    sed -i 's/"attn": attn\[:, :, :y_max_length\],/"attn": attn[:, :, :y_max_length],\n            "durations": w_ceil.squeeze(1),  # phoneme durations in frames, patched by STTS/' .venv/lib/python3.*/site-packages/matcha/models/matcha_tts.py
     sed -i 's/def synthesise(self, x, x_lengths, n_timesteps, temperature=1.0, spks=None, length_scale=1.0):/def synthesise(self, x, x_lengths, n_timesteps, temperature=1.0, spks=None, length_scale=1.0, trim_silence=False):/' .venv/lib/python3.*/site-packages/matcha/models/matcha_tts.py
 fi
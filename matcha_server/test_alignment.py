@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import alignment
+
+symbols = ["_", " ", ",", "a", "b"]
+id2symbol = {i: s for i, s in enumerate(symbols)}
+
+def hard_attn(durations, mel_length):
+    attn = np.zeros((len(durations), mel_length))
+    frame = 0
+    for i, d in enumerate(durations):
+        attn[i, frame:frame+d] = 1
+        frame += d
+    return attn
+
+def seconds(frames):
+    return frames * alignment.DEFAULT_FRAME_SECONDS
+
+class TestAlignment:
+
+    def test_phoneme_frames(self):
+        attn = hard_attn([2, 0, 3], 6)
+        start, end, n = alignment.phoneme_frames(attn)
+        assert n.tolist() == [2, 0, 3]
+        assert start[[0, 2]].tolist() == [0, 2]
+        assert end[[0, 2]].tolist() == [1, 4]
+
+    def test_align_words(self):
+        # a b _ a | space | b
+        x = np.array([[3, 4, 0, 3, 1, 4]])
+        attn = hard_attn([1, 2, 1, 1, 1, 2], 8)
+        res = alignment.align({"x": x}, {"attn": attn[None, None]}, id2symbol)
+        assert res == [
+            {"phonemes": "aba", "start_time": seconds(0), "end_time": seconds(6)},
+            {"phonemes": "b", "start_time": seconds(6), "end_time": seconds(8)},
+        ]
+
+    def test_align_batch_ignores_padding(self):
+        x = np.array([[3, 1, 4], [4, 0, 0]])
+        attn = np.zeros((2, 1, 3, 4))
+        attn[0, 0] = hard_attn([1, 1, 2], 4)
+        attn[1, 0, :1, :2] = hard_attn([2], 2)
+        res = alignment.align_batch(x, [3, 1], attn, id2symbol)
+        assert [w["phonemes"] for w in res[0]] == ["a", "b"]
+        assert res[1] == [{"phonemes": "b", "start_time": seconds(0), "end_time": seconds(2)}]
+
+    def test_durations_match_attn(self):
+        x = np.array([[3, 4, 0, 3, 1, 4]])
+        durations = np.array([[1, 2, 1, 0, 1, 2]]) * 0.85
+        mel_length = int(np.ceil(durations.sum()))
+        starts = np.ceil(np.concatenate([[0], np.cumsum(durations)[:-1]])).astype(int)
+        ends = np.ceil(np.cumsum(durations)).astype(int)
+        attn = np.zeros((6, mel_length))
+        for i in range(6):
+            attn[i, starts[i]:ends[i]] = 1
+        from_attn = alignment.align({"x": x}, {"attn": attn[None, None]}, id2symbol)
+        from_durations = alignment.align({"x": x}, {"durations": durations, "mel_lengths": np.array([mel_length])}, id2symbol)
+        assert from_durations == from_attn
+
+    def test_frame_seconds(self):
+        x = np.array([[3, 1, 4]])
+        attn = hard_attn([1, 1, 2], 4)
+        res = alignment.align({"x": x}, {"attn": attn[None, None]}, id2symbol, frame_seconds=0.01)
+        assert [(w["start_time"], w["end_time"]) for w in res] == [(0.0, 0.02), (0.02, 0.04)]
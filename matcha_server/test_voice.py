@@ -0,0 +1,31 @@
+import pytest
+import numpy as np
+
+import sys, os
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import batching
+import voice
+
+symbols = "_ ,.ab"
+
+def create_voice(**kwargs):
+    return voice.Voice(name="test", enabled=True, config=None, model=None, vocoder=None, steps=1, temperature=0.667,
+                       denoiser_strength=0.0, device="cpu", speaking_rate=1.0, speaker=None, symbols=symbols,
+                       trim_silence=False, phonemizers=[], selected_phonemizer_index=0, **kwargs)
+
+class TestVoice:
+
+    def test_pipelined_sentences_use_batcher(self):
+        v = create_voice(pipeline_sentences=True)
+        batches = []
+        def run_batch(key, items):
+            batches.append((key, len(items)))
+            return [{"mel": np.zeros((1, 80, 4)), "waveform": np.zeros(4 * v.hop_length)} for _ in items]
+        v.batcher = batching.MicroBatcher("test", run_batch, max_batch_size=8, max_wait_ms=0)
+        words = [{"orth": "a.", "phonemes": "a."}, {"orth": "b.", "phonemes": "b."}]
+        # no backend is loaded, so the acoustic model can't be run outside of the batcher
+        sentences = list(v.synthesize_sentences(words, None, 1.0))
+        assert [tokens["x_phones"] for tokens, _ in sentences] == ["_a_._", "_b_._"]
+        assert batches == [((None, 1.0), 1), ((None, 1.0), 1)]
+        v.batcher.shutdown()
@@ -3,6 +3,7 @@ import os
 import re
 import json
 from pathlib import Path
+import threading
 import logging
 import shutil
 
@@ -47,6 +48,64 @@ def get_or_else(value1, value2, default=None):
         return value2
     return default
 
+# Inserts item between and around the elements of lst (same as matcha.utils.utils.intersperse)
+def intersperse(lst, item):
+    result = [item] * (len(lst) * 2 + 1)
+    result[1::2] = lst
+    return result
+
+# Saves mel (npy), spectrogram (png) and wav files for an utterance, like matcha.cli.save_to_folder but without torch.
+# The spectrogram is skipped if matplotlib isn't installed.
+def save_to_folder(filename, mel, wav, folder):
+    import numpy as np
+    folder = Path(folder)
+    folder.mkdir(exist_ok=True, parents=True)
+    try:
+        from matplotlib.figure import Figure
+        # the object oriented API is used (not pyplot), since syntheses may run in parallel threads
+        fig = Figure(figsize=(12, 3))
+        ax = fig.subplots()
+        im = ax.imshow(mel.squeeze(), aspect="auto", origin="lower", interpolation="none")
+        fig.colorbar(im, ax=ax)
+        ax.set_xlabel("Frames")
+        ax.set_ylabel("Channels")
+        ax.set_title("Synthesised Mel-Spectrogram")
+        fig.savefig(folder / f"{filename}.png")
+    except ImportError:
+        log.debug("matplotlib is not installed, spectrogram will not be saved")
+    np.save(folder / f"{filename}", mel)
+    wav_file = folder / f"{filename}.wav"
+    with open(wav_file, "wb") as f:
+        f.write(wav)
+    return wav_file.resolve()
+
+# Encodes a waveform as an in-memory wav file, in the same format as matcha.cli.save_to_folder
+def wav_bytes(waveform, sample_rate):
+    import io
+    import soundfile as sf
+    buf = io.BytesIO()
+    sf.write(buf, waveform, sample_rate, "PCM_24", format="WAV")
+    return buf.getvalue()
+
+# Encodes a waveform as raw 16-bit little endian PCM
+def pcm16_bytes(waveform):
+    import numpy as np
+    return (np.clip(waveform, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+# Saves output files for a result fetched from the synthesis cache (png and label files are not recreated)
+def save_cached_result(result, wav, output_file, save_output, save_audio):
+    wav_file = Path(output_file).with_suffix('.wav')
+    if save_audio:
+        with open(wav_file, "wb") as f:
+            f.write(wav)
+    if save_output:
+        with open(wav_file.with_suffix('.json'), 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+# latest.* are written by concurrent requests (one worker pool per voice), so they are updated under a lock,
+# to keep them from being mixed from different requests
+latest_lock = threading.Lock()
+
 def copy_to_latest(result,output_folder):
     basename = Path(result["audio"]).with_suffix("")
 
@@ -56,17 +115,18 @@ def copy_to_latest(result,output_folder):
 
     latest_json = result.copy()
     latest_json['audio'] = "latest.wav"
-    with open(os.path.join(output_folder, "latest.json"), 'w', encoding="utf-8") as f:
-        json.dump(latest_json, f, ensure_ascii=False, indent=4)
-
-    output_files = {
-        wav_file: os.path.join(output_folder, "latest.wav"),
-        png_file: os.path.join(output_folder, "latest.png"),
-        lab_file: os.path.join(output_folder, "latest.lab")
-    }
-    for source, dest in output_files.items():
-        if os.path.isfile(source):
-            shutil.copy(source, dest)
+    with latest_lock:
+        with open(os.path.join(output_folder, "latest.json"), 'w', encoding="utf-8") as f:
+            json.dump(latest_json, f, ensure_ascii=False, indent=4)
+
+        output_files = {
+            wav_file: os.path.join(output_folder, "latest.wav"),
+            png_file: os.path.join(output_folder, "latest.png"),
+            lab_file: os.path.join(output_folder, "latest.lab")
+        }
+        for source, dest in output_files.items():
+            if os.path.isfile(source):
+                shutil.copy(source, dest)
 
 phoneme_input_re = re.compile("\\[\\[(.*)\\]\\]")
 separate_comma_re = re.compile("(^|[^\\[]) *, *($|[^\\]])")
@@ -92,3 +152,17 @@ def input2tokens(input_string, input_type):
         for w in wordsplit.split(s):
             tokens.append({"orth": w})
     return tokens
+
+sentence_end_re = re.compile("[.!?]+$")
+# Splits a list of words (tokens) into sentences, after each word ending with sentence final punctuation
+def split_sentences(words):
+    res = []
+    sentence = []
+    for w in words:
+        sentence.append(w)
+        if sentence_end_re.search(w.get("orth", w.get("phonemes", ""))):
+            res.append(sentence)
+            sentence = []
+    if len(sentence) > 0:
+        res.append(sentence)
+    return res
@@ -3,19 +3,23 @@ import os
 #import re
 from pathlib import Path
 import json
+import queue
+import threading
+from concurrent.futures import Future
 
 # Imports from this repo
 import tools
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
-from common import log
+from common import log, cache, threads, registry
 
 log.configure("matcha","python","debug")
-log.debug("Starting Matcha imports...")
-from matcha.utils.utils import intersperse
-from matcha.cli import to_waveform, save_to_folder, load_matcha, load_vocoder
-import torch
-log.debug("    ... Matcha imports completed")
+import numpy as np
+import alignment
+import backends
+
+# Lowest value of the log mel spectrogram (log(1e-5)), used to pad mels with silence
+MEL_PAD_VALUE = -11.5129
 
 from dataclasses import dataclass, asdict
 @dataclass
@@ -39,6 +43,11 @@ class Voice:
     
     phonemizers: list
     selected_phonemizer_index: int
+    batch_size: int = 1
+    pipeline_sentences: bool = False
+    alignment_mode: str = "durations"
+    backend_type: str = "torch"
+    quantize: bool = False
 
 
     def __post_init__(self):
@@ -49,9 +58,15 @@ class Voice:
         self.id2symbol = {i: s for i, s in enumerate(self.symbols)}
 
         self.loaded = False
-        self.matcha_model = None
-        self.matcha_vocoder = None
-        self.matcha_denoiser = None
+        self.backend = None
+        self.cache = None
+        self.pool = None
+        self.batcher = None
+        self.batch_inference = True
+        self.vocoder_pool = None
+        self.threads = threads.ThreadSettings(self.name)
+        self.lock = threading.Lock()
+        self.set_audio_config(alignment.DEFAULT_SAMPLE_RATE, alignment.DEFAULT_HOP_LENGTH)
 
     def __str__(self):
         dict = asdict(self)
@@ -71,15 +86,28 @@ class Voice:
             "temperature": self.temperature,
             "denoiser_strength": self.denoiser_strength,
             "device": self.device,
+            "backend": self.backend_type,
+            "quantize": self.quantize,
 
             "speaking_rate": self.speaking_rate,
             "speaker": self.speaker,
             "symbols": "".join(self.symbols),
             "trim_silence": self.trim_silence,
+            "batch_size": self.batch_size,
+            "batch_inference": self.batch_inference,
+            "pipeline_sentences": self.pipeline_sentences,
+            "alignment_mode": self.alignment_mode,
+            "sample_rate": self.sample_rate,
+            "hop_length": self.hop_length,
+            "threads": self.threads.as_json(),
 
             "phonemizers": list(map(lambda p: p.as_json(), self.phonemizers)),
             "selected_phonemizer": phner
         }
+        if self.pool is not None:
+            obj["workers"] = self.pool.as_json()
+        if self.batcher is not None:
+            obj["batching"] = self.batcher.as_json()
         return obj
 
     def load(self, model_paths):
@@ -89,42 +117,96 @@ class Voice:
 
         # load phonemizer(s)
         phonemizers = []
-        defaultPhnIndex = 0
-        for i, phizer in enumerate(self.config['phonemizers']):
-            if phizer.get('enabled', True):
-                if phizer.get('default', False):
-                    defaultPhnIndex = i
-                if phizer['type'] == "deep_phonemizer":
-                    model_path = tools.find_file(phizer['model'], model_paths)
-                    if model_path is None:
-                        raise Exception(f"Couldn't find model {phizer['model']} for {phizer['name']}. Looked in {model_paths}")
-                    phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], model_path))
-                elif phizer['type'] == "espeak":
-                    phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang']))
+        try:
+            defaultPhnIndex = 0
+            for i, phizer in enumerate(self.config['phonemizers']):
+                if phizer.get('enabled', True):
+                    if phizer.get('default', False):
+                        defaultPhnIndex = i
+                    cache_size = phizer.get('cache_size', 10000)
+                    if phizer['type'] == "deep_phonemizer":
+                        model_path = tools.find_file(phizer['model'], model_paths)
+                        if model_path is None:
+                            raise Exception(f"Couldn't find model {phizer['model']} for {phizer['name']}. Looked in {model_paths}")
+                        phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], model_path, cache_size=cache_size))
+                    elif phizer['type'] == "espeak":
+                        phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], cache_size=cache_size))
+                    else:
+                        raise Exception(f"Unknown phonemizer type {type} for {phizer['name']}")
+                    if 'prewarm' in phizer:
+                        prewarm_file = tools.find_file(phizer['prewarm'], model_paths)
+                        if prewarm_file is None:
+                            log.warning(f"Couldn't find prewarm word list {phizer['prewarm']} for {phizer['name']}. Looked in {model_paths}")
+                        else:
+                            phonemizers[-1].prewarm(prewarm_file, phizer.get('prewarm_limit', None))
+
+            if len(phonemizers) == 0:
+                raise Exception(f"Couldn't find phonemizer for voice '{self.config['name']}'")
+
+            # load voice stuff
+            # for the onnx backend, onnx_model and onnx_vocoder are graphs exported with onnx_export.py
+            model_key, vocoder_key = ('onnx_model', 'onnx_vocoder') if self.backend_type == "onnx" else ('model', 'vocoder')
+            self.model=tools.find_file(self.config[model_key], model_paths)
+            if self.model is None:
+                raise Exception(f"Couldn't find model {self.config[model_key]} for voice {self.name}. Looked in {model_paths}")
+            self.vocoder=tools.find_file(self.config[vocoder_key], model_paths)
+            if self.vocoder is None:
+                raise Exception(f"Couldn't find vocoder {self.config[vocoder_key]} for voice {self.name}. Looked in {model_paths}")
+            log.debug(f"Loading {self.backend_type} backend for voice {self.name} with threads {self.threads.as_json()}...")
+            # threads created by the libraries while loading inherit the voice's cpu_affinity
+            with self.threads.pinned():
+                if self.backend_type == "onnx":
+                    self.backend = backends.OnnxBackend(self.model, self.vocoder, threads=self.threads, quantize=self.quantize)
                 else:
-                    raise Exception(f"Unknown phonemizer type {type} for {phizer['name']}")
-
-        if len(phonemizers) == 0:
-            raise Exception(f"Couldn't find phonemizer for voice '{self.config['name']}'")
-
+                    self.backend = backends.TorchBackend(self.model, self.vocoder, self.device, threads=self.threads, quantize=self.quantize)
+            log.debug(f"    ... loaded {self.backend_type} backend for voice {self.name}")
+            self.load_audio_config()
+            if self.alignment_mode == "durations" and not self.backend.returns_durations:
+                log.warning(f"Matcha model for voice {self.name} doesn't return durations (see patch.sh), using attention map for alignment")
+                self.alignment_mode = "attn"
+            # with an unpatched Matcha-TTS, trim_silence trims the last position of each utterance in a padded batch,
+            # which changes the audio of all but the longest utterance, so utterances are run one at a time
+            self.batch_inference = not self.trim_silence or self.backend.batched_trim_silence
+            if not self.batch_inference and (self.batch_size > 1 or self.batcher is not None):
+                log.warning(f"Matcha model for voice {self.name} doesn't support trim_silence in padded batches (see patch.sh), batching is turned off for this voice")
+        except Exception:
+            # the new phonemizers are shared, so they are released if the voice can't be loaded
+            for p in phonemizers:
+                p.release()
+            raise
+
+        for p in self.phonemizers:
+            p.release()
         self.phonemizers=phonemizers
         self.selected_phonemizer_index=defaultPhnIndex
-
-        # load voice stuff
-        self.model=tools.find_file(self.config['model'], model_paths)
-        if self.model is None:
-            raise Exception(f"Couldn't find model {self.config['model']} for voice {self.name}. Looked in {model_paths}")
-        self.vocoder=tools.find_file(self.config['vocoder'], model_paths)
-        if self.vocoder is None:
-            raise Exception(f"Couldn't find vocoder {self.config['vocoder']} for voice {self.name}. Looked in {model_paths}")
-        checkpoint_path = Path(self.model)
-        vocoder_name = os.path.basename(self.vocoder) # equals self.config['vocoder'] ?
-        self.matcha_model = load_matcha(self.model, checkpoint_path, self.device)
-        self.matcha_vocoder, self.matcha_denoiser = load_vocoder(vocoder_name, self.vocoder, self.device)
-
         self.loaded=True
         log.debug(f"Loaded voice {json.dumps(self.as_json(), indent=4)}")
 
+    # Releases the models and phonemizers, the voice is loaded again on the next request
+    def unload(self):
+        self.loaded = False
+        for p in self.phonemizers:
+            p.release()
+        self.backend = None
+        self.phonemizers = []
+        self.selected_phonemizer_index = 0
+        log.debug(f"Unloaded voice {self.name}")
+
+
+    # Reads sample rate and hop length from the vocoder config (HiFi-GAN keeps it in vocoder.h, ONNX graphs in their metadata).
+    # Values in the voice config take precedence, for vocoders without a config.
+    def load_audio_config(self):
+        vocoder_sample_rate, vocoder_hop_length = self.backend.audio_config()
+        sample_rate = tools.get_or_else(self.config.get('sample_rate') if self.config else None, vocoder_sample_rate, alignment.DEFAULT_SAMPLE_RATE)
+        hop_length = tools.get_or_else(self.config.get('hop_length') if self.config else None, vocoder_hop_length, alignment.DEFAULT_HOP_LENGTH)
+        self.set_audio_config(int(sample_rate), int(hop_length))
+        log.debug(f"Voice {self.name} has sample rate {self.sample_rate} and hop length {self.hop_length}")
+
+    def set_audio_config(self, sample_rate, hop_length):
+        self.sample_rate = sample_rate
+        self.hop_length = hop_length
+        # duration of a mel frame, used for all frame to time conversions
+        self.frame_seconds = hop_length / sample_rate
 
     def validate(self, fail_on_error = True):
         if self.speaking_rate < -1.0 or self.speaking_rate > 5.0:
@@ -133,6 +215,24 @@ class Voice:
                 raise Exception(msg)
             else:
                 log.error(msg)
+        if self.backend_type not in backends.backend_types:
+            msg = f"Invalid backend: {self.backend_type} (expected one of {backends.backend_types})"
+            if fail_on_error:
+                raise Exception(msg)
+            else:
+                log.error(msg)
+        if self.backend_type == "onnx" and self.alignment_mode != "durations":
+            msg = f"Alignment mode {self.alignment_mode} is not supported by the onnx backend (use durations)"
+            if fail_on_error:
+                raise Exception(msg)
+            else:
+                log.error(msg)
+        if self.alignment_mode not in ["durations", "attn"]:
+            msg = f"Invalid alignment mode: {self.alignment_mode} (expected durations or attn)"
+            if fail_on_error:
+                raise Exception(msg)
+            else:
+                log.error(msg)
         if self.symbols == "":
             msg = f"No symbols defined for voice {self.name}"
             if fail_on_error:
@@ -172,121 +272,355 @@ class Voice:
         else:
             return None
 
-    def process_tokens(self, tokens: str):
-        words = []
-        phn_list = []
-
-        for t in tokens:
-            w = {}
-            log.debug(f"t in tokens: {t}")
-            if "orth" in t:
-                w["orth"] = t["orth"]
-            if "lang" in t:
-                w["lang"] = t["lang"]
-            if "g2p_method" in t:
-                w["g2p_method"] = t["g2p_method"]
-            if "phonemes" in t:
-                phn_list.append(t["phonemes"])
-                w["input"] =  t["phonemes"]
-                w["phonemes"] =  t["phonemes"]
-            else:
-                lang = w.get("lang", None)
-                phner = self.selected_phonemizer()
-                result = phner.phonemize(t["orth"], lang)
-                log.debug(f"phonemize result {result}")
-                phn_list.append(result)
-                w["input"] = t["orth"]
+    # Processes the tokens of one or more utterances into word lists.
+    # Words without phonemes are phonemized in a single batch for all utterances.
+    def process_token_lists(self, token_lists):
+        res = []
+        phner = self.selected_phonemizer()
+        to_phonemize = [] # (word, lang)
+        for tokens in token_lists:
+            words = []
+            for t in tokens:
+                w = {}
+                log.debug(f"t in tokens: {t}")
+                if "orth" in t:
+                    w["orth"] = t["orth"]
+                if "lang" in t:
+                    w["lang"] = t["lang"]
+                if "g2p_method" in t:
+                    w["g2p_method"] = t["g2p_method"]
+                if "phonemes" in t:
+                    w["input"] =  t["phonemes"]
+                    w["phonemes"] =  t["phonemes"]
+                else:
+                    w["input"] = t["orth"]
+                    w["phonemes"] = None # set below
+                    w["g2p_method"] = phner.tpe
+                    to_phonemize.append((w, w.get("lang", None)))
+                words.append(w)
+            res.append(words)
+        if len(to_phonemize) > 0:
+            results = phner.phonemize_batch([w["input"] for w, _ in to_phonemize], [lang for _, lang in to_phonemize])
+            log.debug(f"phonemize result {results}")
+            for (w, _), result in zip(to_phonemize, results):
                 w["phonemes"] = result
-                w["g2p_method"] = phner.tpe
-            words.append(w)
+        return res
+
+    def process_tokens(self, tokens: str, words=None):
+        if words is None:
+            words = self.process_token_lists([tokens])[0]
+        phn_list = [w["phonemes"] for w in words]
         phn = " ".join(phn_list)
         cleaned_text = self.cleaned_text_to_sequence(phn)
 
-        x = torch.tensor(
-            intersperse(cleaned_text, 0),
-            dtype=torch.long,
-            device=self.device,
-        )[None]
-        x_lengths = torch.tensor([x.shape[-1]], dtype=torch.long, device=self.device)
+        x = np.array(tools.intersperse(cleaned_text, 0), dtype=np.int64)[None]
+        x_lengths = np.array([x.shape[-1]], dtype=np.int64)
         x_phones = self.sequence_to_text(x.squeeze(0).tolist())
         return {"words": words, "x_orig": input, "x": x, "x_lengths": x_lengths, "x_phones": x_phones}
 
-    def synthesize_all(self, inputs, input_type, output_folder, params):
+    # Returns a list of result objects, and a list of in-memory wav files (one per input).
+    # Output files are only written to output_folder if save_audio (wav) and/or save_output (json, png, lab and latest.*) is set.
+    def synthesize_all(self, inputs, input_type, output_folder, params, save_output=True, save_audio=True):
         log.debug(f"voice.synthesize_all input {inputs}")
         import uuid
         uid = uuid.uuid4()
-        res = []
-        i = 0
         spk_id = tools.get_or_else(vars(params).get("speaker"), self.speaker)
-        for input in inputs:
-            i = i+1
+        output_files = []
+        for n in range(len(inputs)):
+            i = n+1
             base_name = f"utt_{uid}_{i:03d}_spk_{spk_id:03d}" if spk_id is not None else f"utt_{uid}_{i:03d}"
-            output_file = os.path.join(output_folder, base_name)
-            res.append(self.synthesize(input, input_type, output_file, params))
-        if len(res) > 0:
+            output_files.append(os.path.join(output_folder, base_name))
+        res = [None] * len(inputs)
+        wavs = [None] * len(inputs)
+        cache_keys = [self.cache_key(input, input_type, params) for input in inputs]
+        todo = []
+        for n, input in enumerate(inputs):
+            cached = self.cache.get(cache_keys[n]) if cache_keys[n] is not None else None
+            if cached is not None:
+                log.debug(f"voice.synthesize_all cache hit for input {input}")
+                result, wav = cached
+                result["audio"] = f"{Path(os.path.basename(output_files[n])).with_suffix('.wav')}"
+                tools.save_cached_result(result, wav, output_files[n], save_output, save_audio)
+                res[n], wavs[n] = result, wav
+            else:
+                todo.append(n)
+        # inputs not found in the cache are phonemized in a single phonemizer call, and synthesized in batches
+        if len(todo) > 0:
+            batch_res = self.synthesize_batch([inputs[n] for n in todo], input_type, [output_files[n] for n in todo], params,
+                                              save_output=save_output, save_audio=save_audio)
+            for n, (result, wav) in zip(todo, batch_res):
+                if cache_keys[n] is not None:
+                    self.cache.put(cache_keys[n], result, wav)
+                res[n], wavs[n] = result, wav
+        if len(res) > 0 and save_output:
             # copy the last output utterance to latest.{json,wav,...}
             tools.copy_to_latest(res[len(res)-1],output_folder)
-        return res
+        return res, wavs
 
-    def synthesize(self, input, input_type, output_file, params):
+    def cache_key(self, input, input_type, params):
+        if self.cache is None:
+            return None
+        phner = self.selected_phonemizer()
+        key_params = {
+            "speaking_rate": tools.get_or_else(vars(params).get("speaking_rate"), self.speaking_rate),
+            "steps": self.steps,
+            "temperature": self.temperature,
+            "speaker": tools.get_or_else(vars(params).get("speaker"), self.speaker),
+            "denoiser_strength": self.denoiser_strength,
+            "trim_silence": self.trim_silence,
+            "phonemizer": phner.name if phner is not None else None,
+        }
+        return cache.synthesis_key(self.name, input, input_type, key_params)
+
+    def synthesize(self, input, input_type, output_file, params, save_output=True, save_audio=True, words=None):
+        word_lists = [words] if words is not None else None
+        return self.synthesize_batch([input], input_type, [output_file], params, save_output, save_audio, word_lists)[0]
+
+    # Synthesizes a list of inputs, returning a list of (result, wav bytes).
+    # Inputs are run through the acoustic model and the vocoder in padded batches of at most batch_size utterances.
+    def synthesize_batch(self, inputs, input_type, output_files, params, save_output=True, save_audio=True, word_lists=None):
         import time
         outer_start_time = time.time()
-        input_tokens = tools.input2tokens(input, input_type)
+        log.debug(f"synthesize_batch input {inputs}")
+        if word_lists is None:
+            word_lists = self.process_token_lists([tools.input2tokens(input, input_type) for input in inputs])
+        processed = [self.process_tokens(None, words) for words in word_lists]
 
-        output_name = os.path.basename(output_file)
-        output_name = Path(output_name).with_suffix('')
-        output_folder = os.path.dirname(output_file)
+        spk_id = tools.get_or_else(vars(params).get("speaker"), self.speaker, None)
+        speaking_rate = tools.get_or_else(vars(params).get("speaking_rate"), self.speaking_rate)
+        log.info(f"matcha speaking rate {speaking_rate}")
 
-        ### SYNTHESIZE
-        log.debug(f"synthesize input {input}")
-        tokens_processed = self.process_tokens(input_tokens)
+        if len(inputs) == 1 and self.pipeline_sentences:
+            # a single (long) input is split into sentences, with the acoustic model and the vocoder run in parallel
+            sentences = [list(self.synthesize_sentences(word_lists[0], spk_id, speaking_rate))]
+        else:
+            if self.batcher is not None:
+                # share batches with concurrent requests using the same speaker and speaking rate
+                outputs = self.batcher.run((spk_id, speaking_rate), processed)
+            else:
+                outputs = self.infer(processed, spk_id, speaking_rate)
+            sentences = [[(p, o)] for p, o in zip(processed, outputs)]
 
-        spk_id = tools.get_or_else(vars(params).get("speaker"), self.speaker, None)
-        spk = torch.tensor([spk_id],device=self.device) if spk_id is not None else None
+        res = []
+        for n, input in enumerate(inputs):
+            result = self.create_result(input, input_type, output_files[n], sentences[n], spk_id, speaking_rate)
+            output = self.concat_outputs([o for _, o in sentences[n]])
+            wav_bytes = self.write_output(result, output, output_files[n], save_output, save_audio)
+            res.append((result, wav_bytes))
+        log.info("voice.py::synthesize - overall     - took %s seconds" % (time.time() - outer_start_time))
+        return res
 
+    # Synthesizes inputs sentence by sentence, yielding events to be streamed to the client:
+    # a start event with the audio format, then for each sentence an alignment event (token times offset to the
+    # start of the stream) followed by an audio event with base64 encoded 16-bit PCM, and finally an end event.
+    def synthesize_stream(self, inputs, input_type, params):
+        import base64
+        spk_id = tools.get_or_else(vars(params).get("speaker"), self.speaker, None)
         speaking_rate = tools.get_or_else(vars(params).get("speaking_rate"), self.speaking_rate)
-        log.info(f"matcha speaking rate {speaking_rate}")
+        yield {"type": "start", "sample_rate": self.sample_rate, "sample_width": 2, "channels": 1, "encoding": "pcm_s16le"}
+        word_lists = self.process_token_lists([tools.input2tokens(input, input_type) for input in inputs])
+        offset = 0.0
+        i = 0
+        for n, words in enumerate(word_lists):
+            for tokens_processed, output in self.synthesize_sentences(words, spk_id, speaking_rate):
+                duration = output["waveform"].shape[-1] / self.sample_rate
+                yield {
+                    "type": "alignment",
+                    "input_index": n,
+                    "sentence_index": i,
+                    "start_time": offset,
+                    "end_time": offset + duration,
+                    "tokens": self.align_tokens(tokens_processed, output, offset),
+                }
+                yield {
+                    "type": "audio",
+                    "sentence_index": i,
+                    "audio": base64.b64encode(tools.pcm16_bytes(output["waveform"])).decode("ascii"),
+                }
+                offset += duration
+                i += 1
+        yield {"type": "end", "duration": offset}
+
+    # Splits words into sentences and synthesizes them one at a time, yielding (tokens_processed, output) for each sentence.
+    # The acoustic model runs in a producer thread, and the vocoder in a separate thread, so that the vocoder renders
+    # sentence N while the acoustic model computes the mel for sentence N+1. Each sentence is yielded as soon as the
+    # vocoder is done with it, without waiting for the acoustic model to finish the next one.
+    # With batching, each sentence is run by the batcher instead, in the same batches as concurrent requests.
+    def synthesize_sentences(self, words, spk_id, speaking_rate):
+        results = queue.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                self.threads.apply()
+                for sentence in tools.split_sentences(words) or [words]:
+                    if stopped.is_set():
+                        break
+                    tokens_processed = self.process_tokens(None, sentence)
+                    if self.batcher is not None:
+                        # share batches with concurrent requests, the batcher runs the vocoder as well
+                        output = self.batcher.run((spk_id, speaking_rate), [tokens_processed])[0]
+                        future = Future()
+                        future.set_result(None)
+                    else:
+                        output = self.acoustic([tokens_processed], spk_id, speaking_rate)[0]
+                        future = self.vocoder_executor().submit(self.vocode, [output])
+                    results.put((tokens_processed, output, future))
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(None)
+
+        threading.Thread(target=produce, name=f"acoustic-{self.name}", daemon=True).start()
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                tokens_processed, output, future = item
+                future.result()
+                yield tokens_processed, output
+        finally:
+            # the consumer went away: stop after the current sentence, and skip vocoding the ones not returned
+            stopped.set()
+            while not results.empty():
+                item = results.get_nowait()
+                if isinstance(item, tuple):
+                    item[2].cancel()
+
+    def vocoder_executor(self):
+        with self.lock:
+            if self.vocoder_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.vocoder_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"vocoder-{self.name}", initializer=self.threads.apply)
+            return self.vocoder_pool
+
+    # Concatenates the outputs of consecutive sentences
+    def concat_outputs(self, outputs):
+        if len(outputs) == 1:
+            return outputs[0]
+        return {
+            "mel": np.concatenate([o["mel"] for o in outputs], axis=-1),
+            "waveform": np.concatenate([o["waveform"] for o in outputs], axis=-1),
+        }
+
+    # Runs the acoustic model and the vocoder on a list of processed inputs, in padded batches of at most batch_size inputs
+    def infer(self, processed, spk_id, speaking_rate, batch_size=None):
+        # sort by input length to minimize padding, and split into batches
+        order = sorted(range(len(processed)), key=lambda n: processed[n]["x_lengths"].item())
+        batch_size = max(1, batch_size or self.batch_size) if self.batch_inference else 1
+        outputs = [None] * len(processed)
+        for b in range(0, len(order), batch_size):
+            batch = order[b:b+batch_size]
+            batch_outputs = self.acoustic([processed[n] for n in batch], spk_id, speaking_rate)
+            self.vocode(batch_outputs)
+            for n, output in zip(batch, batch_outputs):
+                outputs[n] = output
+        return outputs
+
+    # Runs the acoustic model on a padded batch of processed inputs.
+    # Returns one output per input, with mel, mel_lengths and durations (or attn) trimmed to the input's own length.
+    def acoustic(self, processed, spk_id, speaking_rate):
+        import time
         matcha_start_time = time.time()
-        #with torch.no_grad():
-        with torch.inference_mode():        
-            output = self.matcha_model.synthesise(
-                tokens_processed["x"],
-                tokens_processed["x_lengths"],
-                n_timesteps=self.steps, # TODO: pass in runtime as with speaking_rate
-                temperature=self.temperature, # TODO: pass in runtime as with speaking_rate
-                spks=spk,
-                length_scale=speaking_rate,
-                trim_silence=self.trim_silence
-            )
-            log.info("voice.py::synthesize - matcha.synthesize - took %s seconds" % (time.time() - matcha_start_time))
+        x_lengths = np.concatenate([p["x_lengths"] for p in processed])
+        x = np.zeros((len(processed), int(x_lengths.max())), dtype=np.int64)
+        for i, p in enumerate(processed):
+            x[i, :p["x"].shape[-1]] = p["x"][0]
+        spk = np.array([spk_id]*len(processed), dtype=np.int64) if spk_id is not None else None
+        output = self.backend.synthesise(
+            x,
+            x_lengths,
+            spk,
+            n_timesteps=self.steps, # TODO: pass in runtime as with speaking_rate
+            temperature=self.temperature, # TODO: pass in runtime as with speaking_rate
+            length_scale=speaking_rate,
+            trim_silence=self.trim_silence,
+            keep_attn=self.alignment_mode == "attn"
+        )
+        log.info("voice.py::synthesize - matcha.synthesize - batch size %s - took %s seconds" % (len(processed), time.time() - matcha_start_time))
+        # the (text length x mel length) attention map is only kept if timings can't be derived from the durations
+        use_durations = self.alignment_mode == "durations" and "durations" in output
+        res = []
+        for i, p in enumerate(processed):
+            x_len = p["x"].shape[-1]
+            mel_len = int(output["mel_lengths"][i])
+            o = {
+                "mel": output["mel"][i:i+1, :, :mel_len],
+                "mel_lengths": output["mel_lengths"][i:i+1],
+            }
+            if use_durations:
+                o["durations"] = output["durations"][i:i+1, :x_len]
+            else:
+                o["attn"] = output["attn"][i:i+1, :, :x_len, :mel_len]
+            res.append(o)
+        return res
 
-            ## PROCESS ALIGNMENT
-            import alignment
-            tokens = tokens_processed['words']
+    # Runs the vocoder on a padded batch of acoustic model outputs, and adds the waveform to each output
+    def vocode(self, outputs):
+        import time
+        wav_start_time = time.time()
+        mel_lengths = [o["mel"].shape[-1] for o in outputs]
+        # pad with the lowest log mel value (silence)
+        mel = np.full((len(outputs), outputs[0]["mel"].shape[1], max(mel_lengths)), MEL_PAD_VALUE, dtype=outputs[0]["mel"].dtype)
+        for i, o in enumerate(outputs):
+            mel[i, :, :mel_lengths[i]] = o["mel"][0]
+        waveform = self.backend.to_waveform(mel, self.denoiser_strength)
+        for i, o in enumerate(outputs):
+            o["waveform"] = waveform[i, :mel_lengths[i] * self.hop_length]
+        log.info("voice.py::synthesize - to_waveform - batch size %s - took %s seconds" % (len(outputs), time.time() - wav_start_time))
+
+    # Aligns the tokens of one sentence, with times offset by the given number of seconds
+    def align_tokens(self, tokens_processed, output, offset=0.0):
+        aligned = alignment.align(tokens_processed, output, self.id2symbol, self.frame_seconds)
+        log.debug(f"ALIGNED {aligned}")
+        if offset > 0:
+            for a in aligned:
+                for k in ["start_time", "end_time"]:
+                    if a.get(k) is not None:
+                        a[k] += offset
+        return alignment.combine(tokens_processed['words'], aligned)
+
+    # Creates the result for an input synthesized as a list of (tokens_processed, output) sentences
+    def create_result(self, input, input_type, output_file, sentences, spk_id, speaking_rate):
+        ## PROCESS ALIGNMENT
+        tokens = []
+        offset = 0.0
+        for tokens_processed, output in sentences:
+            tokens += self.align_tokens(tokens_processed, output, offset)
+            offset += output["waveform"].shape[-1] / self.sample_rate
+
+        result = {
+            "input": input,
+            "input_type": input_type,
+            "speaking_rate": speaking_rate,
+            "speaker_id": spk_id,
+        }
+        phonemes = []
+        for token in tokens:
+            if "phonemes" in token:
+                phonemes.append(token["phonemes"])
+        if len(phonemes) > 0:
+            result["phonemes"]=" ".join(phonemes)
+        result["tokens"] = tokens
+        result["audio"] = f"{Path(os.path.basename(output_file)).with_suffix('.wav')}"
+        return result
 
-            aligned = alignment.align(tokens_processed, output, self.id2symbol)
-            log.debug(f"ALIGNED {aligned}")
+    # Saves output files, as configured, and returns the wav bytes
+    def write_output(self, result, output, output_file, save_output, save_audio):
+        import time
+        output_name = os.path.basename(output_file)
+        output_name = Path(output_name).with_suffix('')
+        output_folder = os.path.dirname(output_file)
 
-            tokens = alignment.combine(tokens, aligned)
+        wav_bytes = tools.wav_bytes(output["waveform"], self.sample_rate)
 
-            result = {
-                "input": input,
-                "input_type": input_type,
-                "speaking_rate": speaking_rate,
-                "speaker_id": spk_id,
-            }
-            phonemes = []
-            for token in tokens:
-                if "phonemes" in token:
-                    phonemes.append(token["phonemes"])
-            if len(phonemes) > 0:
-                result["phonemes"]=" ".join(phonemes)
-            result["tokens"] = tokens
-            result["audio"] = f"{Path(os.path.basename(output_file)).with_suffix('.wav')}"
-
-            ## SAVE OUTPUT
-            save_start_time = time.time()
+        ## SAVE OUTPUT
+        save_start_time = time.time()
 
+        if save_output:
             # json file
             json_output = Path(output_file).with_suffix('.json')
             with open(json_output, 'w', encoding='utf-8') as f:
@@ -294,71 +628,90 @@ class Voice:
                 log.debug(f"JSON output saved: {json_output}")
             log.info("voice.py::synthesize - save json - took %s seconds" % (time.time() - save_start_time))
 
-            ## alignment output for debugging
-            # alignment_output = Path(os.path.join(output_folder,f"{output_name}_alignment_debug")).with_suffix('.json')
-            # with open(alignment_output, 'w', encoding='utf-8') as f:
-            #     json.dump(aligned, f, ensure_ascii=False, indent=4)
-            #     log.debug(f"Alignment output saved: {alignment_output}")
-
-            # wav file
-            save_wav_start_time = time.time()
-            #with torch.no_grad():
-            with torch.inference_mode():            
-                output["waveform"] = to_waveform(output["mel"], self.matcha_vocoder, self.matcha_denoiser, self.denoiser_strength)
-                log.info("voice.py::synthesize - to_waveform - took %s seconds" % (time.time() - save_wav_start_time))
-
+            # wav, png and mel files
             save_wav_file_start_time = time.time()
-            location = save_to_folder(output_name, output, output_folder)
+            location = tools.save_to_folder(output_name, output["mel"], wav_bytes, output_folder)
             log.debug(f"Waveform saved: {location}")
             log.info("voice.py::synthesize - save wav - took %s seconds" % (time.time() - save_wav_file_start_time))
-            log.info("voice.py::synthesize - to_waveform+save_wav - took %s seconds" % (time.time() - save_wav_start_time))
 
-            if len(tokens) == len(aligned):
+            if all("start_time" in token for token in result['tokens']):
                 # label file
                 lab_file = os.path.join(output_folder, f"{output_name}.lab")
                 with open(lab_file, "w") as f:
                     for token in result['tokens']:
-                        f.write(f"{token['start_time']/1000.0}\t{token['end_time']/1000.0}\t{token['phonemes']}\n")
+                        f.write(f"{token['start_time']}\t{token['end_time']}\t{token['phonemes']}\n")
             else:
                 log.error(f"Different number of tokens vs aligned tokens -- label file will not be created")
+        elif save_audio:
+            wav_file = Path(output_file).with_suffix('.wav')
+            with open(wav_file, "wb") as f:
+                f.write(wav_bytes)
+            log.debug(f"Waveform saved: {wav_file}")
+
+        log.info("voice.py::synthesize - save output - took %s seconds" % (time.time() - save_start_time))
+        return wav_bytes
 
-            log.info("voice.py::synthesize - save output - took %s seconds" % (time.time() - save_start_time))
-            log.info("voice.py::synthesize - overall     - took %s seconds" % (time.time() - outer_start_time))
-            return result
+DP_BATCH_SIZE = 32
+
+# Phonemizer backends, shared by all voices in the process, keyed on (type, model path, lang)
+phonemizer_backends = registry.SharedRegistry("phonemizer")
 
 class Phonemizer:
     name: str
     tpe: str
     lang: str
     pher: object
-    def __init__(self, name, tpe, lang, path=None):
+    def __init__(self, name, tpe, lang, path=None, cache_size=10000):
         self.name = name
         self.tpe = tpe
         self.lang = lang
         self.path = path
+        self.cache = None
+        # the phonemizer backend is shared by all voices using the same type, model and language.
+        # phonemizer backends are not guaranteed to be thread safe, so calls are serialized with the shared lock.
+        self.shared = None
+        self.lock = threading.Lock()
         try:
-            if tpe == "deep_phonemizer":
-                from dp.phonemizer import Phonemizer
-                if path is None:
-                    raise Exception(f"Deep phonemizer {name} cannot be loaded without a model path. Found None")
-                if not os.path.isfile(self.path):
-                    raise Exception(f"Model path for deep phonemizer {name} does not exist: {path}")
-                self.pher = Phonemizer.from_checkpoint(path)
-            elif tpe == "espeak":
-                import phonemizer
-                self.pher = phonemizer.backend.EspeakBackend(
-                    language=lang,
-                    preserve_punctuation=True,
-                    with_stress=True,
-                    language_switch="remove-flags",
-                    logger=log.pylogger or None,
-                )
-            else:
-                raise Exception(f"Unknown phonemizer type {tpe} for {self.name}")
+            key = (tpe, os.path.realpath(path) if path is not None else None, lang)
+            self.shared = phonemizer_backends.acquire(key, self.load_backend)
+            self.pher = self.shared.value
+            self.lock = self.shared.lock
+            # word level cache, keyed on (lang, word). The cache is stored with the shared backend, so it is used by all
+            # voices with the same phonemizer, and kept when the voices are unloaded (the first voice sets its size).
+            if cache_size > 0:
+                with self.lock:
+                    self.cache = self.shared.data.setdefault("cache", cache.LRUCache(max_entries=cache_size))
         except RuntimeError as e:
             msg = f"Couldn't load phonetizer for voice {name}: {e}. Voice will not be loaded."
             log.error(msg)
 
+    def load_backend(self):
+        if self.tpe == "deep_phonemizer":
+            from dp.phonemizer import Phonemizer
+            if self.path is None:
+                raise Exception(f"Deep phonemizer {self.name} cannot be loaded without a model path. Found None")
+            if not os.path.isfile(self.path):
+                raise Exception(f"Model path for deep phonemizer {self.name} does not exist: {self.path}")
+            pher = Phonemizer.from_checkpoint(self.path)
+        elif self.tpe == "espeak":
+            import phonemizer
+            pher = phonemizer.backend.EspeakBackend(
+                language=self.lang,
+                preserve_punctuation=True,
+                with_stress=True,
+                language_switch="remove-flags",
+                logger=log.pylogger or None,
+            )
+        else:
+            raise Exception(f"Unknown phonemizer type {self.tpe} for {self.name}")
+        return pher
+
+    # Releases the shared phonemizer backend (dropped when no other voice uses it)
+    def release(self):
+        if self.shared is not None:
+            phonemizer_backends.release(self.shared)
+            self.shared = None
+            self.pher = None
 
     def as_json(self):
         obj = {
@@ -366,30 +719,87 @@ class Phonemizer:
             "type": self.tpe,
             "lang": self.lang,
             "path": self.path,
+            "shared_by": self.shared.refs if self.shared is not None else 0,
         }
+        if self.cache is not None:
+            obj["cache"] = self.cache.stats()
         return obj
 
-    def phonemize(self, input, lang=None):
+    # Fills the word cache from a word list (one word per line, most frequent first; additional tab separated fields are ignored)
+    def prewarm(self, word_list_file, limit=None):
+        if self.cache is None:
+            return
+        import time
+        start_time = time.time()
+        words = []
+        with open(word_list_file, "r", encoding="utf-8") as f:
+            for l in f:
+                w = l.split("\t")[0].strip()
+                if w == "":
+                    continue
+                words.append(w)
+                if limit is not None and len(words) >= limit:
+                    break
+        self.phonemize_batch(words)
+        log.info(f"Prewarmed phonemizer {self.name} with {len(words)} words from {word_list_file} in {time.time() - start_time:.2f} seconds")
+
+    def resolve_lang(self, lang):
+        if self.tpe != "deep_phonemizer" or lang is None:
+            return self.lang
+        if lang not in self.pher.predictor.text_tokenizer.languages:
+            log.info(f"Language {lang} is not supported by phonemizer. Using {self.lang} instead")
+            return self.lang
+        return lang
+
+    # special cases that are not sent to the phonemizer
+    def special_case(self, input):
         if input == "":
             return ""
         elif input in [",", ":"]: # experiment for pausing
             return "__"
         elif input in ["..",".","_","__", "#", "##", ",", ",,", "!", "!!"]: # experiment for pausing
             return input
-        elif self.tpe == "deep_phonemizer":
-            if lang is None:
-                lang = self.lang
-            else:
-                if lang not in self.pher.predictor.text_tokenizer.languages:
-                    log.info(f"Language {lang} is not supported by phonemizer. Using {self.lang} instead")
-                    lang = self.lang
-            return self.pher(input, lang).replace(" ","_")
-        else:
-            tmp = self.pher.phonemize([input], strip=True, njobs=1)
-            if len(tmp) > 0:
-                return tmp[0].replace(" ","_")
+        return None
+
+    def phonemize(self, input, lang=None):
+        return self.phonemize_batch([input], [lang])[0]
+
+    # Phonemizes a list of words, with one phonemizer call per language for all words not found in the cache.
+    # langs is an optional list of language overrides, one per word (None to use the phonemizer's default language).
+    def phonemize_batch(self, inputs, langs=None):
+        res = [None] * len(inputs)
+        todo = {} # lang => word => indices of the word in inputs
+        for i, input in enumerate(inputs):
+            special = self.special_case(input)
+            if special is not None:
+                res[i] = special
+                continue
+            lang = self.resolve_lang(langs[i] if langs is not None else None)
+            if self.cache is not None:
+                cached = self.cache.get((lang, input))
+                if cached is not None:
+                    res[i] = cached
+                    continue
+            todo.setdefault(lang, {}).setdefault(input, []).append(i)
+        for lang, words in todo.items():
+            uniq = list(words.keys())
+            phonemized = self.phonemize_words(uniq, lang)
+            for word, phns in zip(uniq, phonemized):
+                if self.cache is not None:
+                    self.cache.put((lang, word), phns)
+                for i in words[word]:
+                    res[i] = phns
+        return res
+
+    def phonemize_words(self, inputs, lang):
+        with self.lock:
+            if self.tpe == "deep_phonemizer":
+                tmp = self.pher(inputs, lang, batch_size=DP_BATCH_SIZE)
             else:
-                raise Exception(f"Unexpected output from phonemize input '{input}': {tmp}")
+                tmp = self.pher.phonemize(inputs, strip=True, njobs=1)
+        if len(tmp) != len(inputs):
+            raise Exception(f"Unexpected output from phonemize input {inputs}: {tmp}")
+        return [t.replace(" ","_") for t in tmp]
 
     def __str__(self):
         return f"(name={self.name},lang={self.lang},model={self.path})"
@@ -6,7 +6,7 @@ from pathlib import Path
 import tools, voice
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
-from common import log
+from common import log, workers, cache, threads, residency
 
 from piper import PiperVoice, SynthesisConfig
 
@@ -20,7 +20,12 @@ class PiperConfig:
     voices: dict
     model_paths: list
     output_path: str
+    save_output: bool
     force_cpu: bool
+    cache: object
+    residency: object
+    startup_voices: list
+    warmup: dict
 
     
 def load_config(config_file):
@@ -31,6 +36,7 @@ def load_config(config_file):
         else:
             log.configure("piper", log.default_handler, log.default_level)
             
+        memLogger = None
         if data.get("log_memory_usage",False):
             memLogger = log.MemoryLogger()
             memLogger.start()
@@ -38,8 +44,23 @@ def load_config(config_file):
         result = PiperConfig()
         result.model_paths = list(map(tools.create_path, data['model_paths']))
         result.output_path = tools.create_path(data['output_path'], create=True)
+        result.save_output = data.get('save_output', True)
         result.force_cpu = data.get('force_cpu', False)
         result.voices = {}
+        # voices with load_on_startup are loaded in the background when the server starts (see common/warmup.py)
+        result.startup_voices = []
+        result.warmup = data.get('warmup')
+        result.cache = None
+        if "cache" in data:
+            result.cache = cache.create_synthesis_cache(data["cache"], result.output_path)
+
+        result.residency = residency.create_manager(result.model_paths, data.get('residency'))
+        if result.residency.max_rss is not None:
+            # max_rss is checked on each sample of the memory logger
+            if memLogger is None:
+                memLogger = log.MemoryLogger()
+                memLogger.start()
+            memLogger.listeners.append(result.residency.check_rss)
 
         if data.get('clear_audio_on_startup', False):
             tools.clear_audio(result.output_path)
@@ -62,6 +83,10 @@ def load_config(config_file):
                             speaker_id=voice_config.get('speaker_id',None),
                             phonemizers=[],
                             selected_phonemizer_index=0)
+            v.threads = threads.create_settings(name, data.get('threads'), voice_config.get('threads'))
+            v.pool = workers.create_pool(name, data.get('workers'), voice_config.get('workers'), initializer=v.threads.apply)
+            if voice_config.get('cache', True):
+                v.cache = result.cache
             result.voices[name] = v
             if not voice_config.get('enabled', True):
                 log.debug(f"Skipping voice {name} (not enabled)")
@@ -70,7 +95,7 @@ def load_config(config_file):
             if not voice_config.get('load_on_startup', True):
                 log.debug(f"Not loading voice {name} on startup")
                 continue
-            v.load(result.model_paths)
+            result.startup_voices.append(name)
             
     log.debug(f"Loaded config file {config_file}")
     return result
@@ -0,0 +1,35 @@
+import pytest
+import io
+import wave
+import tools
+
+class TestTools:
+
+    def test_wav_header(self):
+        pcm = b"\x01\x00\x02\x00\x03\x00"
+        header = tools.wav_header(22050, 2, 1, data_size=len(pcm))
+        assert len(header) == 44
+        with wave.open(io.BytesIO(header + pcm), "rb") as wf:
+            assert wf.getframerate() == 22050
+            assert wf.getsampwidth() == 2
+            assert wf.getnchannels() == 1
+            assert wf.readframes(3) == pcm
+
+    def test_streaming_wav_header(self):
+        header = tools.wav_header(16000, 2, 1)
+        assert header[4:8] == b"\xff\xff\xff\xff"
+        assert header[40:44] == b"\xff\xff\xff\xff"
+
+    def test_copy_to_latest_concurrent(self, tmp_path):
+        import json, threading
+        def copy(i):
+            (tmp_path / f"utt_{i}.wav").write_bytes(str(i).encode() * 10000)
+            tools.copy_to_latest({"audio": f"utt_{i}.wav", "n": i}, str(tmp_path))
+        threads = [threading.Thread(target=copy, args=(i,)) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # latest.json and latest.wav come from the same request
+        n = json.loads((tmp_path / "latest.json").read_text())["n"]
+        assert (tmp_path / "latest.wav").read_bytes() == str(n).encode() * 10000
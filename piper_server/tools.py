@@ -1,5 +1,6 @@
 import sys, os
 from pathlib import Path
+import threading
 
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
@@ -103,6 +104,18 @@ def create_path(p,create=True):
     return p
 
 
+# WAV header for streaming output, where the data size is not known when the header is sent.
+# The RIFF and data chunk sizes are set to the max value, which is how most players and decoders handle open-ended streams.
+def wav_header(sample_rate, sample_width, channels, data_size=0xFFFFFFFF):
+    import struct
+    riff_size = 0xFFFFFFFF if data_size == 0xFFFFFFFF else data_size + 36
+    block_align = channels * sample_width
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", riff_size, b"WAVE",
+                       b"fmt ", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, sample_width * 8,
+                       b"data", data_size)
+
+
 def clear_audio(audio_path):
     log.info(f"Clearing audio set to true")
     n=0
@@ -114,6 +127,20 @@ def clear_audio(audio_path):
             #print(fn, "is removed")
     log.debug(f"Deleted {n} files from folder {audio_path}")
    
+# Saves output files for a result fetched from the synthesis cache (label files are not recreated)
+def save_cached_result(result, wav, output_file, save_output, save_audio):
+    wav_file = Path(output_file).with_suffix('.wav')
+    if save_audio:
+        with open(wav_file, "wb") as f:
+            f.write(wav)
+    if save_output:
+        with open(wav_file.with_suffix('.json'), 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+# latest.* are written by concurrent requests (one worker pool per voice), so they are updated under a lock,
+# to keep them from being mixed from different requests
+latest_lock = threading.Lock()
+
 def copy_to_latest(result, output_folder):
     basename = Path(result["audio"]).with_suffix("")
 
@@ -122,18 +149,19 @@ def copy_to_latest(result, output_folder):
 
     latest_json = result.copy()
     latest_json['audio'] = "latest.wav"
-    with open(os.path.join(output_folder, "latest.json"), 'w') as f:
-        json.dump(latest_json, f, ensure_ascii=False, indent=4)
-        
-    output_files = {
-        wav_file: os.path.join(output_folder, "latest.wav"),
-        lab_file: os.path.join(output_folder, "latest.lab")
-    }
-    import shutil
-    for source, dest in output_files.items():
-        if os.path.isfile(source): 
-            shutil.copy(source, dest)
+    with latest_lock:
+        with open(os.path.join(output_folder, "latest.json"), 'w') as f:
+            json.dump(latest_json, f, ensure_ascii=False, indent=4)
         
+        output_files = {
+            wav_file: os.path.join(output_folder, "latest.wav"),
+            lab_file: os.path.join(output_folder, "latest.lab")
+        }
+        import shutil
+        for source, dest in output_files.items():
+            if os.path.isfile(source): 
+                shutil.copy(source, dest)
+
 
 phoneme_input_re = re.compile("\\[\\[(.*)\\]\\]")
 separate_comma_re = re.compile("(^|[^\\[]) *, *($|[^\\]])")
@@ -1,5 +1,9 @@
 from piper import PiperVoice, SynthesisConfig
+from piper.config import PiperConfig
+import onnxruntime
 import wave
+import io
+import threading
 
 import sys, os, re
 from pathlib import Path
@@ -9,7 +13,7 @@ import json
 import tools
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
-from common import log
+from common import log, cache, threads, registry
 
 phoneme_input_re = re.compile("\\[\\[(.*)\\]\\]")
 separate_comma_re = re.compile("(^|[^\\[]) *, *($|[^\\]])")
@@ -36,6 +40,9 @@ class Voice:
 
     def __post_init__(self):
         self.loaded = False
+        self.pool = None
+        self.cache = None
+        self.threads = threads.ThreadSettings(self.name)
     
     def __str__(self):
         dict = asdict(self)
@@ -59,6 +66,9 @@ class Voice:
             "phonemizers": list(map(lambda p: p.as_json(), self.phonemizers)),
             "selected_phonemizer": phner
         }
+        obj["threads"] = self.threads.as_json()
+        if self.pool is not None:
+            obj["workers"] = self.pool.as_json()
         return obj
 
     def load(self, model_paths):
@@ -66,50 +76,83 @@ class Voice:
             log.error(f"Cannot load voice {self.name} (voice not enabled)")
             return
         phonemizers = []
-        defaultPhnIndex = 0
-        for i, phizer in enumerate(self.config['phonemizers']):
-            if phizer.get('enabled', True):
-                if phizer.get('default', False):
-                    defaultPhnIndex = i
-                if phizer['type'] == "deep_phonemizer":
-                    model_path = tools.find_file(phizer['model'], model_paths)
-                    if model_path is None:
-                        raise Exception(f"Couldn't find model {phizer['model']} for {phizer['name']}. Looked in {model_paths}")
-                    phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], model_path))
-                elif phizer['type'] == "espeak":
-                    phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang']))
-                else:
-                    raise Exception(f"Unknown phonemizer type {type} for {phizer['name']}")
-
-        if len(phonemizers) == 0:
-            raise Exception(f"Couldn't find phonemizer for voice '{self.config['name']}'")
-
-        onnx_fn = str(Path(self.config['model']).with_suffix(".onnx"))
-        model_path = tools.find_file(onnx_fn, model_paths)
-        # for debugging: temporarily list files in model_paths
-        all_found = []
-        from os import listdir
-        from os.path import join
-        for p in model_paths:
-            for f in listdir(p):
-                all_found.append(f"{p}/{f}")
-        log.debug(f"While looking for {onnx_fn}, I found all these files in configured model_paths {model_paths}: {all_found}")
-        if model_path is None:
-            msg = f"Couldn't find model {onnx_fn} for {self.name}. Looked in {model_paths}"
-            log.error(msg)
-            #log.error(f"All files in configured {model_paths}: {all_found}")
-            raise Exception(msg)
-        cuda = False
-        config = None # Explicit path to config file, but we should always have the config file stored with the onnx model
-        piper_voice = PiperVoice.load(model_path, config, cuda)
+        try:
+            defaultPhnIndex = 0
+            for i, phizer in enumerate(self.config['phonemizers']):
+                if phizer.get('enabled', True):
+                    if phizer.get('default', False):
+                        defaultPhnIndex = i
+                    cache_size = phizer.get('cache_size', 10000)
+                    if phizer['type'] == "deep_phonemizer":
+                        model_path = tools.find_file(phizer['model'], model_paths)
+                        if model_path is None:
+                            raise Exception(f"Couldn't find model {phizer['model']} for {phizer['name']}. Looked in {model_paths}")
+                        phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], model_path, cache_size=cache_size))
+                    elif phizer['type'] == "espeak":
+                        phonemizers.append(Phonemizer(phizer['name'], phizer['type'], phizer['lang'], cache_size=cache_size))
+                    else:
+                        raise Exception(f"Unknown phonemizer type {type} for {phizer['name']}")
+                    if 'prewarm' in phizer:
+                        prewarm_file = tools.find_file(phizer['prewarm'], model_paths)
+                        if prewarm_file is None:
+                            log.warning(f"Couldn't find prewarm word list {phizer['prewarm']} for {phizer['name']}. Looked in {model_paths}")
+                        else:
+                            phonemizers[-1].prewarm(prewarm_file, phizer.get('prewarm_limit', None))
+
+            if len(phonemizers) == 0:
+                raise Exception(f"Couldn't find phonemizer for voice '{self.config['name']}'")
+
+            onnx_fn = str(Path(self.config['model']).with_suffix(".onnx"))
+            model_path = tools.find_file(onnx_fn, model_paths)
+            # for debugging: temporarily list files in model_paths
+            all_found = []
+            from os import listdir
+            from os.path import join
+            for p in model_paths:
+                for f in listdir(p):
+                    all_found.append(f"{p}/{f}")
+            log.debug(f"While looking for {onnx_fn}, I found all these files in configured model_paths {model_paths}: {all_found}")
+            if model_path is None:
+                msg = f"Couldn't find model {onnx_fn} for {self.name}. Looked in {model_paths}"
+                log.error(msg)
+                #log.error(f"All files in configured {model_paths}: {all_found}")
+                raise Exception(msg)
+            # the config file is stored with the onnx model
+            config_path = f"{model_path}.json"
+            log.debug(f"Loading {model_path} for voice {self.name} with threads {self.threads.as_json()}...")
+            # threads created by onnxruntime while loading inherit the voice's cpu_affinity
+            with self.threads.pinned():
+                # same as PiperVoice.load, but with the voice's thread settings in the session options
+                with open(config_path, "r", encoding="utf-8") as config_file:
+                    piper_config = PiperConfig.from_dict(json.load(config_file))
+                options = self.threads.session_options(onnxruntime.SessionOptions())
+                session = onnxruntime.InferenceSession(str(model_path), sess_options=options, providers=["CPUExecutionProvider"])
+                piper_voice = PiperVoice(config=piper_config, session=session)
+        except Exception:
+            # the new phonemizers are shared, so they are released if the voice can't be loaded
+            for p in phonemizers:
+                p.release()
+            raise
 
         self.piper_voice = piper_voice
+        for p in self.phonemizers:
+            p.release()
         self.phonemizers=phonemizers
         self.selected_phonemizer_index=defaultPhnIndex
         onnx_fn = str(Path(self.config['model']).with_suffix(".onnx"))
         self.model_path = tools.find_file(onnx_fn, model_paths)
         self.loaded = True
         log.debug(f"Loaded voice {json.dumps(self.as_json(), indent=4)}")
+
+    # Releases the model and phonemizers, the voice is loaded again on the next request
+    def unload(self):
+        self.loaded = False
+        for p in self.phonemizers:
+            p.release()
+        self.piper_voice = None
+        self.phonemizers = []
+        self.selected_phonemizer_index = 0
+        log.debug(f"Unloaded voice {self.name}")
     
     def validate(self, fail_on_error = True):
         if self.length_scale < -1.0 or self.length_scale > 5.0:
@@ -125,69 +168,138 @@ class Voice:
         else:
             return None
     
-    def process_tokens(self, tokens: str):
+    # Processes the tokens of one or more utterances.
+    # Words without phonemes are phonemized in a single batch for all utterances.
+    def process_token_lists(self, token_lists):
         res = []
-
-        for t in tokens:
-            w = {}
-            if "orth" in t:
-                w["orth"] = t["orth"]
-            if "lang" in t:
-                w["lang"] = t["lang"]
-            if "g2p_method" in t:
-                w["g2p_method"] = t["g2p_method"]
-            if "phonemes" in t:
-                w["input"] =  t["phonemes"]
-                w["phonemes"] =  t["phonemes"]
-            else:
-                lang = w.get("lang", None)
-                phner = self.selected_phonemizer()
-                phner_input = ""
-                if len(t["orth"]) > 0:
-                    phner_input = t["orth"]
+        phner = self.selected_phonemizer()
+        to_phonemize = [] # (word, phonemizer input, lang)
+        for tokens in token_lists:
+            words = []
+            for t in tokens:
+                w = {}
+                if "orth" in t:
+                    w["orth"] = t["orth"]
+                if "lang" in t:
+                    w["lang"] = t["lang"]
+                if "g2p_method" in t:
+                    w["g2p_method"] = t["g2p_method"]
+                if "phonemes" in t:
+                    w["input"] =  t["phonemes"]
+                    w["phonemes"] =  t["phonemes"]
                 else:
-                    phner_input = t.get("prepunct","")+t.get("postpunct","") ## Workaround to handle input words without orthography, because if we use the empty string, we will not be able to track back the number of tokens from the phonetizer output
-                result = phner.phonemize(phner_input, lang)
-                w["input"] = t["orth"]
+                    lang = w.get("lang", None)
+                    phner_input = ""
+                    if len(t["orth"]) > 0:
+                        phner_input = t["orth"]
+                    else:
+                        phner_input = t.get("prepunct","")+t.get("postpunct","") ## Workaround to handle input words without orthography, because if we use the empty string, we will not be able to track back the number of tokens from the phonetizer output
+                    w["input"] = t["orth"]
+                    w["phonemes"] = None # set below
+                    w["g2p_method"] = phner.tpe
+                    to_phonemize.append((w, phner_input, lang))
+                if "hidden" in t:
+                    w["hidden"] = t["hidden"]
+                if "postpunct" in t:
+                    w["postpunct"] = t["postpunct"]
+                if "prepunct" in t:
+                    w["prepunct"] = t["prepunct"]
+                words.append(w)
+            res.append(words)
+        if len(to_phonemize) > 0:
+            results = phner.phonemize_batch([x[1] for x in to_phonemize], [x[2] for x in to_phonemize])
+            for (w, _, _), result in zip(to_phonemize, results):
                 w["phonemes"] = result
-                w["g2p_method"] = phner.tpe
-            if "hidden" in t:
-                w["hidden"] = t["hidden"]
-            if "postpunct" in t:
-                w["postpunct"] = t["postpunct"]
-            if "prepunct" in t:
-                w["prepunct"] = t["prepunct"]
-            res.append(w)
         return res
-        
-    def synthesize_all(self, inputs, input_type, output_folder, params):
+
+    def process_tokens(self, tokens: str):
+        return self.process_token_lists([tokens])[0]
+
+    # Returns a list of result objects, and a list of in-memory wav files (one per input).
+    # Output files are only written to output_folder if save_audio (wav) and/or save_output (json, lab and latest.*) is set.
+    def synthesize_all(self, inputs, input_type, output_folder, params, save_output=True, save_audio=True):
         import uuid
         uid = uuid.uuid4()
         res = []
-        i = 0
+        wavs = []
         spk_id = tools.get_or_else(vars(params).get("speaker_id"), self.speaker_id)
-        for input in inputs:
-            i = i+1
+        cache_keys = [self.cache_key(input, input_type, params) for input in inputs]
+        cached = [self.cache.get(k) if k is not None else None for k in cache_keys]
+        # process the tokens of all inputs not found in the cache, with a single phonemizer call
+        todo = [n for n, c in enumerate(cached) if c is None]
+        token_lists = self.process_token_lists([tools.input2tokens(inputs[n], input_type, self.lang) for n in todo])
+        tokens_processed = dict(zip(todo, token_lists))
+        for n, input in enumerate(inputs):
+            i = n+1
             base_name = f"utt_{uid}_{i:03d}_spk_{spk_id:03d}" if spk_id is not None else f"utt_{uid}_{i:03d}"
             output_file = os.path.join(output_folder, base_name)
-            res.append(self.synthesize(input, input_type, output_file, params))
-        if len(res) > 0:
+            if cached[n] is not None:
+                log.debug(f"voice.synthesize_all cache hit for input {input}")
+                result, wav = cached[n]
+                result["audio"] = os.path.basename(str(Path(output_file).with_suffix('.wav')))
+                tools.save_cached_result(result, wav, output_file, save_output, save_audio)
+            else:
+                result, wav = self.synthesize(input, input_type, output_file, params, save_output=save_output, save_audio=save_audio, tokens_processed=tokens_processed[n])
+                if cache_keys[n] is not None and result is not None:
+                    self.cache.put(cache_keys[n], result, wav)
+            res.append(result)
+            wavs.append(wav)
+        if len(res) > 0 and save_output:
             tools.copy_to_latest(res[len(res)-1],output_folder)
-        return res
+        return res, wavs
 
-    def synthesize(self, input, input_type, output_file, syn_config):
-        if not self.loaded:
+    def cache_key(self, input, input_type, syn_config):
+        if self.cache is None:
             return None
+        phner = self.selected_phonemizer()
+        params = {
+            "length_scale": syn_config.length_scale,
+            "noise_scale": syn_config.noise_scale,
+            "noise_w_scale": syn_config.noise_w_scale,
+            "speaker_id": tools.get_or_else(syn_config.speaker_id, self.speaker_id),
+            "volume": syn_config.volume,
+            "normalize_audio": syn_config.normalize_audio,
+            "phonemizer": phner.name if phner is not None else None,
+        }
+        return cache.synthesis_key(self.name, input, input_type, params)
+
+    def prepare_input(self, input, input_type):
+        input_tokens = tools.input2tokens(input, input_type, self.lang)
+        tokens_processed = self.process_tokens(input_tokens)
+        return tokens_processed, tools.tokens2piper(tokens_processed)
+
+    # Yields a WAV header followed by raw PCM chunks, as soon as piper produces them
+    def synthesize_stream(self, inputs, input_type, syn_config):
+        if not self.loaded:
+            return
+
+        import time
+        start_time = time.time()
+        first_chunk = True
+        for input in inputs:
+            log.debug(f"voice.synthesize_stream input: {input}")
+            _, piper_input = self.prepare_input(input, input_type)
+            for audio_chunk in self.piper_voice.synthesize(piper_input, syn_config=syn_config):
+                if first_chunk:
+                    log.info("voice.py::synthesize_stream - first chunk - took %s seconds" % (time.time() - start_time))
+                    yield tools.wav_header(audio_chunk.sample_rate, audio_chunk.sample_width, audio_chunk.sample_channels)
+                    first_chunk = False
+                yield audio_chunk.audio_int16_bytes
+        log.info("voice.py::synthesize_stream - overall - took %s seconds" % (time.time() - start_time))
+
+    def synthesize(self, input, input_type, output_file, syn_config, save_output=True, save_audio=True, tokens_processed=None):
+        if not self.loaded:
+            return None, None
 
         import time
         outer_start_time = time.time()
 
         log.debug(f"voice.synthesize input: {input}")
-        input_tokens = tools.input2tokens(input, input_type, self.lang)
-        
         set_wav_format = True
-        tokens_processed = self.process_tokens(input_tokens)
-        piper_input = tools.tokens2piper(tokens_processed)
+        if tokens_processed is None:
+            tokens_processed, piper_input = self.prepare_input(input, input_type)
+        else:
+            piper_input = tools.tokens2piper(tokens_processed)
 
         log.debug(f"??? voice tokens_processed: {tokens_processed}")
         log.debug(f"??? voice piper_input: {piper_input}")
@@ -203,8 +315,9 @@ class Voice:
         log.debug(f"Piper input: {piper_input}")
         log.debug(f"syn_config: {syn_config}")
 
+        wav_buffer = io.BytesIO()
         try:
-            with wave.open(wav_file, "wb") as wf:
+            with wave.open(wav_buffer, "wb") as wf:
                 chunks = []
                 try:
                     piper_start_time = time.time()
@@ -229,7 +342,6 @@ class Voice:
                     first_chunk = False
 
                     wf.writeframes(audio_chunk.audio_int16_bytes)
-                    log.info(f"Audio saved to {wav_file}")
 
                     if piper_alignments_enabled and audio_chunk.phoneme_alignments:
                         alignments.extend(audio_chunk.phoneme_alignments)
@@ -266,12 +378,7 @@ class Voice:
                     del tokens[0]
                 
         result["audio"] = os.path.basename(wav_file)
-
-        save_start_time = time.time()
-
-        # json file
-        json_obj = result
-        json_obj["tts_config"] = {
+        result["tts_config"] = {
             "volume": syn_config.volume,
             "length_scale": syn_config.length_scale,
             "noise_scale": syn_config.noise_scale,
@@ -279,58 +386,99 @@ class Voice:
             "normalize_audio": syn_config.normalize_audio,
             "speaker_id": syn_config.speaker_id,
         }
-        json_output = Path(wav_file).with_suffix('.json')
-        with open(json_output, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=4)
-            log.info(f"JSON saved to {json_output}")
+        wav_bytes = wav_buffer.getvalue()
 
-        # lab file
-        with open(lab_file, "w") as f:
-            for t in tokens:
-                f.write(f"{t['start_time']}\t{t['end_time']}\t{t['phonemes']}\n")
-        log.info(f"Label style output saved to {lab_file}")
+        save_start_time = time.time()
+
+        # wav file
+        if save_audio:
+            with open(wav_file, "wb") as f:
+                f.write(wav_bytes)
+            log.info(f"Audio saved to {wav_file}")
+
+        if save_output:
+            # json file
+            json_output = Path(wav_file).with_suffix('.json')
+            with open(json_output, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=4)
+                log.info(f"JSON saved to {json_output}")
+
+            # lab file
+            if piper_alignments_enabled:
+                with open(lab_file, "w") as f:
+                    for t in tokens:
+                        f.write(f"{t['start_time']}\t{t['end_time']}\t{t['phonemes']}\n")
+                log.info(f"Label style output saved to {lab_file}")
 
         log.info("voice.py::synthesize - save output - took %s seconds" % (time.time() - save_start_time))
         log.info("voice.py::synthesize - overall     - took %s seconds" % (time.time() - outer_start_time))
-        return result
+        return result, wav_bytes
+
 
 
+DP_BATCH_SIZE = 32
+
+# Phonemizer backends, shared by all voices in the process, keyed on (type, model path, lang)
+phonemizer_backends = registry.SharedRegistry("phonemizer")
 
 class Phonemizer:
     name: str
     tpe: str
     lang: str
     pher: object
-    def __init__(self, name, tpe, lang, path=None):
+    def __init__(self, name, tpe, lang, path=None, cache_size=10000):
         self.name = name
         self.tpe = tpe
         self.lang = lang
         self.path = path
+        self.cache = None
+        # the phonemizer backend is shared by all voices using the same type, model and language.
+        # phonemizer backends are not guaranteed to be thread safe, so calls are serialized with the shared lock.
+        self.shared = None
+        self.lock = threading.Lock()
         try:
-            if tpe == "deep_phonemizer":
-                from dp.phonemizer import Phonemizer
-                if path is None:
-                    raise Exception(f"Deep phonemizer {name} cannot be loaded without a model path. Found None")
-                if not os.path.isfile(self.path):
-                    raise Exception(f"Model path for deep phonemizer {name} does not exist: {path}")
-                self.pher = Phonemizer.from_checkpoint(path)
-                log.debug(f"Loaded dp phonemizer {self.pher}")
-            elif tpe == "espeak":
-                import phonemizer
-                self.pher = phonemizer.backend.EspeakBackend(
-                    language=lang,
-                    preserve_punctuation=True,
-                    with_stress=True,
-                    language_switch="remove-flags",
-                    logger=log.pylogger or None,
-                )
-                log.debug(f"Loaded espeak phonemizer {self.pher}")
-            else:
-                raise Exception(f"Unknown phonemizer type {tpe} for {self.name}")
+            key = (tpe, os.path.realpath(path) if path is not None else None, lang)
+            self.shared = phonemizer_backends.acquire(key, self.load_backend)
+            self.pher = self.shared.value
+            self.lock = self.shared.lock
+            # word level cache, keyed on (lang, word). The cache is stored with the shared backend, so it is used by all
+            # voices with the same phonemizer, and kept when the voices are unloaded (the first voice sets its size).
+            if cache_size > 0:
+                with self.lock:
+                    self.cache = self.shared.data.setdefault("cache", cache.LRUCache(max_entries=cache_size))
         except RuntimeError as e:
             msg = f"Couldn't load phonetizer for voice {name}: {e}. Voice will not be loaded."
             log.error(msg)
 
+    def load_backend(self):
+        if self.tpe == "deep_phonemizer":
+            from dp.phonemizer import Phonemizer
+            if self.path is None:
+                raise Exception(f"Deep phonemizer {self.name} cannot be loaded without a model path. Found None")
+            if not os.path.isfile(self.path):
+                raise Exception(f"Model path for deep phonemizer {self.name} does not exist: {self.path}")
+            pher = Phonemizer.from_checkpoint(self.path)
+            log.debug(f"Loaded dp phonemizer {pher}")
+        elif self.tpe == "espeak":
+            import phonemizer
+            pher = phonemizer.backend.EspeakBackend(
+                language=self.lang,
+                preserve_punctuation=True,
+                with_stress=True,
+                language_switch="remove-flags",
+                logger=log.pylogger or None,
+            )
+            log.debug(f"Loaded espeak phonemizer {pher}")
+        else:
+            raise Exception(f"Unknown phonemizer type {self.tpe} for {self.name}")
+        return pher
+
+    # Releases the shared phonemizer backend (dropped when no other voice uses it)
+    def release(self):
+        if self.shared is not None:
+            phonemizer_backends.release(self.shared)
+            self.shared = None
+            self.pher = None
 
     def as_json(self):
         obj = {
@@ -338,30 +486,87 @@ class Phonemizer:
             "type": self.tpe,
             "lang": self.lang,
             "path": self.path,
+            "shared_by": self.shared.refs if self.shared is not None else 0,
         }
+        if self.cache is not None:
+            obj["cache"] = self.cache.stats()
         return obj
 
-    def phonemize(self, input, lang=None):
+    # Fills the word cache from a word list (one word per line, most frequent first; additional tab separated fields are ignored)
+    def prewarm(self, word_list_file, limit=None):
+        if self.cache is None:
+            return
+        import time
+        start_time = time.time()
+        words = []
+        with open(word_list_file, "r", encoding="utf-8") as f:
+            for l in f:
+                w = l.split("\t")[0].strip()
+                if w == "":
+                    continue
+                words.append(w)
+                if limit is not None and len(words) >= limit:
+                    break
+        self.phonemize_batch(words)
+        log.info(f"Prewarmed phonemizer {self.name} with {len(words)} words from {word_list_file} in {time.time() - start_time:.2f} seconds")
+
+    def resolve_lang(self, lang):
+        if self.tpe != "deep_phonemizer" or lang is None:
+            return self.lang
+        if lang not in self.pher.predictor.text_tokenizer.languages:
+            log.info(f"Language {lang} is not supported by phonemizer. Using {self.lang} instead")
+            return self.lang
+        return lang
+
+    # special cases that are not sent to the phonemizer
+    def special_case(self, input):
         if input == "":
             return ""
         elif input in [",", ":"]: # experiment for pausing
             return "__"
         elif input in ["..",".","_","__", "#", "##", ",", ",,", "!", "!!"]: # experiment for pausing
             return input
-        elif self.tpe == "deep_phonemizer":
-            if lang is None:
-                lang = self.lang
-            else:
-                if lang not in self.pher.predictor.text_tokenizer.languages:
-                    log.info(f"Language {lang} is not supported by phonemizer. Using {self.lang} instead")
-                    lang = self.lang
-            return self.pher(input, lang).replace(" ","_")
-        else:
-            tmp = self.pher.phonemize([input], strip=True, njobs=1)
-            if len(tmp) > 0:
-                return tmp[0].replace(" ","_")
+        return None
+
+    def phonemize(self, input, lang=None):
+        return self.phonemize_batch([input], [lang])[0]
+
+    # Phonemizes a list of words, with one phonemizer call per language for all words not found in the cache.
+    # langs is an optional list of language overrides, one per word (None to use the phonemizer's default language).
+    def phonemize_batch(self, inputs, langs=None):
+        res = [None] * len(inputs)
+        todo = {} # lang => word => indices of the word in inputs
+        for i, input in enumerate(inputs):
+            special = self.special_case(input)
+            if special is not None:
+                res[i] = special
+                continue
+            lang = self.resolve_lang(langs[i] if langs is not None else None)
+            if self.cache is not None:
+                cached = self.cache.get((lang, input))
+                if cached is not None:
+                    res[i] = cached
+                    continue
+            todo.setdefault(lang, {}).setdefault(input, []).append(i)
+        for lang, words in todo.items():
+            uniq = list(words.keys())
+            phonemized = self.phonemize_words(uniq, lang)
+            for word, phns in zip(uniq, phonemized):
+                if self.cache is not None:
+                    self.cache.put((lang, word), phns)
+                for i in words[word]:
+                    res[i] = phns
+        return res
+
+    def phonemize_words(self, inputs, lang):
+        with self.lock:
+            if self.tpe == "deep_phonemizer":
+                tmp = self.pher(inputs, lang, batch_size=DP_BATCH_SIZE)
             else:
-                raise Exception(f"Unexpected output from phonemize input '{input}': {tmp}")
+                tmp = self.pher.phonemize(inputs, strip=True, njobs=1)
+        if len(tmp) != len(inputs):
+            raise Exception(f"Unexpected output from phonemize input {inputs}: {tmp}")
+        return [t.replace(" ","_") for t in tmp]
 
     def __str__(self):
         return f"(name={self.name},lang={self.lang},model={self.path})"
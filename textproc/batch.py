@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import os
+import sys
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import log
+
+import textproc
+
+defaults = {
+    "processes": None, # None = number of CPUs
+    "chunk_size": 32,
+    "max_pending_chunks": None, # None = 4 * processes
+}
+
+OUTPUT_FORMATS = ["full", "text"]
+
+# Textprocs loaded in each worker process (see init_worker)
+textprocs = None
+
+def init_worker(json_config):
+    global textprocs
+    textprocs = textproc.load_config(json_config)
+
+def worker_ready():
+    return textprocs is not None
+
+# Processes a chunk of (id, text) items in a worker process.
+# Errors in single items are returned as results, so that they don't stop the rest of the batch.
+def process_chunk(name, output, chunk):
+    if name not in textprocs:
+        raise ValueError(f"No such textproc: {name}")
+    tp = textprocs[name]
+    res = []
+    for id, text in chunk:
+        try:
+            utts = tp.process_text(text)
+            if output == "text":
+                utts = [utt["derived_output_text"] for utt in utts]
+            res.append({"id": id, "result": utts})
+        except Exception as e:
+            log.error(f"Couldn't process batch item {id}: {e}")
+            res.append({"id": id, "error": f"{e}"})
+    return res
+
+# A batch item is a string, or an object with text and an optional id. Items without an id are tagged with their position in the batch.
+def parse_item(i, obj):
+    if isinstance(obj, str):
+        return (i, obj)
+    if isinstance(obj, dict) and isinstance(obj.get("text"), str):
+        return (obj.get("id", i), obj["text"])
+    raise ValueError(f"Invalid batch item #{i}: {obj} (expected a string, or an object with text and optional id)")
+
+# Parses an NDJSON line as batch item #i. Returns None for empty lines.
+def parse_line(i, line):
+    if line.strip() == "":
+        return None
+    try:
+        obj = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON for batch item #{i}: {e}")
+    return parse_item(i, obj)
+
+def read_ndjson(lines):
+    i = 0
+    for line in lines:
+        item = parse_line(i, line)
+        if item is not None:
+            yield item
+            i += 1
+
+# Reads NDJSON items from an async stream of bytes (e.g., a request body), as they arrive
+async def read_ndjson_stream(stream):
+    i = 0
+    rest = b""
+    async for data in stream:
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            item = parse_line(i, line.decode("utf-8"))
+            if item is not None:
+                yield item
+                i += 1
+    item = parse_line(i, rest.decode("utf-8"))
+    if item is not None:
+        yield item
+
+async def iterate_async(items):
+    for item in items:
+        yield item
+
+# Parses a JSON array of batch items
+def parse_json_batch(body):
+    data = json.loads(body)
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array")
+    return [parse_item(i, obj) for i, obj in enumerate(data)]
+
+def read_text(lines):
+    for i, line in enumerate(lines):
+        yield (i, line.rstrip("\n"))
+
+def chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+async def chunks_async(items, size):
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+# Runs process_text for batches of texts in a pool of worker processes, each with its own preloaded textprocs.
+# Items are sent to the workers in chunks of chunk_size, with at most max_pending_chunks in progress, so that input is
+# read and output is written as a stream. Results are returned in input order, or as soon as they are done (ordered=False).
+class BatchProcessor:
+
+    def __init__(self, json_config, processes=defaults["processes"], chunk_size=defaults["chunk_size"], max_pending_chunks=defaults["max_pending_chunks"]):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if max_pending_chunks is None:
+            max_pending_chunks = 4 * processes
+        if processes < 1:
+            raise ValueError(f"Invalid processes for batch: {processes} (expected >= 1)")
+        if chunk_size < 1:
+            raise ValueError(f"Invalid chunk_size for batch: {chunk_size} (expected >= 1)")
+        if max_pending_chunks < 1:
+            raise ValueError(f"Invalid max_pending_chunks for batch: {max_pending_chunks} (expected >= 1)")
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = max_pending_chunks
+        # spawn, since the server process has threads running
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(json_config,))
+
+    # Starts the worker processes and loads the textprocs in the background (otherwise, workers are started on the first batch)
+    def start(self):
+        for _ in range(self.processes):
+            self.executor.submit(worker_ready)
+        log.info(f"Starting {self.processes} textproc batch worker(s)")
+
+    def run(self, name, items, ordered=True, output="full"):
+        if output not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {output} (expected one of {OUTPUT_FORMATS})")
+        pending = deque()
+        try:
+            for chunk in chunks(items, self.chunk_size):
+                pending.append(self.executor.submit(process_chunk, name, output, chunk))
+                while len(pending) >= self.max_pending_chunks:
+                    yield from self.next_results(pending, ordered)
+            while len(pending) > 0:
+                yield from self.next_results(pending, ordered)
+        finally:
+            # if the caller stops early, chunks that haven't started are dropped
+            for future in pending:
+                future.cancel()
+
+    def next_results(self, pending, ordered):
+        if ordered:
+            future = pending.popleft()
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            future = next(iter(done))
+            pending.remove(future)
+        return future.result()
+
+    # Same as run, for an async iterator of items, without blocking the event loop
+    async def run_async(self, name, items, ordered=True, output="full"):
+        if output not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {output} (expected one of {OUTPUT_FORMATS})")
+        pending = deque()
+        try:
+            async for chunk in chunks_async(items, self.chunk_size):
+                pending.append(asyncio.wrap_future(self.executor.submit(process_chunk, name, output, chunk)))
+                while len(pending) >= self.max_pending_chunks:
+                    for res in await self.next_results_async(pending, ordered):
+                        yield res
+            while len(pending) > 0:
+                for res in await self.next_results_async(pending, ordered):
+                    yield res
+        finally:
+            # if the caller stops early (e.g., the client disconnected), chunks that haven't started are dropped
+            # (cancelling the asyncio future cancels the worker future)
+            for future in pending:
+                future.cancel()
+
+    async def next_results_async(self, pending, ordered):
+        if ordered:
+            future = pending.popleft()
+        else:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            future = next(iter(done))
+            pending.remove(future)
+        return await future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_processor(json_config, opts=None):
+    with open(json_config, "r") as file:
+        data = json.load(file)
+    opts = defaults | (data.get("batch") or {}) | (opts or {})
+    opts.pop("_comment", None)
+    return BatchProcessor(json_config, **opts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='batch',
+        description="Runs textproc for many texts, in parallel. Writes one NDJSON result per input text, with id and result (or error)."
+    )
+    parser.add_argument('-c', '--config', required=True, help="Textproc config file (json)")
+    parser.add_argument('-n', '--name', default="sv_se_1", help="Textproc name")
+    parser.add_argument('-p', '--processes', type=int, default=None, help="Number of worker processes (default: from config, or number of CPUs)")
+    parser.add_argument('-i', '--input-format', choices=["text", "ndjson"], default="text", help="text: one text per line; ndjson: one JSON string, or object with text and optional id, per line")
+    parser.add_argument('-o', '--output', choices=OUTPUT_FORMATS, default="full", help="full: process_text result; text: derived output text per sentence")
+    parser.add_argument('-u', '--unordered', action='store_true', help="Write results as soon as they are done, instead of in input order")
+    parser.add_argument('input', nargs='?', default="-", help="Input file (default: stdin)")
+    args = parser.parse_args()
+
+    opts = {}
+    if args.processes is not None:
+        opts["processes"] = args.processes
+    processor = create_processor(args.config, opts)
+    fh = sys.stdin if args.input == "-" else open(args.input, "r")
+    try:
+        reader = read_ndjson if args.input_format == "ndjson" else read_text
+        for res in processor.run(args.name, reader(fh), ordered=not args.unordered, output=args.output):
+            print(json.dumps(res, ensure_ascii=False))
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+        processor.shutdown()
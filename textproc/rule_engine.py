@@ -0,0 +1,191 @@
+import os
+import sys
+import re
+
+parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, parentdir)
+from common import log
+
+# Compiled version of Textproc.apply_rewrite_rules, with identical output.
+#
+# Rules are grouped into stages of consecutive rules of the same type, and each stage is compiled into a combined
+# regex: an alternation of the stage's rules, with a named group per rule, so that one scan finds the first rule
+# that can match.
+#
+# Token stages: for each token, the first rule that matches the token (input or word) is found with one combined
+# match on each. Token records (punctuation and numeral expansion, needed for the word) are created on first use,
+# and shared by all stages and rules for the rest of the utterance (see Textproc.cached_token).
+#
+# Utterance stages: texts where none of the remaining rules match are skipped with one combined search,
+# instead of one search per rule. When a rule matches, it is applied with Textproc.apply_rewrite_rule, and the
+# remaining rules are applied to the resulting text parts in the same way.
+#
+# Stages that can't be combined (invalid combined regex, or rules with backreferences) are run rule by rule.
+
+BACKREFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+def combine(rules, prefix):
+    alternatives = []
+    for i, r in enumerate(rules):
+        if BACKREFERENCE_RE.search(r["input"]):
+            raise re.error(f"rule #{r['id']} contains a backreference")
+        flag = "i" if r["input_compiled"].flags & re.IGNORECASE else "-i"
+        alternatives.append(f"(?P<{prefix}{i}>(?{flag}:{r['input']}))")
+    return re.compile("|".join(alternatives))
+
+
+class Stage:
+    def __init__(self, rule_type, rules, first_id):
+        self.rule_type = rule_type
+        self.rules = rules
+        self.combined = None
+        # group name => index of the rule in the stage
+        self.prefix = f"rule_{first_id}_"
+        try:
+            if rule_type == "token":
+                self.combined = combine(rules, self.prefix)
+            else:
+                # one combined regex for each suffix rules[i:] of the stage
+                self.combined = [combine(rules[i:], f"{self.prefix}{i}_") for i in range(len(rules))]
+        except (re.error, RecursionError, OverflowError) as e:
+            log.warning(f"Couldn't combine textproc rules #{rules[0]['id']}-#{rules[-1]['id']}, applying them one by one: {e}")
+            self.combined = None
+
+    # Index (in the stage) of the rule matched by a combined regex
+    def rule_index(self, m, offset=0):
+        name = m.lastgroup
+        if name is not None and name.startswith(self.prefix):
+            return offset + int(name.rsplit("_", 1)[1])
+        for name, value in m.groupdict().items():
+            if value is not None and name.startswith(self.prefix):
+                return offset + int(name.rsplit("_", 1)[1])
+        raise ValueError(f"No rule group matched in {m}")
+
+
+class RuleEngine:
+
+    def __init__(self, textproc, rules):
+        self.textproc = textproc
+        self.stages = []
+        start = 0
+        for i in range(1, len(rules) + 1):
+            if i == len(rules) or rules[i]["rule_type"] != rules[start]["rule_type"]:
+                self.stages.append(Stage(rules[start]["rule_type"], rules[start:i], rules[start]["id"]))
+                start = i
+
+    def apply(self, item: object, token_cache=None):
+        if token_cache is None:
+            token_cache = {}
+        acc = [item]
+        for stage in self.stages:
+            acc0 = acc
+            acc = []
+            for item in acc0:
+                if item["type"] == "text":
+                    if stage.combined is None:
+                        acc.extend(self.apply_sequential(stage.rules, item["text"], token_cache))
+                    elif stage.rule_type == "token":
+                        acc.extend(self.apply_token_stage(stage, item["text"], token_cache))
+                    else:
+                        acc.extend(self.apply_utterance_stage(stage, item["text"]))
+                elif item["type"] in ["alias", "phonemes"]:
+                    acc.append(item)
+                else:
+                    raise ValueError(item)
+        return acc
+
+    def apply_sequential(self, rules, s: str, token_cache):
+        acc = [{"type": "text", "text": s}]
+        for r in rules:
+            acc0 = acc
+            acc = []
+            for item in acc0:
+                if item["type"] == "text":
+                    acc.extend(self.textproc.apply_rewrite_rule(r, item["text"], token_cache))
+                else:
+                    acc.append(item)
+        return acc
+
+    def apply_token_stage(self, stage, s: str, token_cache):
+        tp = self.textproc
+        res = []
+        for text in tp.token_split_re.split(s):
+            i = self.first_token_rule(stage, text, token_cache)
+            if i is None:
+                # each token is passed to the next rule as a text of its own, and tokenized again
+                if len(stage.rules) > 1 and tp.token_split_re.split(text) != [text]:
+                    res.extend(self.apply_sequential(stage.rules[1:], text, token_cache))
+                else:
+                    res.append({"type": "text", "text": text})
+                continue
+            tok = tp.cached_token(text, token_cache)
+            rule, matched_input = stage.rules[abs(i) - 1], i > 0
+            rex = rule["input_compiled"]
+            if matched_input:
+                try:
+                    alias = rex.sub(rule["output"], tok["input"])
+                    if rule.get("trim", False):
+                        alias = alias.strip()
+                except Exception as e:
+                    log.error(f"Couldn't replace {tok['input']} to {rule['output']} with rule {rule}")
+                    raise e
+            else:
+                alias = tok.get("prepunct", "") + rex.sub(rule["output"], tok["word"]) + tok.get("postpunct", "")
+            res.append({
+                "type": "alias",
+                "text": tok["input"],
+                "alias": alias
+            })
+        return res
+
+    # Returns the first rule matching a token, as index + 1 if the rule matches the token input,
+    # or -(index + 1) if it matches the word (input is tested first for each rule). None if no rule matches.
+    def first_token_rule(self, stage, text, token_cache):
+        m = stage.combined.match(text)
+        i1 = stage.rule_index(m) if m else None
+        if i1 == 0:
+            return 1
+        m = stage.combined.match(self.textproc.cached_token(text, token_cache)["word"])
+        i2 = stage.rule_index(m) if m else None
+        if i1 is not None and (i2 is None or i1 <= i2):
+            return i1 + 1
+        if i2 is not None:
+            return -(i2 + 1)
+        return None
+
+    def apply_utterance_stage(self, stage, s: str):
+        res = []
+        # the first rule is applied to the text as it is, after that all text parts are stripped
+        for item in self.textproc.apply_rewrite_rule(stage.rules[0], s):
+            if item["type"] == "text":
+                self.apply_utterance_rules(stage, 1, item["text"], res)
+            else:
+                res.append(item)
+        return res
+
+    # Applies rules[i:] of an utterance stage to a stripped text s
+    def apply_utterance_rules(self, stage, i, s, res):
+        n = len(stage.rules)
+        if i >= n:
+            res.append({"type": "text", "text": s})
+            return
+        m = stage.combined[i].search(s)
+        if m is None:
+            if len(s) > 0:
+                res.append({"type": "text", "text": s})
+            return
+        # rules[i:j] don't match at the position of the first match, or before it
+        j = stage.rule_index(m, offset=i)
+        p = m.start()
+        k = j
+        for t in range(i, j):
+            if stage.rules[t]["input_compiled"].search(s, p + 1):
+                k = t
+                break
+        if k > i and len(s) == 0:
+            return
+        for item in self.textproc.apply_rewrite_rule(stage.rules[k], s):
+            if item["type"] == "text":
+                self.apply_utterance_rules(stage, k + 1, item["text"], res)
+            else:
+                res.append(item)
@@ -0,0 +1,36 @@
+# Compares the compiled rule engine with the rules applied one by one
+
+import pytest
+import random
+import textproc_server
+
+def test_inputs(client):
+    random.seed(0)
+    for name, tp in textproc_server.textprocs.items():
+        inputs = [t["from"] for t in tp.tests]
+        for r in tp.rewrite_rules:
+            inputs.extend(t["from"] for t in r["tests"])
+        words = " ".join(inputs).split() + ["", ".", ",", "1984", "XIV", "12,5", "3-", "%"]
+        for _ in range(500):
+            inputs.append("".join(random.choice(words) + random.choice([" ", "  ", "", ". ", ", ", "\t"]) for _ in range(random.randint(0, 10))))
+        for input in inputs:
+            item = {"type": "text", "text": input}
+            assert tp.apply_rewrite_rules(dict(item)) == tp.apply_rewrite_rules_sequential(dict(item)), f"{name}: {input}"
+
+def test_stages(client):
+    tp = textproc_server.textprocs["sv_se_1"]
+    stages = tp.rule_engine.stages
+    assert sum(len(s.rules) for s in stages) == len(tp.rewrite_rules)
+    assert all(s.combined is not None for s in stages)
+
+def test_numerals_expanded_once(client):
+    tp = textproc_server.textprocs["sv_se_1"]
+    calls = []
+    process_numeral = tp.process_numeral
+    tp.process_numeral = lambda s: calls.append(s) or process_numeral(s)
+    try:
+        tp.process_utt("1984 och 1984 och 17")
+    finally:
+        del tp.process_numeral
+    assert calls.count("1984") == 1
+    assert sorted(calls) == sorted(set(calls))
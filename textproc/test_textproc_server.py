@@ -7,6 +7,7 @@
 # Reading config env file defined in conftest.py
 
 import pytest
+import json
 
 def test_read_main(client):
     response = client.get("/")
@@ -122,3 +123,53 @@ def test_sv_ekr(client):
     toks = data[0]["tokens"]
     #assert len(toks) == 9
     assert data[0]["derived_output_text"] == "cirka år fyra-hundra efter Kristus till femton-hundra efter Kristus"
+
+def test_list_rbnf_cache(client):
+    response = client.get("/process_text?name=sv_se_1&input=år 1984 och 1984")
+    assert response.status_code == 200
+    response = client.get("/list")
+    assert response.status_code == 200
+    cache = {tp["name"]: tp["rbnf_cache"] for tp in response.json()}["sv_se_1"]
+    # prewarmed on startup
+    assert cache["size"] >= 3001
+    assert cache["hits"] > 0
+    assert 0 < cache["hit_rate"] <= 1
+
+def test_process_text_stream(client):
+    input = "cirka år 400 e.Kr. Till 1500 e.Kr. Och sen"
+    expect = client.get(f"/process_text?name=sv_se_1&input={input}").json()
+    assert len(expect) == 3
+    response = client.get(f"/process_text_stream?name=sv_se_1&input={input}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert [json.loads(l) for l in lines] == expect
+
+def test_process_batch(client):
+    texts = ["cirka år 400 e.Kr. Till 1500 e.Kr.", "hej", "den 3 februari såg jag en häst"]
+    expect = [client.get(f"/process_text?name=sv_se_1&input={t}").json() for t in texts]
+    response = client.post("/process_batch?name=sv_se_1", json=texts)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = [json.loads(l) for l in response.text.splitlines()]
+    assert [r["id"] for r in results] == [0, 1, 2]
+    assert [r["result"] for r in results] == expect
+
+def test_process_batch_ndjson(client):
+    body = "\n".join(json.dumps({"id": f"line{i}", "text": t}) for i, t in enumerate(["hej", "1984"]))
+    response = client.post("/process_batch?name=sv_se_1&ordered=false&output=text", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 200
+    results = {r["id"]: r["result"] for r in map(json.loads, response.text.splitlines())}
+    assert results == {"line0": ["hej"], "line1": ["nitton-hundra-åttio-fyra"]}
+
+def test_process_batch_invalid(client):
+    response = client.post("/process_batch?name=sv_se_1", json={"text": "hej"})
+    assert response.status_code == 400
+    response = client.post("/process_batch?name=xx", json=["hej"])
+    assert response.status_code == 404
+
+def test_process_batch_ndjson_invalid_line(client):
+    body = '"hej"\n{"id": 1\n"då"\n'
+    response = client.post("/process_batch?name=sv_se_1", content=body, headers={"content-type": "application/x-ndjson"})
+    assert response.status_code == 400
+    assert "item #1" in response.json()["detail"]
@@ -2,12 +2,15 @@ import os
 import sys
 import json
 import re
+import time
+import functools
 from unicode_rbnf import RbnfEngine, FormatPurpose, FormatOptions
 from typing import Final
 
 parentdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.insert(0, parentdir)
 from common import io, log
+from rule_engine import RuleEngine
 
 INT_RE: Final[str] = re.compile("^[0-9]+$")
 FLOAT_RE: Final[str] = re.compile("^[0-9]+[.][0-9]+$")
@@ -16,6 +19,12 @@ ROMAN_RE_EXCEPTION: Final[str] = re.compile("^CC$")
 YEAR_RE: Final[str] = re.compile("^1[0-9]{3}$")
 COMMA_FLOAT_RE: Final[str] = re.compile("^[0-9]+[,][0-9]+$")
 
+# RBNF memo cache (per textproc). Cardinals and years from 0 to prewarm are formatted on startup.
+rbnf_cache_defaults = {
+    "max_size": 10000,
+    "prewarm": 3000,
+}
+
 def roman2int(s):
     values = {"I": 1, "V": 5, "X": 10, "L": 50, "C": 100, "D": 500, "M": 1000}
     result = 0
@@ -49,6 +58,7 @@ def load_config(json_config):
             log.configure("textproc", data["logger"].get("handler",log.default_handler), data["logger"].get("level",log.default_level))
         else:
             log.configure("matcha", log.default_handler, log.default_level)
+        rbnf_cache = rbnf_cache_defaults | (data.get("rbnf_cache") or {})
 
         for component in data["textprocs"]:
             name = component["name"]
@@ -67,7 +77,8 @@ def load_config(json_config):
                 token_split_re = re.compile(rules["token_split_re"])
                 p_re = f"^((?:{rules['punctuation_re']})*)(.*?)((?:{rules['punctuation_re']})*)$"
                 punctuation_re = re.compile(p_re)
-                punctuation_after_match = re.compile(f"^((?:{rules['punctuation_re']})+)( |$)")
+                # no ^ anchor, since it's matched from the end of each rule match (with pos)
+                punctuation_after_match = re.compile(f"((?:{rules['punctuation_re']})+)( |$)")
                 rewrite_rules = load_nested_files(rules["rules"], resource_paths)
                 for id, r in enumerate(rewrite_rules,start=1):
                     if r.get("rule_type","") == "file":
@@ -85,32 +96,35 @@ def load_config(json_config):
                         r["input_compiled"] = re.compile(r["input"],re.IGNORECASE)
                     else:
                         r["input_compiled"] = re.compile(r["input"])
-                    comp_delim = rules.get("rbnf_compound_delimiter",None)
-                    if comp_delim is None:
-                        comp_delim_repeated = None
-                    else:
-                        comp_delim_repeated = re.compile(f"({comp_delim})+")
-                    rbnf_lang = rules.get("rbnf_lang", None)
-                    rbnf_engine = None
-                    if rbnf_lang:
-                        rbnf_engine = RbnfEngine.for_language(rbnf_lang)
-                    textprocs[name] = Textproc(
-                        name = name,
-                        lang = lang,
-                        rbnf_lang = rbnf_lang,
-                        sentence_split_re = sentence_split_re,
-                        token_split_re = token_split_re,
-                        punctuation_re = punctuation_re,
-                        punctuation_after_match = punctuation_after_match,
-                        rbnf_engine = rbnf_engine,
-                        rbnf_compound_delimiter = comp_delim,
-                        rbnf_compound_delimiter_repeated = comp_delim_repeated,
-                        rewrite_rules = rewrite_rules,
-                        tests = rules["tests"],
-                        enabled = rules.get("enabled",True),
-                        fail_on_error = rules.get("fail_on_error",True)
-                    )
-                log.info(f"Loaded textproc {name} with {len(rules)} rules")
+                comp_delim = rules.get("rbnf_compound_delimiter",None)
+                if comp_delim is None:
+                    comp_delim_repeated = None
+                else:
+                    comp_delim_repeated = re.compile(f"({comp_delim})+")
+                rbnf_lang = rules.get("rbnf_lang", None)
+                rbnf_engine = None
+                if rbnf_lang:
+                    rbnf_engine = RbnfEngine.for_language(rbnf_lang)
+                textprocs[name] = Textproc(
+                    name = name,
+                    lang = lang,
+                    rbnf_lang = rbnf_lang,
+                    sentence_split_re = sentence_split_re,
+                    token_split_re = token_split_re,
+                    punctuation_re = punctuation_re,
+                    punctuation_after_match = punctuation_after_match,
+                    rbnf_engine = rbnf_engine,
+                    rbnf_compound_delimiter = comp_delim,
+                    rbnf_compound_delimiter_repeated = comp_delim_repeated,
+                    rewrite_rules = rewrite_rules,
+                    tests = rules["tests"],
+                    enabled = rules.get("enabled",True),
+                    fail_on_error = rules.get("fail_on_error",True),
+                    rbnf_cache_size = rbnf_cache["max_size"]
+                )
+                log.info(f"Loaded textproc {name} with {len(rewrite_rules)} rules")
+                if rbnf_cache["prewarm"]:
+                    textprocs[name].prewarm_rbnf(rbnf_cache["prewarm"])
     return textprocs
 
 from dataclasses import dataclass, asdict
@@ -135,15 +149,47 @@ class Textproc:
     tests: list
     fail_on_error: bool
     enabled: bool
+    rbnf_cache_size: int = rbnf_cache_defaults["max_size"]
 
     def __post_init__(self):
         self.loaded = False
+        self.rule_engine = RuleEngine(self, self.rewrite_rules)
+        # keyed on (number, fmt); typed, since e.g. 1 and 1.0 are formatted differently
+        self.rbnf_cache = functools.lru_cache(maxsize=self.rbnf_cache_size, typed=True)(self.rbnfify_uncached)
+        self.rbnf_prewarm_stats = (0, 0)
 
     def __str__(self):
         dict = asdict(self)
         return f"{dict}"
 
     def rbnfify(self, number, fmt=None):
+        return self.rbnf_cache(number, fmt)
+
+    def prewarm_rbnf(self, max_number: int):
+        if self.rbnf_engine is None:
+            return
+        start_time = time.time()
+        for i in range(max_number + 1):
+            self.rbnfify(i)
+            self.rbnfify(i, FormatPurpose.YEAR)
+        # prewarm lookups are not counted in the hit rate
+        info = self.rbnf_cache.cache_info()
+        self.rbnf_prewarm_stats = (info.hits, info.misses)
+        log.info(f"Prewarmed RBNF cache for textproc {self.name} with numbers 0-{max_number} in {time.time() - start_time:.2f} seconds")
+
+    def rbnf_cache_info(self):
+        info = self.rbnf_cache.cache_info()
+        hits = info.hits - self.rbnf_prewarm_stats[0]
+        misses = info.misses - self.rbnf_prewarm_stats[1]
+        return {
+            "max_size": info.maxsize,
+            "size": info.currsize,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else None,
+        }
+
+    def rbnfify_uncached(self, number, fmt=None):
         opts = FormatOptions.PRESERVE_SOFT_HYPENS
         res = f"{number}"
         if fmt is None and self.rbnf_engine:
@@ -167,64 +213,72 @@ class Textproc:
             res = self.rbnf_compound_delimiter_repeated.sub(self.rbnf_compound_delimiter, res)
         return res
 
+    # Splits text into sentences in a single pass: each sentence_split_re match is replaced by a sentence break
+    # followed by group 2 (the start of the next sentence). Tabs in the input are also sentence breaks.
+    def split_sentences(self, text: str):
+        acc = ""
+        i = 0
+        for m in self.sentence_split_re.finditer(text):
+            yield from (acc + text[i:m.start()]).split("\t")
+            acc = m.expand("\\2")
+            i = m.end()
+        yield from (acc + text[i:]).split("\t")
+
+    # Yields the processed utterances one at a time, as soon as each sentence is processed
+    def process_text_stream(self, text: str):
+        for utt in self.split_sentences(text):
+            yield self.process_utt(utt)
+
     def process_text(self, text: str):
         #log.debug(f"textproc.process_text called with {text}")
-        utts = []
-        acc = text
-        m = self.sentence_split_re.search(acc)
-        while m:
-            acc = self.sentence_split_re.sub("\t\\2", acc)
-            m = self.sentence_split_re.match(acc)
-        for utt in re.compile("\t").split(acc):
-            utts.append(self.process_utt(utt))
-        return utts
-
-    def toksplit(self, utt: str, process_numeral=True):
-        input_tokens = self.token_split_re.split(utt)
+        return list(self.process_text_stream(text))
+
+    def toksplit(self, utt: str, process_numeral=True, token_cache=None):
         res = []
-        for t in input_tokens:
-            m = self.punctuation_re.match(t)
-            if m is None:
-                raise Exception(f"Expected token '{t}' to match punctuation_re /{self.punctuation_re.pattern}/")
-            prepunct = m.group(1)
-            word = m.group(2)
-            if process_numeral:
-                word2, tags = self.process_numeral(word)
-            else:
-                word2, tags = word, []
-            postpunct = m.group(3)
-            if "spellout" in tags:
-                words = list(word2)
-                word2 = self.rbnf_compound_delimiter.join(words)
+        for t in self.token_split_re.split(utt):
+            if token_cache is None or not process_numeral:
+                res.append(self.create_token(t, process_numeral))
             else:
-                words = self.token_split_re.split(word2)
-            # if len(words) == 1:
-            word = {
-                "input": t,
-                "word": word2
-            }
-            if tags is not None and len(tags) > 0:
-                word["tags"] = tags
-            if len(prepunct) > 0:
-                word["prepunct"] = prepunct
-            if len(postpunct) > 0:
-                word["postpunct"] = postpunct
-            res.append(word)
-            # else:
-            #     for i, w in enumerate(words):
-            #         word = {
-            #             "input": w,
-            #             "word": w
-            #         }
-            #         if tags is not None and len(tags) > 0:
-            #             word["tags"] = tags
-            #         if i==0 and len(prepunct) > 0:
-            #             word["prepunct"] = prepunct
-            #         if i==len(words)-1 and len(postpunct) > 0:
-            #             word["postpunct"] = postpunct
-            #         res.append(word)
-
-        return res           
+                word = dict(self.cached_token(t, token_cache))
+                if "tags" in word:
+                    word["tags"] = list(word["tags"])
+                res.append(word)
+        return res
+
+    # Token record for input token t, split into punctuation and word, with numerals expanded
+    def create_token(self, t: str, process_numeral=True):
+        m = self.punctuation_re.match(t)
+        if m is None:
+            raise Exception(f"Expected token '{t}' to match punctuation_re /{self.punctuation_re.pattern}/")
+        prepunct = m.group(1)
+        word = m.group(2)
+        if process_numeral:
+            word2, tags = self.process_numeral(word)
+        else:
+            word2, tags = word, []
+        postpunct = m.group(3)
+        if "spellout" in tags:
+            word2 = self.rbnf_compound_delimiter.join(list(word2))
+        word = {
+            "input": t,
+            "word": word2
+        }
+        if tags is not None and len(tags) > 0:
+            word["tags"] = tags
+        if len(prepunct) > 0:
+            word["prepunct"] = prepunct
+        if len(postpunct) > 0:
+            word["postpunct"] = postpunct
+        return word
+
+    # Token records are created on first use, and then reused by all rules for the rest of the utterance (see process_utt).
+    # The cached records are shared, and should not be modified (toksplit returns copies).
+    def cached_token(self, t: str, token_cache: dict):
+        word = token_cache.get(t)
+        if word is None:
+            word = self.create_token(t)
+            token_cache[t] = word
+        return word
 
     def is_roman(self, s: str):
         return ROMAN_RE.match(s) and not ROMAN_RE_EXCEPTION.match(s)
@@ -272,11 +326,11 @@ class Textproc:
             processed_token = self.rbnfify(s, formatPurpose)
         return processed_token, tags
     
-    def apply_rewrite_rule(self, rule, s: str):
+    def apply_rewrite_rule(self, rule, s: str, token_cache=None):
         res = []
         rex = rule["input_compiled"]
         if rule["rule_type"] == "token":
-            tokens = self.toksplit(s)
+            tokens = self.toksplit(s, token_cache=token_cache)
             for tok in tokens:
                 m = rex.match(tok["input"])
                 if m:
@@ -312,7 +366,7 @@ class Textproc:
         else: # rule type utterance
             matches = rex.finditer(s)
             i = 0
-            rest = s
+            rest = 0 # start of the remaining text
             for m in matches:
                 span = m.span()
                 res.append({
@@ -320,16 +374,16 @@ class Textproc:
                     "text": s[i:span[0]].strip()
                 })
                 text = s[span[0]:span[1]]
-                rest = s[span[1]:len(s)]
+                rest = span[1]
                 i = span[1]
                 alias = rex.sub(rule["output"],text)
                 alias = alias.replace("  "," ")
                 if rule.get("trim",False):
                     alias = alias.strip()
-                mx = self.punctuation_after_match.match(rest)
+                mx = self.punctuation_after_match.match(s, span[1])
                 if mx:
                     n = len(mx.group(1))
-                    rest = s[span[1]+n:len(s)]
+                    rest = span[1]+n
                     alias = alias+mx.group(1)
                     if rule.get("strip",False):
                         alias = alias.strip()
@@ -338,10 +392,10 @@ class Textproc:
                     "text": text,
                     "alias": alias
                 })
-            if len(rest) > 0:
+            if rest < len(s):
                 end = {
                     "type": "text",
-                    "text": rest.strip()
+                    "text": s[rest:].strip()
                 }
                 res.append(end)
 
@@ -369,7 +423,11 @@ class Textproc:
         # return converted_res
         return res
         
-    def apply_rewrite_rules(self, item: object):
+    def apply_rewrite_rules(self, item: object, token_cache=None):
+        return self.rule_engine.apply(item, token_cache)
+
+    # Applies the rules one by one (reference implementation for the compiled rule engine)
+    def apply_rewrite_rules_sequential(self, item: object):
         acc = [item]
         for r in self.rewrite_rules:
             acc0 = acc
@@ -398,14 +456,16 @@ class Textproc:
         else:
             items = input
         res = []
+        # token records are shared by all rules, and by the words below
+        token_cache = {}
         for item in items:
             if item["type"] == "text":
-                subitems = self.apply_rewrite_rules(item)
+                subitems = self.apply_rewrite_rules(item, token_cache)
                 for i, item in enumerate(subitems):
                     if item["type"] == "text":
-                        item["words"] = self.toksplit(item["text"])
+                        item["words"] = self.toksplit(item["text"], token_cache=token_cache)
                     elif item["type"] == "alias":
-                        item["words"] = self.toksplit(item["alias"])
+                        item["words"] = self.toksplit(item["alias"], token_cache=token_cache)
                     elif item["type"] == "phonemes":
                         item["words"] = [
                             {
@@ -417,7 +477,7 @@ class Textproc:
                 res.extend(subitems)
             elif item["type"] == "alias":
                 if not "tokens" in item:
-                    item["words"] = self.toksplit(item["alias"])
+                    item["words"] = self.toksplit(item["alias"], token_cache=token_cache)
                 res.append(item)
             elif item["type"] == "phonemes":
                 i = {
@@ -454,7 +514,7 @@ class Textproc:
             
 
         derived_input = []
-        derived_output = ""
+        derived_output = []
         for item in res:
             if "text" in item:
                 derived_input.append(item["text"])
@@ -472,10 +532,10 @@ class Textproc:
                         token.pop("postpunct")                    
 
                 t = f"{token.get('prepunct','')}{token['word']}{token.get('postpunct','')}"
-                derived_output = derived_output + t
+                derived_output.append(t)
                 if not "nodelim" in token.get("tags",[]):
-                    derived_output = derived_output + " "
-        derived_output = derived_output.replace("  "," ")
+                    derived_output.append(" ")
+        derived_output = "".join(derived_output).replace("  "," ")
         complete_res = {
             "input": input,
             "derived_input_text": " ".join(derived_input),
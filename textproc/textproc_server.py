@@ -3,8 +3,9 @@
 import os
 import sys
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel # data models for post requests
 from dotenv import load_dotenv
 import json, re
@@ -14,6 +15,7 @@ sys.path.insert(0, parentdir)
 from common import release, log
 
 import textproc
+import batch
 
 json_config = os.getenv("TEXTPROC_CONFIG")  # Reads from .env file passed to uvicorn
 if not json_config:
@@ -22,10 +24,11 @@ if not json_config:
 load_dotenv()
 
 textprocs = {}
+batch_processor = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global textprocs, vInfo
+    global textprocs, vInfo, batch_processor
     textprocs = textproc.load_config(json_config)
     startedAt = release.genStartedAtString()
     vInfo = release.versionInfo("textproc",startedAt)
@@ -41,6 +44,8 @@ async def lifespan(app: FastAPI):
         raise Exception("Server exit after textproc selftest errors")
         #sys.exit(1)
     yield
+    if batch_processor is not None:
+        batch_processor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan, swagger_ui_parameters={"tryItOutEnabled": True})
@@ -98,13 +103,72 @@ async def process_text(
     return res
 
 
+# Streams the processed utterances as NDJSON, one line per sentence, so that clients can start on the first sentence
+@app.get("/process_text_stream")
+async def process_text_stream(
+    name: str = "sv_se_1", input: str = "den 3 februari såg jag en häst. Den var brun"
+):
+    if textprocs is None:
+        raise Exception("textprocs not initialized")
+    if not name in textprocs:
+        msg = f"No such textproc: {name}"
+        log.error(msg)
+        raise HTTPException(status_code=404, detail=msg)
+    comp = textprocs[name]
+    def generate():
+        for utt in comp.process_text_stream(input):
+            yield json.dumps(utt, ensure_ascii=False) + "\n"
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+# The batch worker processes are started on the first /process_batch request
+def get_batch_processor():
+    global batch_processor
+    if batch_processor is None:
+        batch_processor = batch.create_processor(json_config)
+        batch_processor.start()
+    return batch_processor
+
+
+# Processes many texts in the batch worker processes, and streams the results as NDJSON, one line per input text.
+# The request body is a JSON array, or NDJSON (with content type application/x-ndjson). Each item is a string, or an
+# object with text and an optional id. Results are tagged with the item id (or its position in the batch), and returned
+# in input order, or as soon as they are done (ordered=false).
+# NDJSON input is parsed line by line as it is uploaded. The upload is read before the response is started, since the
+# response listens for client disconnects while streaming, and would take the rest of the request body.
+# If the client disconnects, chunks that haven't been started by the workers are dropped.
+@app.post("/process_batch")
+async def process_batch(request: Request, name: str = "sv_se_1", ordered: bool = True, output: str = "full"):
+    if not name in textprocs:
+        msg = f"No such textproc: {name}"
+        log.error(msg)
+        raise HTTPException(status_code=404, detail=msg)
+    if output not in batch.OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid output format: {output} (expected one of {batch.OUTPUT_FORMATS})")
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items = [item async for item in batch.read_ndjson_stream(request.stream())]
+        else:
+            items = batch.parse_json_batch(await request.body())
+    except ValueError as e:
+        log.error(f"Invalid batch: {e}")
+        raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
+    processor = get_batch_processor()
+    async def generate():
+        async for res in processor.run_async(name, batch.iterate_async(items), ordered=ordered, output=output):
+            yield json.dumps(res, ensure_ascii=False) + "\n"
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
 @app.get("/list")
 async def list():
     if textprocs is None:
         raise Exception("textprocs not initialized")
     res = []
     for tp in textprocs.values():
-        res.append(tp)
+        obj = jsonable_encoder(tp)
+        obj["rbnf_cache"] = tp.rbnf_cache_info()
+        res.append(obj)
     return res
 
 @app.get("/ping")